@@ -11,6 +11,7 @@ from src.facerender.animate import AnimateFromCoeff
 from src.generate_batch import get_data
 from src.generate_facerender_batch import get_facerender_data
 from src.utils.init_path import init_path
+from src.utils.pipeline_context import PipelineContext
 
 def main(args):
     #torch.backends.cudnn.enabled = False
@@ -37,17 +38,20 @@ def main(args):
 
     audio_to_coeff = Audio2Coeff(sadtalker_paths,  device)
     
-    animate_from_coeff = AnimateFromCoeff(sadtalker_paths, device)
+    animate_from_coeff = AnimateFromCoeff(sadtalker_paths, device, check_freeze=args.check_freeze,
+                                          compile_mode=args.compile, cache_dir=args.compile_dir)
+
+    # the stages hand their results over in memory, the intermediate files are only written with --verbose
+    context = PipelineContext(pic_path, audio_path, save_dir=save_dir if args.verbose else None)
 
     #crop image and extract 3dmm from image
-    first_frame_dir = os.path.join(save_dir, 'first_frame_dir')
-    os.makedirs(first_frame_dir, exist_ok=True)
     print('3DMM Extraction for source image')
-    first_coeff_path, crop_pic_path, crop_info =  preprocess_model.generate(pic_path, first_frame_dir, args.preprocess,\
-                                                                             source_image_flag=True, pic_size=args.size)
-    if first_coeff_path is None:
+    source = preprocess_model.extract(pic_path, args.preprocess, source_image_flag=True, pic_size=args.size)
+    if source is None:
         print("Can't get the coeffs of the input")
         return
+    context.set_source(source)
+    crop_info = context.crop_info
 
     if ref_eyeblink is not None:
         ref_eyeblink_videoname = os.path.splitext(os.path.split(ref_eyeblink)[-1])[0]
@@ -71,21 +75,31 @@ def main(args):
         ref_pose_coeff_path=None
 
     #audio2ceoff
-    batch = get_data(first_coeff_path, audio_path, device, ref_eyeblink_coeff_path, still=args.still)
-    coeff_path = audio_to_coeff.generate(batch, save_dir, pose_style, ref_pose_coeff_path)
+    batch = get_data(None, audio_path, device, ref_eyeblink_coeff_path, still=args.still, context=context)
+    audio_to_coeff.generate(batch, save_dir, pose_style, ref_pose_coeff_path, context=context)
 
     # 3dface render
     if args.face3dvis:
         from src.face3d.visualize import gen_composed_video
-        gen_composed_video(args, device, first_coeff_path, coeff_path, audio_path, os.path.join(save_dir, '3dface.mp4'))
+        gen_composed_video(args, device, context.source['full_3dmm'], context.coeffs, audio_path, os.path.join(save_dir, '3dface.mp4'))
     
     #coeff2video
-    data = get_facerender_data(coeff_path, crop_pic_path, first_coeff_path, audio_path, 
+    data = get_facerender_data(None, None, None, audio_path, 
                                 batch_size, input_yaw_list, input_pitch_list, input_roll_list,
-                                expression_scale=args.expression_scale, still_mode=args.still, preprocess=args.preprocess, size=args.size)
+                                expression_scale=args.expression_scale, still_mode=args.still, preprocess=args.preprocess, size=args.size,
+                                dump_txt=args.verbose, context=context)
     
+    if args.precision_report:
+        for precision, stats in animate_from_coeff.precision_report(data).items():
+            print('%s: PSNR %.2f dB against fp32, %.2fs' % (precision, stats['psnr'], stats['seconds']))
+    if args.compile_report:
+        for mode, stats in animate_from_coeff.compile_report(data).items():
+            print('%s: %.1f ms/frame' % (mode, stats['ms_per_frame']) +
+                  (', max diff %.2g against eager, compiled in %.2fs' % (stats['max_abs_diff'], stats['compile_time']) if 'max_abs_diff' in stats else ''))
+
     result = animate_from_coeff.generate(data, save_dir, pic_path, crop_info, \
-                                enhancer=args.enhancer, background_enhancer=args.background_enhancer, preprocess=args.preprocess, img_size=args.size)
+                                enhancer=args.enhancer, background_enhancer=args.background_enhancer, preprocess=args.preprocess, img_size=args.size,
+                                render_memory_mb=args.render_memory_mb, precision=args.precision)
     
     shutil.move(result, save_dir+'.mp4')
     print('The generated video is named:', save_dir+'.mp4')
@@ -106,6 +120,9 @@ if __name__ == '__main__':
     parser.add_argument("--pose_style", type=int, default=0,  help="input pose style from [0, 46)")
     parser.add_argument("--batch_size", type=int, default=2,  help="the batch size of facerender")
     parser.add_argument("--size", type=int, default=256,  help="the image size of the facerender")
+    parser.add_argument("--render_memory_mb", type=int, default=2048,  help="memory budget of one facerender batch, frames are rendered in chunks that fit in it")
+    parser.add_argument("--precision", default='fp32', choices=['fp32', 'bf16', 'fp16', 'auto'], help="face render precision, auto is fp16 on cuda and bf16 on cpu")
+    parser.add_argument("--precision_report", action="store_true", help="print the PSNR of the reduced precision renders against fp32 on the first second")
     parser.add_argument("--expression_scale", type=float, default=1.,  help="the batch size of facerender")
     parser.add_argument('--input_yaw', nargs='+', type=int, default=None, help="the input yaw degree of the user ")
     parser.add_argument('--input_pitch', nargs='+', type=int, default=None, help="the input pitch degree of the user")
@@ -118,6 +135,10 @@ if __name__ == '__main__':
     parser.add_argument("--preprocess", default='crop', choices=['crop', 'extcrop', 'resize', 'full', 'extfull'], help="how to preprocess the images" ) 
     parser.add_argument("--verbose",action="store_true", help="saving the intermedia output or not" ) 
     parser.add_argument("--old_version",action="store_true", help="use the pth other than safetensor version" ) 
+    parser.add_argument("--compile", default='off', choices=['off', 'trace', 'inductor'], help="compile the face renderer decode, cached on disk across runs")
+    parser.add_argument("--compile_dir", default=None, help="where the compiled face renderers are cached, $SADTALKER_CACHE_DIR/compiled by default")
+    parser.add_argument("--compile_report", action="store_true", help="print the per-frame render latency of the eager and the compiled face renderer")
+    parser.add_argument("--check_freeze", action="store_true", help="compare the face renderer frozen for inference with the checkpoint one")
 
 
     # net structure and parameters
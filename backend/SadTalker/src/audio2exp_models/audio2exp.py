@@ -1,41 +1,41 @@
-from tqdm import tqdm
 import torch
 from torch import nn
 
 
 class Audio2Exp(nn.Module):
-    def __init__(self, netG, cfg, device, prepare_training_loss=False):
+    def __init__(self, netG, cfg, device, prepare_training_loss=False, chunk_size=256):
         super(Audio2Exp, self).__init__()
         self.cfg = cfg
         self.device = device
         self.netG = netG.to(device)
+        # netG is per-frame, so the sequence can be cut anywhere. chunk_size only bounds the activation memory,
+        # None runs the whole sequence in one forward pass.
+        self.chunk_size = chunk_size
 
-    def test(self, batch):
+    def forward_chunk(self, batch, start, end):
+        mel_input = batch['indiv_mels'][:, start:end]                  # bs t 1 80 16
+        ref = batch['ref'][:, :, :64][:, start:end]                    # bs t 64
+        ratio = batch['ratio_gt'][:, start:end]                        # bs t
 
-        mel_input = batch['indiv_mels']                         # bs T 1 80 16
-        bs = mel_input.shape[0]
-        T = mel_input.shape[1]
+        audiox = mel_input.reshape(-1, 1, 80, 16)                      # bs*t 1 80 16
 
-        exp_coeff_pred = []
+        # no_grad is thread local, chunks may run on a worker thread
+        with torch.no_grad():
+            return self.netG(audiox, ref, ratio)                       # bs t 64
 
-        for i in tqdm(range(0, T, 10),'audio2exp:'): # every 10 frames
-            
-            current_mel_input = mel_input[:,i:i+10]
+    def iter_test(self, batch, chunk_size=None):
+        """ Yield the expression coefficients chunk by chunk, in order. """
+        T = batch['indiv_mels'].shape[1]
+        chunk_size = chunk_size or self.chunk_size or T
+        for start in range(0, T, chunk_size):
+            yield self.forward_chunk(batch, start, min(start + chunk_size, T))
 
-            #ref = batch['ref'][:, :, :64].repeat((1,current_mel_input.shape[1],1))           #bs T 64
-            ref = batch['ref'][:, :, :64][:, i:i+10]
-            ratio = batch['ratio_gt'][:, i:i+10]                               #bs T
+    def test(self, batch, chunk_size=None):
 
-            audiox = current_mel_input.view(-1, 1, 80, 16)                  # bs*T 1 80 16
-
-            curr_exp_coeff_pred  = self.netG(audiox, ref, ratio)         # bs T 64 
-
-            exp_coeff_pred += [curr_exp_coeff_pred]
+        exp_coeff_pred = list(self.iter_test(batch, chunk_size))
 
         # BS x T x 64
         results_dict = {
             'exp_coeff_pred': torch.cat(exp_coeff_pred, axis=1)
             }
         return results_dict
-
-
@@ -45,7 +45,54 @@ class Audio2Pose(nn.Module):
 
         return batch
 
-    def test(self, x):
+    def window_starts(self, num_frames):
+        """ Start of every seq_len window in the frames after the ref frame, the tail window last. """
+        num_frames = int(num_frames) - 1
+        div = num_frames//self.seq_len
+        re = num_frames%self.seq_len
+        starts = [i*self.seq_len for i in range(div)]
+        if re != 0:
+            starts.append(max(num_frames - self.seq_len, 0))
+        return starts
+
+    def predict_windows(self, x, first, last, seed=None):
+        """
+        Pose motion of windows [first, last) as bs x W x seq_len x 6, the windows going through
+        the audio encoder and the CVAE decoder as one batch. With a seed, window i draws its z
+        from seed + i, so any range of windows matches the same windows of a full run.
+        """
+        ref = x['ref'][:,0,-6:]                   # bs 6
+        bs = ref.shape[0]
+        indiv_mels_use = x['indiv_mels'][:, 1:]   # we regard the ref as the first frame
+        starts = self.window_starts(x['num_frames'])[first:last]
+        num_windows = len(starts)
+
+        windows = [indiv_mels_use[:, start:start+self.seq_len] for start in starts]
+        mels = torch.stack(windows, dim=1)                                # bs W seq_len 1 80 16
+        audio_emb = self.audio_encoder.encode_windows(mels.reshape((bs * num_windows,) + mels.shape[2:])) # bs*W seq_len 512
+        if audio_emb.shape[1] != self.seq_len:
+            pad_dim = self.seq_len-audio_emb.shape[1]
+            pad_audio_emb = audio_emb[:, :1].repeat(1, pad_dim, 1) 
+            audio_emb = torch.cat([pad_audio_emb, audio_emb], 1) 
+
+        if seed is None:
+            z = torch.randn(bs, num_windows, self.latent_dim)
+        else:
+            z = torch.stack([torch.randn(bs, self.latent_dim, generator=torch.Generator().manual_seed(seed + first + i))
+                             for i in range(num_windows)], dim=1)          # bs W latent_dim
+
+        window_batch = {'z': z.reshape(bs * num_windows, self.latent_dim).to(ref.device),
+                        'audio_emb': audio_emb,
+                        'class': x['class'].repeat_interleave(num_windows, dim=0),
+                        'ref': ref.repeat_interleave(num_windows, dim=0)}
+        window_batch = self.netG.test(window_batch)
+        window_batch['pose_motion_pred'] = window_batch['pose_motion_pred'].reshape(bs, num_windows, self.seq_len, -1)  # bs W seq_len 6
+        return window_batch
+
+    def test(self, x, seed=None):
+        """
+        All seq_len windows (the padded tail included) are predicted as one batch.
+        """
 
         batch = {}
         ref = x['ref']                            #bs 1 70
@@ -53,37 +100,26 @@ class Audio2Pose(nn.Module):
         batch['class'] = x['class']  
         bs = ref.shape[0]
         
-        indiv_mels= x['indiv_mels']               # bs T 1 80 16
-        indiv_mels_use = indiv_mels[:, 1:]        # we regard the ref as the first frame
         num_frames = x['num_frames']
         num_frames = int(num_frames) - 1
 
         #  
         div = num_frames//self.seq_len
         re = num_frames%self.seq_len
-        audio_emb_list = []
         pose_motion_pred_list = [torch.zeros(batch['ref'].unsqueeze(1).shape, dtype=batch['ref'].dtype, 
                                                 device=batch['ref'].device)]
 
-        for i in range(div):
-            z = torch.randn(bs, self.latent_dim).to(ref.device)
-            batch['z'] = z
-            audio_emb = self.audio_encoder(indiv_mels_use[:, i*self.seq_len:(i+1)*self.seq_len,:,:,:]) #bs seq_len 512
-            batch['audio_emb'] = audio_emb
-            batch = self.netG.test(batch)
-            pose_motion_pred_list.append(batch['pose_motion_pred'])  #list of bs seq_len 6
-        
-        if re != 0:
-            z = torch.randn(bs, self.latent_dim).to(ref.device)
-            batch['z'] = z
-            audio_emb = self.audio_encoder(indiv_mels_use[:, -1*self.seq_len:,:,:,:]) #bs seq_len  512
-            if audio_emb.shape[1] != self.seq_len:
-                pad_dim = self.seq_len-audio_emb.shape[1]
-                pad_audio_emb = audio_emb[:, :1].repeat(1, pad_dim, 1) 
-                audio_emb = torch.cat([pad_audio_emb, audio_emb], 1) 
-            batch['audio_emb'] = audio_emb
-            batch = self.netG.test(batch)
-            pose_motion_pred_list.append(batch['pose_motion_pred'][:,-1*re:,:])   
+        num_windows = len(self.window_starts(x['num_frames']))
+        if num_windows > 0:
+            window_batch = self.predict_windows(x, 0, num_windows, seed)
+            pose_motion_pred = window_batch['pose_motion_pred']               # bs W seq_len 6
+
+            if div > 0:
+                pose_motion_pred_list.append(pose_motion_pred[:, :div].reshape(bs, div*self.seq_len, -1))  # bs div*seq_len 6
+            if re != 0:
+                pose_motion_pred_list.append(pose_motion_pred[:, -1, -1*re:, :])
+            batch['z'] = window_batch['z']
+            batch['audio_emb'] = window_batch['audio_emb']
         
         pose_motion_pred = torch.cat(pose_motion_pred_list, dim = 1)
         batch['pose_motion_pred'] = pose_motion_pred
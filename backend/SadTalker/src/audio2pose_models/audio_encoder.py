@@ -51,6 +51,13 @@ class AudioEncoder(nn.Module):
         # self.audio_encoder.load_state_dict(state_dict)
 
 
+    def encode_windows(self, audio_sequences):
+        # audio_sequences = (B, T, 1, 80, 16), every frame of every window is encoded in one batch.
+        # Unlike forward(), the (B, T) order is kept for B > 1.
+        B, T = audio_sequences.shape[:2]
+        audio_embedding = self.audio_encoder(audio_sequences.reshape((B * T,) + audio_sequences.shape[2:])) # B*T, 512, 1, 1
+        return audio_embedding.reshape(B, T, -1) #B T 512
+
     def forward(self, audio_sequences):
         # audio_sequences = (B, T, 1, 80, 16)
         B = audio_sequences.size(0)
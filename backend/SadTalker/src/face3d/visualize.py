@@ -10,10 +10,10 @@ from tqdm import tqdm
 
 # draft
 def gen_composed_video(args, device, first_frame_coeff, coeff_path, audio_path, save_path, exp_dim=64):
-    
-    coeff_first = scio.loadmat(first_frame_coeff)['full_3dmm']
+    # the coefficients are either .mat paths or the arrays themselves
+    coeff_first = scio.loadmat(first_frame_coeff)['full_3dmm'] if isinstance(first_frame_coeff, str) else first_frame_coeff
 
-    coeff_pred = scio.loadmat(coeff_path)['coeff_3dmm']
+    coeff_pred = scio.loadmat(coeff_path)['coeff_3dmm'] if isinstance(coeff_path, str) else coeff_path
 
     coeff_full = np.repeat(coeff_first, coeff_pred.shape[0], axis=0) # 257
 
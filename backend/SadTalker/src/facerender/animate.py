@@ -1,15 +1,14 @@
 import os
+import tempfile
+import time
 import cv2
 import yaml
 import numpy as np
 import warnings
 from skimage import img_as_ubyte
-import safetensors
-import safetensors.torch 
 warnings.filterwarnings('ignore')
 
 
-import imageio
 import torch
 import torchvision
 
@@ -17,12 +16,14 @@ import torchvision
 from src.facerender.modules.keypoint_detector import HEEstimator, KPDetector
 from src.facerender.modules.mapping import MappingNet
 from src.facerender.modules.generator import OcclusionAwareGenerator, OcclusionAwareSPADEGenerator
-from src.facerender.modules.make_animation import make_animation 
+from src.facerender.modules.make_animation import iter_animation, precision_report, SourceEncodingCache
+from src.facerender.freeze import freeze_for_inference, freeze_checked
+from src.facerender.compile import CompiledGenerator, checkpoint_fingerprint
 
-from pydub import AudioSegment 
 from src.utils.face_enhancer import enhancer_generator_with_len, enhancer_list
-from src.utils.paste_pic import paste_pic
-from src.utils.videoio import save_video_with_watermark
+from src.utils.paste_pic import load_full_image, get_paste_box, paste_frame
+from src.utils.videoio import VideoStreamWriter
+from src.utils.safetensor_helper import load_checkpoint
 
 try:
     import webui  # in webui
@@ -32,7 +33,7 @@ except:
 
 class AnimateFromCoeff():
 
-    def __init__(self, sadtalker_path, device):
+    def __init__(self, sadtalker_path, device, freeze=True, check_freeze=False, compile_mode='off', cache_dir=None):
 
         with open(sadtalker_path['facerender_yaml']) as f:
             config = yaml.safe_load(f)
@@ -80,33 +81,53 @@ class AnimateFromCoeff():
         self.generator.eval()
         self.he_estimator.eval()
         self.mapping.eval()
+
+        if freeze:
+            self.freeze(device, check_freeze)
+
+        # the generator iter_animation renders with, its decode compiled unless compile_mode is 'off'
+        self.renderer = self.generator
+        if compile_mode != 'off':
+            if cache_dir is None:
+                cache_dir = os.path.join(os.environ.get('SADTALKER_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'sadtalker_cache')), 'compiled')
+            checkpoints = [sadtalker_path.get('checkpoint', sadtalker_path.get('free_view_checkpoint')),
+                           sadtalker_path['mappingnet_checkpoint'], sadtalker_path['facerender_yaml']]
+            fingerprint = checkpoint_fingerprint(checkpoints) + ('_frozen' if freeze else '')
+            self.renderer = CompiledGenerator(self.generator, cache_dir, fingerprint, compile_mode)
+
+        # encoded avatars are reused across frames and requests
+        self.source_cache = SourceEncodingCache()
          
         self.device = device
     
+    def freeze(self, device, check=False):
+        """ Spectral norms and batch norms rewritten for inference, optionally checked against the loaded models. """
+        if not check:
+            for model in (self.kp_extractor, self.he_estimator, self.generator):
+                freeze_for_inference(model)
+            return
+
+        with torch.no_grad():
+            image = torch.rand(1, 3, 256, 256, device=device)
+            kp_source = self.kp_extractor(image)
+            kp_driving = {'value': kp_source['value'] + 0.02 * torch.randn_like(kp_source['value'])}
+        for name, model, run in [('kp_extractor', self.kp_extractor, lambda m: m(image)),
+                                 ('he_estimator', self.he_estimator, lambda m: m(image)),
+                                 ('generator', self.generator, lambda m: m(image, kp_driving=kp_driving, kp_source=kp_source))]:
+            print('freeze %s: %s' % (name, freeze_checked(model, run)))
+
     def load_cpk_facevid2vid_safetensor(self, checkpoint_path, generator=None, 
                         kp_detector=None, he_estimator=None,  
                         device="cpu"):
 
-        checkpoint = safetensors.torch.load_file(checkpoint_path)
+        checkpoint = load_checkpoint(checkpoint_path)
 
         if generator is not None:
-            x_generator = {}
-            for k,v in checkpoint.items():
-                if 'generator' in k:
-                    x_generator[k.replace('generator.', '')] = v
-            generator.load_state_dict(x_generator)
+            generator.load_state_dict(checkpoint.view('generator'))
         if kp_detector is not None:
-            x_generator = {}
-            for k,v in checkpoint.items():
-                if 'kp_extractor' in k:
-                    x_generator[k.replace('kp_extractor.', '')] = v
-            kp_detector.load_state_dict(x_generator)
+            kp_detector.load_state_dict(checkpoint.view('kp_extractor'))
         if he_estimator is not None:
-            x_generator = {}
-            for k,v in checkpoint.items():
-                if 'he_estimator' in k:
-                    x_generator[k.replace('he_estimator.', '')] = v
-            he_estimator.load_state_dict(x_generator)
+            he_estimator.load_state_dict(checkpoint.view('he_estimator'))
         
         return None
 
@@ -154,7 +175,64 @@ class AnimateFromCoeff():
 
         return checkpoint['epoch']
 
-    def generate(self, x, video_save_dir, pic_path, crop_info, enhancer=None, background_enhancer=None, preprocess='crop', img_size=256):
+    def iter_frames(self, source_image, source_semantics, target_semantics, crop_info, img_size=256,
+                    yaw_c_seq=None, pitch_c_seq=None, roll_c_seq=None, frame_num=None, render_memory_mb=2048, precision='fp32'):
+        """ Rendered frames as uint8 RGB arrays, back at the aspect ratio of the crop, as soon as each chunk is done. """
+        ### the generated video is 256x256, so we keep the aspect ratio, 
+        original_size = crop_info[0]
+        if original_size:
+            out_size = (img_size, int(img_size * original_size[1]/original_size[0]))
+
+        predictions = iter_animation(source_image, source_semantics, target_semantics,
+                                        self.renderer, self.kp_extractor, self.mapping, 
+                                        yaw_c_seq, pitch_c_seq, roll_c_seq,
+                                        source_cache=self.source_cache, render_memory_mb=render_memory_mb,
+                                        precision=precision)
+        written = 0
+        for chunk in predictions:
+            if frame_num is not None:
+                chunk = chunk[:frame_num - written]
+            written += chunk.shape[0]
+            result = img_as_ubyte(np.transpose(chunk.data.cpu().numpy(), [0, 2, 3, 1]).astype(np.float32))
+            for frame in result:
+                if original_size:
+                    frame = cv2.resize(frame, out_size)
+                yield frame
+
+    def precision_report(self, x, precisions=('bf16', 'fp16'), num_frames=25):
+        """ PSNR against float32 and render time of the first `num_frames` frames of a facerender batch, per precision. """
+        target_semantics = x['target_semantics_list'][:1, :num_frames].type(torch.FloatTensor).to(self.device)
+        return precision_report(x['source_image'][:1].type(torch.FloatTensor).to(self.device),
+                                x['source_semantics'][:1].type(torch.FloatTensor).to(self.device),
+                                target_semantics, self.renderer, self.kp_extractor, self.mapping, precisions)
+
+    def compile_report(self, x, num_frames=25, render_batch_size=None):
+        """ Per-frame render latency in ms of the eager and the compiled generator on a facerender batch, with their max difference. """
+        source_image = x['source_image'][:1].type(torch.FloatTensor).to(self.device)
+        source_semantics = x['source_semantics'][:1].type(torch.FloatTensor).to(self.device)
+        target_semantics = x['target_semantics_list'][:1, :num_frames].type(torch.FloatTensor).to(self.device)
+        num_frames = target_semantics.shape[1]
+
+        def render(generator):
+            return torch.cat(list(iter_animation(source_image, source_semantics, target_semantics,
+                                                 generator, self.kp_extractor, self.mapping,
+                                                 render_batch_size=render_batch_size)))
+
+        # the first pass pays for the source encoding and the compilation, only the second one is timed
+        render(self.generator)
+        start = time.time()
+        reference = render(self.generator)
+        report = {'eager': {'ms_per_frame': 1000 * (time.time() - start) / num_frames}}
+        if self.renderer is not self.generator:
+            render(self.renderer)
+            start = time.time()
+            frames = render(self.renderer)
+            report[self.renderer.mode] = {'ms_per_frame': 1000 * (time.time() - start) / num_frames,
+                                          'max_abs_diff': (frames - reference).abs().max().item(),
+                                          'compile_time': self.renderer.compile_time}
+        return report
+
+    def generate(self, x, video_save_dir, pic_path, crop_info, enhancer=None, background_enhancer=None, preprocess='crop', img_size=256, render_memory_mb=2048, precision='fp32'):
 
         source_image=x['source_image'].type(torch.FloatTensor)
         source_semantics=x['source_semantics'].type(torch.FloatTensor)
@@ -179,79 +257,67 @@ class AnimateFromCoeff():
             roll_c_seq = None
 
         frame_num = x['frame_num']
+        # decoded samples are piped to ffmpeg, a file is trimmed to the rendered frames by ffmpeg itself
+        if 'audio_pcm' in x:
+            audio = {'audio_pcm': x['audio_pcm']}
+        else:
+            audio = {'audio_path': x['audio_path']}
+        duration = frame_num / 25.
 
-        predictions_video = make_animation(source_image, source_semantics, target_semantics,
-                                        self.generator, self.kp_extractor, self.he_estimator, self.mapping, 
-                                        yaw_c_seq, pitch_c_seq, roll_c_seq, use_exp = True)
-
-        predictions_video = predictions_video.reshape((-1,)+predictions_video.shape[2:])
-        predictions_video = predictions_video[:frame_num]
-
-        video = []
-        for idx in range(predictions_video.shape[0]):
-            image = predictions_video[idx]
-            image = np.transpose(image.data.cpu().numpy(), [1, 2, 0]).astype(np.float32)
-            video.append(image)
-        result = img_as_ubyte(video)
-
-        ### the generated video is 256x256, so we keep the aspect ratio, 
-        original_size = crop_info[0]
-        if original_size:
-            result = [ cv2.resize(result_i,(img_size, int(img_size * original_size[1]/original_size[0]) )) for result_i in result ]
-        
         video_name = x['video_name']  + '.mp4'
-        path = os.path.join(video_save_dir, 'temp_'+video_name)
-        
-        imageio.mimsave(path, result,  fps=float(25))
-
         av_path = os.path.join(video_save_dir, video_name)
         return_path = av_path 
-        
-        audio_path =  x['audio_path'] 
-        audio_name = os.path.splitext(os.path.split(audio_path)[-1])[0]
-        new_audio_path = os.path.join(video_save_dir, audio_name+'.wav')
-        start_time = 0
-        # cog will not keep the .mp3 filename
-        sound = AudioSegment.from_file(audio_path)
-        frames = frame_num 
-        end_time = start_time + frames*1/25*1000
-        word1=sound.set_frame_rate(16000)
-        word = word1[start_time:end_time]
-        word.export(new_audio_path, format="wav")
-
-        save_video_with_watermark(path, new_audio_path, av_path, watermark= False)
-        print(f'The generated video is named {video_save_dir}/{video_name}') 
 
+        sinks = [VideoStreamWriter(av_path, fps=25, duration=duration, **audio)]
+
+        full_img = None
         if 'full' in preprocess.lower():
             # only add watermark to the full image.
             video_name_full = x['video_name']  + '_full.mp4'
             full_video_path = os.path.join(video_save_dir, video_name_full)
-            return_path = full_video_path
-            paste_pic(path, pic_path, crop_info, new_audio_path, full_video_path, extended_crop= True if 'ext' in preprocess.lower() else False)
-            print(f'The generated video is named {video_save_dir}/{video_name_full}') 
-        else:
+            box = get_paste_box(crop_info, extended_crop= True if 'ext' in preprocess.lower() else False)
+            if box is None:
+                print("you didn't crop the image")
+            else:
+                full_img = cv2.cvtColor(load_full_image(pic_path), cv2.COLOR_BGR2RGB)
+                sinks.append(VideoStreamWriter(full_video_path, fps=25, duration=duration, **audio))
+                return_path = full_video_path
+        if full_img is None:
             full_video_path = av_path 
 
+        # frames go from the renderer straight into ffmpeg, chunk by chunk
+        frames = self.iter_frames(source_image, source_semantics, target_semantics, crop_info, img_size,
+                                    yaw_c_seq, pitch_c_seq, roll_c_seq, frame_num=frame_num, render_memory_mb=render_memory_mb,
+                                    precision=precision)
+        try:
+            for frame in frames:
+                sinks[0].write(frame)
+                if full_img is not None:
+                    # seamlessClone works per channel, so it can stay in RGB
+                    sinks[1].write(paste_frame(frame, full_img, box))
+            for sink in sinks:
+                sink.close()
+        except:
+            for sink in sinks:
+                sink.abort()
+            raise
+
+        print(f'The generated video is named {video_save_dir}/{video_name}') 
+        if full_img is not None:
+            print(f'The generated video is named {video_save_dir}/{video_name_full}') 
+
         #### paste back then enhancers
         if enhancer:
             video_name_enhancer = x['video_name']  + '_enhanced.mp4'
-            enhanced_path = os.path.join(video_save_dir, 'temp_'+video_name_enhancer)
             av_path_enhancer = os.path.join(video_save_dir, video_name_enhancer) 
             return_path = av_path_enhancer
 
             try:
-                enhanced_images_gen_with_len = enhancer_generator_with_len(full_video_path, method=enhancer, bg_upsampler=background_enhancer)
-                imageio.mimsave(enhanced_path, enhanced_images_gen_with_len, fps=float(25))
+                with VideoStreamWriter(av_path_enhancer, fps=25, duration=duration, **audio) as sink:
+                    sink.write_batch(enhancer_generator_with_len(full_video_path, method=enhancer, bg_upsampler=background_enhancer))
             except:
-                enhanced_images_gen_with_len = enhancer_list(full_video_path, method=enhancer, bg_upsampler=background_enhancer)
-                imageio.mimsave(enhanced_path, enhanced_images_gen_with_len, fps=float(25))
-            
-            save_video_with_watermark(enhanced_path, new_audio_path, av_path_enhancer, watermark= False)
+                with VideoStreamWriter(av_path_enhancer, fps=25, duration=duration, **audio) as sink:
+                    sink.write_batch(enhancer_list(full_video_path, method=enhancer, bg_upsampler=background_enhancer))
             print(f'The generated video is named {video_save_dir}/{video_name_enhancer}')
-            os.remove(enhanced_path)
-
-        os.remove(path)
-        os.remove(new_audio_path)
 
         return return_path
-
@@ -0,0 +1,195 @@
+import hashlib
+import os
+import threading
+import time
+import uuid
+
+import torch
+from torch import nn
+
+COMPILE_MODES = ('off', 'trace', 'inductor')
+
+# the code a traced decode is made of, a saved module is stale once any of it changes
+_DECODE_SOURCES = ('modules/generator.py', 'modules/dense_motion.py', 'modules/util.py', 'freeze.py', 'compile.py')
+_code_salt = None
+
+
+def checkpoint_fingerprint(paths):
+    """ Cheap identity of the checkpoint files: path, size and mtime, without reading the weights. """
+    h = hashlib.sha1()
+    for path in paths:
+        if path is None:
+            continue
+        stat = os.stat(path)
+        h.update(('%s:%d:%d;' % (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)).encode())
+    return h.hexdigest()
+
+
+def code_salt():
+    """ Hash of the sources the decode is traced from. """
+    global _code_salt
+    if _code_salt is None:
+        h = hashlib.sha1()
+        for name in _DECODE_SOURCES:
+            with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), name), 'rb') as f:
+                h.update(f.read())
+        _code_salt = h.hexdigest()
+    return _code_salt
+
+
+def _autocast_enabled(device_type):
+    try:
+        return torch.is_autocast_enabled(device_type)
+    except TypeError:  # torch < 2.4
+        return torch.is_autocast_cpu_enabled() if device_type == 'cpu' else torch.is_autocast_enabled()
+
+
+class _Decode(nn.Module):
+    """ generator.decode on plain tensors, the form torch.jit.trace and torch.compile take. """
+
+    def __init__(self, generator):
+        super(_Decode, self).__init__()
+        self.generator = generator
+
+    def forward(self, feature_3d, kp_source, kp_driving, gaussian_source):
+        out = self.generator.decode(feature_3d, kp_driving={'value': kp_driving}, kp_source={'value': kp_source},
+                                    gaussian_source=gaussian_source)
+        return out['prediction']
+
+
+class CompiledGenerator():
+    """ The generator with its per-frame decode compiled, a drop-in for it in iter_animation.
+
+    'trace' builds one TorchScript module per input shape, i.e. per (size, batch), and saves it
+    to `cache_dir` under a key made of the checkpoint fingerprint, the model code, the torch
+    version, the device and the shapes, so warm restarts load it instead of tracing again, after
+    checking it like a freshly traced one. 'inductor' goes through torch.compile with its kernel
+    cache under `cache_dir`. The odd sized last chunk of a video gets a module of its own,
+    compiled once like the others, by the first render that needs it while the other shapes
+    keep rendering.
+
+    Anything that fails to compile, or renders differently from the eager generator by more
+    than `atol` (half an 8-bit level of the frames, compiled kernels reorder float sums), falls
+    back to the eager decode for that shape. Reduced precision renders
+    (autocast) always run eagerly.
+    """
+
+    def __init__(self, generator, cache_dir, fingerprint, mode='trace', atol=2e-3):
+        if mode not in COMPILE_MODES:
+            raise ValueError('unknown compile mode: %s' % mode)
+        self.generator = generator
+        self.cache_dir = cache_dir
+        self.fingerprint = fingerprint
+        self.mode = mode
+        self.atol = atol
+        self.compile_time = 0.
+
+        self._decode = _Decode(generator).eval()
+        self._compiled = {}
+        self._compiling = {}        # shape -> Event set once its compile is stored in _compiled
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        if mode == 'inductor':
+            os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', os.path.join(cache_dir, 'inductor'))
+
+    def __getattr__(self, name):
+        # encode_source, source_gaussian and the rest run once per avatar, eagerly
+        if name == 'generator':
+            raise AttributeError(name)
+        return getattr(self.generator, name)
+
+    def key(self, feature_3d, batch_size, device):
+        h = hashlib.sha1()
+        h.update(('%s_%s_%s_%s_%s_%s_%d' % (self.fingerprint, code_salt(), torch.__version__, self.mode,
+                                            torch.device(device).type, tuple(feature_3d.shape[1:]), batch_size)).encode())
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.pt')
+
+    def _max_diff(self, compiled, inputs):
+        with torch.no_grad():
+            return (compiled(*inputs) - self._decode(*inputs)).abs().max().item()
+
+    def _compile(self, inputs):
+        device = inputs[0].device
+        key = self.key(inputs[0], inputs[2].shape[0], device)
+        path = self._path(key)
+        start = time.time()
+        compiled = None
+        if self.mode == 'trace' and os.path.isfile(path):
+            try:
+                compiled = torch.jit.load(path, map_location=device)
+                diff = self._max_diff(compiled, inputs)
+                if diff > self.atol:
+                    compiled = None
+                    print('compiled decode %s differs from the eager one by %g, tracing again' % (key, diff))
+            except Exception as e:
+                compiled = None
+                print('compiled decode %s unreadable, tracing again: %s' % (key, e))
+
+        if compiled is None and self.mode == 'trace':
+            with torch.no_grad():
+                compiled = torch.jit.freeze(torch.jit.trace(self._decode, inputs, check_trace=False))
+            diff = self._max_diff(compiled, inputs)
+            if diff > self.atol:
+                raise RuntimeError('traced decode differs from the eager one by %g' % diff)
+            tmp_path = path + '.' + uuid.uuid4().hex + '.tmp'
+            torch.jit.save(compiled, tmp_path)
+            os.replace(tmp_path, path)
+        elif self.mode == 'inductor':
+            compiled = torch.compile(self._decode, dynamic=False)
+            diff = self._max_diff(compiled, inputs)
+            if diff > self.atol:
+                raise RuntimeError('compiled decode differs from the eager one by %g' % diff)
+
+        print('compiled decode (%s, batch %d) in %.2fs' % (self.mode, inputs[2].shape[0], time.time() - start))
+        return compiled
+
+    def get(self, inputs):
+        """ The compiled decode for these inputs, None when they run eagerly. """
+        shape = tuple(inputs[0].shape[1:]) + (inputs[2].shape[0], inputs[0].device.type)
+        with self._lock:
+            if shape in self._compiled:
+                return self._compiled[shape]
+            done = self._compiling.get(shape)
+            waiting = done is not None
+            if not waiting:
+                done = self._compiling[shape] = threading.Event()
+
+        # the first render of a shape compiles it outside the lock, later ones wait for it
+        if waiting:
+            done.wait()
+            return self._compiled[shape]
+
+        start = time.time()
+        compiled = None
+        try:
+            compiled = self._compile(inputs)
+        except Exception as e:
+            print('compiling the decode failed, running it eagerly: %s' % e)
+        finally:
+            with self._lock:
+                self._compiled[shape] = compiled
+                self.compile_time += time.time() - start
+                del self._compiling[shape]
+            done.set()
+        return compiled
+
+    def decode(self, feature_3d, kp_driving, kp_source, gaussian_source=None):
+        compiled = None
+        if (self.mode != 'off' and gaussian_source is not None and set(kp_driving) == {'value'}
+                and not _autocast_enabled(feature_3d.device.type)):
+            inputs = (feature_3d[:1], kp_source['value'], kp_driving['value'], gaussian_source[:1])
+            compiled = self.get(inputs)
+        if compiled is None:
+            return self.generator.decode(feature_3d, kp_driving=kp_driving, kp_source=kp_source,
+                                         gaussian_source=gaussian_source)
+        return {'prediction': compiled(*inputs)}
+
+    def stats(self):
+        with self._lock:
+            compiled = list(self._compiled.values())
+        return {'mode': self.mode, 'compiled': sum(c is not None for c in compiled),
+                'eager': sum(c is None for c in compiled), 'compile_time': self.compile_time,
+                'cache_dir': self.cache_dir}
@@ -0,0 +1,112 @@
+import copy
+
+import torch
+from torch import nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+from torch.nn.utils.spectral_norm import SpectralNorm
+
+from src.facerender.sync_batchnorm import SynchronizedBatchNorm1d, SynchronizedBatchNorm2d, SynchronizedBatchNorm3d
+from src.facerender.modules.util import ResBottleneck, UpBlock2d, UpBlock3d, DownBlock2d, DownBlock3d, SameBlock2d, Decoder
+from src.facerender.modules.keypoint_detector import HEEstimator
+from src.facerender.modules.dense_motion import DenseMotionNetwork
+
+# (conv, norm) attributes where the norm directly follows the conv in forward()
+_CONV_NORM_PAIRS = {
+    ResBottleneck: [('conv1', 'norm1'), ('conv2', 'norm2'), ('conv3', 'norm3'), ('skip', 'norm4')],
+    UpBlock2d: [('conv', 'norm')],
+    UpBlock3d: [('conv', 'norm')],
+    DownBlock2d: [('conv', 'norm')],
+    DownBlock3d: [('conv', 'norm')],
+    SameBlock2d: [('conv', 'norm')],
+    Decoder: [('conv', 'norm')],
+    HEEstimator: [('conv1', 'norm1'), ('conv2', 'norm2'), ('conv3', 'norm3'), ('conv4', 'norm4'), ('conv5', 'norm5')],
+    DenseMotionNetwork: [('compress', 'norm')],
+}
+
+_PLAIN_NORMS = {
+    SynchronizedBatchNorm1d: nn.BatchNorm1d,
+    SynchronizedBatchNorm2d: nn.BatchNorm2d,
+    SynchronizedBatchNorm3d: nn.BatchNorm3d,
+}
+
+
+def remove_spectral_norms(model):
+    """ Bake the spectral normalized weights into the convs and drop their pre-forward hooks. """
+    count = 0
+    for module in model.modules():
+        if any(isinstance(hook, SpectralNorm) for hook in module._forward_pre_hooks.values()):
+            # the eval weight, without a power iteration
+            nn.utils.remove_spectral_norm(module)
+            count += 1
+    return count
+
+
+def fold_batch_norms(model):
+    """ Fold the eval batch norms that follow a conv into its weight and bias. """
+    count = 0
+    for module in model.modules():
+        for conv_name, norm_name in _CONV_NORM_PAIRS.get(type(module), []):
+            conv, norm = getattr(module, conv_name, None), getattr(module, norm_name, None)
+            if not isinstance(norm, nn.modules.batchnorm._BatchNorm):
+                continue
+            fused = fuse_conv_bn_eval(conv, norm)
+            fused.weight.requires_grad = False
+            fused.bias.requires_grad = False
+            setattr(module, conv_name, fused)
+            setattr(module, norm_name, nn.Identity())
+            count += 1
+    return count
+
+
+def unsync_batch_norms(model):
+    """ Swap the remaining SynchronizedBatchNorms for the plain ones they fall back to in eval mode. """
+    count = 0
+    for parent in list(model.modules()):
+        for name, child in parent.named_children():
+            if type(child) not in _PLAIN_NORMS:
+                continue
+            bn = _PLAIN_NORMS[type(child)](child.num_features, eps=child.eps, momentum=child.momentum, affine=child.affine)
+            bn.load_state_dict(child.state_dict())
+            bn.to(child.running_mean.device).eval().requires_grad_(False)
+            setattr(parent, name, bn)
+            count += 1
+    return count
+
+
+def freeze_for_inference(model):
+    """
+    Rewrite an eval model loaded from a checkpoint into a cheaper equivalent: spectral norms baked
+    into their convs, batch norms folded into the preceding conv and the remaining SyncBNs made
+    plain BNs. The state dict no longer matches the checkpoint's afterwards, load before freezing.
+    """
+    model.eval()
+    stats = {'spectral_norm': remove_spectral_norms(model),
+             'folded_bn': fold_batch_norms(model),
+             'plain_bn': unsync_batch_norms(model)}
+    return stats
+
+
+def _max_abs_diff(a, b):
+    if isinstance(a, dict):
+        return max((_max_abs_diff(a[k], b[k]) for k in a), default=0.)
+    if isinstance(a, (list, tuple)):
+        return max((_max_abs_diff(x, y) for x, y in zip(a, b)), default=0.)
+    if torch.is_tensor(a):
+        return (a.float() - b.float()).abs().max().item()
+    return 0.
+
+
+def freeze_checked(model, run, atol=1e-3):
+    """
+    freeze_for_inference, compared against a copy of the unfrozen model: `run(model)` computes the
+    outputs of both and a difference above `atol` raises, leaving `model` frozen either way.
+    """
+    reference = copy.deepcopy(model).eval()
+    stats = freeze_for_inference(model)
+    with torch.no_grad():
+        diff = _max_abs_diff(run(reference), run(model))
+    del reference
+    if diff > atol:
+        raise RuntimeError('frozen %s differs from the checkpoint model by %g' % (type(model).__name__, diff))
+    stats['max_abs_diff'] = diff
+    return stats
@@ -1,7 +1,7 @@
 from torch import nn
 import torch.nn.functional as F
 import torch
-from src.facerender.modules.util import Hourglass, make_coordinate_grid, kp2gaussian
+from src.facerender.modules.util import Hourglass, get_coordinate_grid, kp2gaussian, full_precision, grid_sample_fp32
 
 from src.facerender.sync_batchnorm import SynchronizedBatchNorm3d as BatchNorm3d
 
@@ -32,24 +32,25 @@ class DenseMotionNetwork(nn.Module):
 
 
     def create_sparse_motions(self, feature, kp_driving, kp_source):
-        bs, _, d, h, w = feature.shape
-        identity_grid = make_coordinate_grid((d, h, w), type=kp_source['value'].type())
+        _, _, d, h, w = feature.shape
+        bs = kp_driving['value'].shape[0]
+        identity_grid = get_coordinate_grid((d, h, w), kp_source['value'].dtype, kp_source['value'].device)
         identity_grid = identity_grid.view(1, 1, d, h, w, 3)
         coordinate_grid = identity_grid - kp_driving['value'].view(bs, self.num_kp, 1, 1, 1, 3)
         
         # if 'jacobian' in kp_driving:
         if 'jacobian' in kp_driving and kp_driving['jacobian'] is not None:
-            jacobian = torch.matmul(kp_source['jacobian'], torch.inverse(kp_driving['jacobian']))
-            jacobian = jacobian.unsqueeze(-3).unsqueeze(-3).unsqueeze(-3)
-            jacobian = jacobian.repeat(1, 1, d, h, w, 1, 1)
-            coordinate_grid = torch.matmul(jacobian, coordinate_grid.unsqueeze(-1))
-            coordinate_grid = coordinate_grid.squeeze(-1)                  
+            with full_precision(coordinate_grid):
+                jacobian = torch.matmul(kp_source['jacobian'].float(), torch.inverse(kp_driving['jacobian'].float()))
+                jacobian = jacobian.unsqueeze(-3).unsqueeze(-3).unsqueeze(-3)      # broadcast over d, h, w by matmul
+                coordinate_grid = torch.matmul(jacobian, coordinate_grid.unsqueeze(-1))
+                coordinate_grid = coordinate_grid.squeeze(-1)                  
 
 
         driving_to_source = coordinate_grid + kp_source['value'].view(bs, self.num_kp, 1, 1, 1, 3)    # (bs, num_kp, d, h, w, 3)
 
         #adding background feature
-        identity_grid = identity_grid.repeat(bs, 1, 1, 1, 1, 1)
+        identity_grid = identity_grid.expand(bs, 1, d, h, w, 3)
         sparse_motions = torch.cat([identity_grid, driving_to_source], dim=1)                #bs num_kp+1 d h w 3
         
         # sparse_motions = driving_to_source
@@ -57,19 +58,29 @@ class DenseMotionNetwork(nn.Module):
         return sparse_motions
 
     def create_deformed_feature(self, feature, sparse_motions):
-        bs, _, d, h, w = feature.shape
-        feature_repeat = feature.unsqueeze(1).unsqueeze(1).repeat(1, self.num_kp+1, 1, 1, 1, 1, 1)      # (bs, num_kp+1, 1, c, d, h, w)
-        feature_repeat = feature_repeat.view(bs * (self.num_kp+1), -1, d, h, w)                         # (bs*(num_kp+1), c, d, h, w)
-        sparse_motions = sparse_motions.view((bs * (self.num_kp+1), d, h, w, -1))                       # (bs*(num_kp+1), d, h, w, 3) !!!!
-        sparse_deformed = F.grid_sample(feature_repeat, sparse_motions)
-        sparse_deformed = sparse_deformed.view((bs, self.num_kp+1, -1, d, h, w))                        # (bs, num_kp+1, c, d, h, w)
-        return sparse_deformed
-
-    def create_heatmap_representations(self, feature, kp_driving, kp_source):
+        """
+        Sample the feature volume at the sparse motions of every keypoint. grid_sample treats every
+        grid point on its own, so the num_kp+1 motions (and the frames, when a single source feature
+        is shared by the batch) are stacked along the grid depth instead of copying the feature
+        volume once per keypoint and frame. The result is a (bs, num_kp+1, c, d, h, w) view.
+        """
+        n, c, d, h, w = feature.shape
+        bs = sparse_motions.shape[0]
+        grid = sparse_motions.reshape(n, -1, h, w, 3)                                   # (n, bs/n*(num_kp+1)*d, h, w, 3)
+        sparse_deformed = grid_sample_fp32(feature, grid)                               # (n, c, bs/n*(num_kp+1)*d, h, w)
+        sparse_deformed = sparse_deformed.view(n, c, bs // n, self.num_kp+1, d, h, w)
+        return sparse_deformed.permute(0, 2, 3, 1, 4, 5, 6).flatten(0, 1)             # (bs, num_kp+1, c, d, h, w)
+
+    def source_gaussian(self, kp_source, spatial_size):
+        """ The gaussians of the source keypoints, the same for every driving frame """
+        return kp2gaussian(kp_source, spatial_size=spatial_size, kp_variance=0.01)
+
+    def create_heatmap_representations(self, feature, kp_driving, kp_source, gaussian_source=None):
         spatial_size = feature.shape[3:]
         gaussian_driving = kp2gaussian(kp_driving, spatial_size=spatial_size, kp_variance=0.01)
-        gaussian_source = kp2gaussian(kp_source, spatial_size=spatial_size, kp_variance=0.01)
-        heatmap = gaussian_driving - gaussian_source
+        if gaussian_source is None:
+            gaussian_source = self.source_gaussian(kp_source, spatial_size)
+        heatmap = gaussian_driving - gaussian_source      # a single source broadcasts to the batch
 
         # adding background feature
         zeros = torch.zeros(heatmap.shape[0], 1, spatial_size[0], spatial_size[1], spatial_size[2]).type(heatmap.type())
@@ -77,21 +88,25 @@ class DenseMotionNetwork(nn.Module):
         heatmap = heatmap.unsqueeze(2)         # (bs, num_kp+1, 1, d, h, w)
         return heatmap
 
-    def forward(self, feature, kp_driving, kp_source):
-        bs, _, d, h, w = feature.shape
+    def forward(self, feature, kp_driving, kp_source, gaussian_source=None):
+        _, _, d, h, w = feature.shape
+        bs = kp_driving['value'].shape[0]
 
         feature = self.compress(feature)
         feature = self.norm(feature)
         feature = F.relu(feature)
+        # a single encoded source shared by every driving frame is sampled as is, without expanding it
 
         out_dict = dict()
         sparse_motion = self.create_sparse_motions(feature, kp_driving, kp_source)
         deformed_feature = self.create_deformed_feature(feature, sparse_motion)
 
-        heatmap = self.create_heatmap_representations(deformed_feature, kp_driving, kp_source)
+        heatmap = self.create_heatmap_representations(deformed_feature, kp_driving, kp_source, gaussian_source)
 
         input_ = torch.cat([heatmap, deformed_feature], dim=2)
         input_ = input_.view(bs, -1, d, h, w)
+        # only input_ is needed from here, the hourglass activations are the peak of the render
+        del heatmap, deformed_feature
 
         # input = deformed_feature.view(bs, -1, d, h, w)      # (bs, num_kp+1 * c, d, h, w)
 
@@ -99,7 +114,7 @@ class DenseMotionNetwork(nn.Module):
 
 
         mask = self.mask(prediction)
-        mask = F.softmax(mask, dim=1)
+        mask = F.softmax(mask.float(), dim=1)      # float32, it weighs the sampling coordinates
         out_dict['mask'] = mask
         mask = mask.unsqueeze(2)                                   # (bs, num_kp+1, 1, d, h, w)
         
@@ -1,7 +1,7 @@
 import torch
 from torch import nn
 import torch.nn.functional as F
-from src.facerender.modules.util import ResBlock2d, SameBlock2d, UpBlock2d, DownBlock2d, ResBlock3d, SPADEResnetBlock
+from src.facerender.modules.util import ResBlock2d, SameBlock2d, UpBlock2d, DownBlock2d, ResBlock3d, SPADEResnetBlock, full_precision, grid_sample_fp32
 from src.facerender.modules.dense_motion import DenseMotionNetwork
 
 
@@ -203,12 +203,15 @@ class OcclusionAwareSPADEGenerator(nn.Module):
         _, _, d, h, w = inp.shape
         if d_old != d or h_old != h or w_old != w:
             deformation = deformation.permute(0, 4, 1, 2, 3)
-            deformation = F.interpolate(deformation, size=(d, h, w), mode='trilinear')
+            with full_precision(deformation):
+                deformation = F.interpolate(deformation.float(), size=(d, h, w), mode='trilinear')
             deformation = deformation.permute(0, 2, 3, 4, 1)
-        return F.grid_sample(inp, deformation)
+        return grid_sample_fp32(inp, deformation)
 
-    def forward(self, source_image, kp_driving, kp_source):
-        # Encoding (downsampling) part
+    def encode_source(self, source_image):
+        """
+        Encoding (downsampling) part, it only depends on the source image and can be reused for every frame
+        """
         out = self.first(source_image)
         for i in range(len(self.down_blocks)):
             out = self.down_blocks[i](out)
@@ -217,12 +220,34 @@ class OcclusionAwareSPADEGenerator(nn.Module):
         # print(out.shape)
         feature_3d = out.view(bs, self.reshape_channel, self.reshape_depth, h ,w) 
         feature_3d = self.resblocks_3d(feature_3d)
+        return feature_3d
+
+    def forward(self, source_image, kp_driving, kp_source):
+        feature_3d = self.encode_source(source_image)
+        return self.decode(feature_3d, kp_driving, kp_source)
+
+    def source_gaussian(self, feature_3d, kp_source):
+        """
+        The dense motion heatmap of the source keypoints, it only depends on the source and can be
+        passed to decode() for every frame
+        """
+        if self.dense_motion_network is None:
+            return None
+        return self.dense_motion_network.source_gaussian(kp_source, feature_3d.shape[2:])
+
+    def decode(self, feature_3d, kp_driving, kp_source, gaussian_source=None):
+        """
+        Per-frame part: dense motion, warping and SPADE decoding. feature_3d may hold a single
+        encoded source, it is broadcast to the batch of driving keypoints, as is gaussian_source.
+        """
+        bs = kp_driving['value'].shape[0]
+        out = feature_3d
 
         # Transforming feature representation according to deformation and occlusion
         output_dict = {}
         if self.dense_motion_network is not None:
             dense_motion = self.dense_motion_network(feature=feature_3d, kp_driving=kp_driving,
-                                                     kp_source=kp_source)
+                                                     kp_source=kp_source, gaussian_source=gaussian_source)
             output_dict['mask'] = dense_motion['mask']
 
             # import pdb; pdb.set_trace()
@@ -233,6 +258,8 @@ class OcclusionAwareSPADEGenerator(nn.Module):
             else:
                 occlusion_map = None
             deformation = dense_motion['deformation']
+            if feature_3d.shape[0] != bs:
+                feature_3d = feature_3d.expand(bs, *feature_3d.shape[1:])
             out = self.deform_input(feature_3d, deformation)
 
             bs, c, d, h, w = out.shape
@@ -3,7 +3,7 @@ import torch
 import torch.nn.functional as F
 
 from src.facerender.sync_batchnorm import SynchronizedBatchNorm2d as BatchNorm2d
-from src.facerender.modules.util import KPHourglass, make_coordinate_grid, AntiAliasInterpolation2d, ResBottleneck
+from src.facerender.modules.util import KPHourglass, get_coordinate_grid, AntiAliasInterpolation2d, ResBottleneck
 
 
 class KPDetector(nn.Module):
@@ -46,9 +46,9 @@ class KPDetector(nn.Module):
         Extract the mean from a heatmap
         """
         shape = heatmap.shape
-        heatmap = heatmap.unsqueeze(-1)
-        grid = make_coordinate_grid(shape[2:], heatmap.type()).unsqueeze_(0).unsqueeze_(0)
-        value = (heatmap * grid).sum(dim=(2, 3, 4))
+        grid = get_coordinate_grid(shape[2:], heatmap.dtype, heatmap.device)
+        # the heatmap weighted sum of the grid points as one (bs, kp, dhw) x (dhw, 3) product
+        value = torch.matmul(heatmap.reshape(shape[0], shape[1], -1), grid.view(-1, 3))
         kp = {'value': value}
 
         return kp
@@ -1,3 +1,5 @@
+import contextlib
+
 from torch import nn
 
 import torch.nn.functional as F
@@ -12,25 +14,38 @@ import torch.nn.utils.spectral_norm as spectral_norm
 def kp2gaussian(kp, spatial_size, kp_variance):
     """
     Transform a keypoint into gaussian like representation
+
+    The isotropic gaussian is separable over the grid axes, so it is the outer product of three
+    1D gaussians: neither the grid per keypoint nor the offsets to every grid point are built.
     """
-    mean = kp['value']
+    mean = kp['value']                                                        # (..., 3)
+    grid = get_coordinate_grid(spatial_size, mean.dtype, mean.device)
+    z, y, x = grid[:, 0, 0, 2], grid[0, :, 0, 1], grid[0, 0, :, 0]
+
+    def axis_gaussian(axis, coord):
+        return torch.exp(-0.5 * (axis - mean[..., coord:coord + 1]) ** 2 / kp_variance)   # (..., n)
 
-    coordinate_grid = make_coordinate_grid(spatial_size, mean.type())
-    number_of_leading_dimensions = len(mean.shape) - 1
-    shape = (1,) * number_of_leading_dimensions + coordinate_grid.shape
-    coordinate_grid = coordinate_grid.view(*shape)
-    repeats = mean.shape[:number_of_leading_dimensions] + (1, 1, 1, 1)
-    coordinate_grid = coordinate_grid.repeat(*repeats)
+    gz, gy, gx = axis_gaussian(z, 2), axis_gaussian(y, 1), axis_gaussian(x, 0)
+    return gz[..., :, None, None] * gy[..., None, :, None] * gx[..., None, None, :]
 
-    # Preprocess kp shape
-    shape = mean.shape[:number_of_leading_dimensions] + (1, 1, 1, 3)
-    mean = mean.view(*shape)
+def full_precision(tensor):
+    """
+    Autocast switched off on the device of `tensor`, around the numerically sensitive steps of a
+    reduced precision render
+    """
+    if tensor.device.type not in ('cuda', 'cpu'):
+        return contextlib.nullcontext()
+    return torch.autocast(tensor.device.type, enabled=False)
 
-    mean_sub = (coordinate_grid - mean)
 
-    out = torch.exp(-0.5 * (mean_sub ** 2).sum(-1) / kp_variance)
+def grid_sample_fp32(inp, grid):
+    """
+    F.grid_sample in float32: with reduced precision coordinates the samples drift to the
+    neighbouring voxels
+    """
+    with full_precision(inp):
+        return F.grid_sample(inp.float(), grid.float())
 
-    return out
 
 def make_coordinate_grid_2d(spatial_size, type):
     """
@@ -70,6 +85,21 @@ def make_coordinate_grid(spatial_size, type):
     return meshed
 
 
+_coordinate_grids = {}
+
+def get_coordinate_grid(spatial_size, dtype, device):
+    """
+    make_coordinate_grid, built once per (spatial_size, dtype, device). The grid is shared by
+    every caller and must not be modified in place.
+    """
+    key = (tuple(spatial_size), dtype, device)
+    grid = _coordinate_grids.get(key)
+    if grid is None:
+        grid = make_coordinate_grid(key[0], 'torch.FloatTensor').to(device=device, dtype=dtype)
+        _coordinate_grids[key] = grid
+    return grid
+
+
 class ResBottleneck(nn.Module):
     def __init__(self, in_features, stride):
         super(ResBottleneck, self).__init__()
@@ -431,7 +461,10 @@ class SPADE(nn.Module):
         self.mlp_beta = nn.Conv2d(nhidden, norm_nc, kernel_size=3, padding=1)
 
     def forward(self, x, segmap):
-        normalized = self.param_free_norm(x)
+        # float32 statistics, as CUDA autocast does: in bfloat16 the cancellation against the mean
+        # costs most of the mantissa
+        with full_precision(x):
+            normalized = self.param_free_norm(x.float())
         segmap = F.interpolate(segmap, size=x.size()[2:], mode='nearest')
         actv = self.mlp_shared(segmap)
         gamma = self.mlp_gamma(actv)
@@ -1,6 +1,5 @@
 import os
 
-from tqdm import tqdm
 import torch
 import numpy as np
 import random
@@ -48,40 +47,105 @@ def generate_blink_seq_randomly(num_frames):
             break
     return ratio
 
-def get_data(first_coeff_path, audio_path, device, ref_eyeblink_coeff_path, still=False, idlemode=False, length_of_audio=False, use_blink=True):
+def get_mel_window_indices(num_mel_frames, num_frames, fps=25, syncnet_mel_step_size=16):
+    """ Clamped mel frame indices of every video frame's window, as one (T, 16) array. """
+    start_frame_num = np.arange(num_frames) - 2
+    start_idx = np.trunc(80. * (start_frame_num / float(fps))).astype(np.int64)
+    seq = start_idx[:, None] + np.arange(syncnet_mel_step_size)[None, :]
+    return np.clip(seq, 0, num_mel_frames - 1)
+
+def get_mel_windows(orig_mel, num_frames, fps=25, syncnet_mel_step_size=16, out=None):
+    """
+    Gather the (T, 80, 16) mel windows of all video frames with a single fancy index.
+    The result is written straight into `out` (e.g. a preallocated float32 tensor's numpy view) when given.
+    """
+    seq = get_mel_window_indices(orig_mel.shape[0], num_frames, fps, syncnet_mel_step_size)
+    spec = np.ascontiguousarray(orig_mel.T, dtype=np.float32)          # 80 nframes
+    if out is None:
+        out = np.empty((num_frames, spec.shape[0], syncnet_mel_step_size), dtype=np.float32)
+    np.take(spec, seq, axis=1, out=out.transpose(1, 0, 2))
+    return out
+
+class MelWindowStream():
+    """
+    get_data's mel windows of audio that is still arriving. PCM chunks go in, and the (N, 80, 16)
+    windows of the next video frames come out as soon as the mel frames they cover are final, so
+    audio2exp can start on the first frames before the utterance is fully synthesized. Only whole
+    video frames of audio are analysed, as crop_pad_audio would crop the rest, and finish() emits
+    the windows clamped at the end: all windows put together match get_data on the whole audio.
+    """
+
+    def __init__(self, sr=16000, fps=25, syncnet_mel_step_size=16):
+        self.fps = fps
+        self.samples_per_frame = int(sr / fps)
+        self.step_size = syncnet_mel_step_size
+        self.mel = audio.StreamingMelSpectrogram()
+        self.pending = np.zeros(0, dtype=np.float32)
+        self.spec = np.zeros((0, 80), dtype=np.float32)    # nframes 80, so far
+        self.audio_frames = 0                               # video frames of audio analysed
+        self.num_frames = 0                                 # video frames emitted
+
+    def _append(self, mel):
+        self.spec = np.concatenate([self.spec, mel.T.astype(np.float32)])
+
+    def _windows(self, num_frames, num_mel_frames):
+        seq = get_mel_window_indices(num_mel_frames, num_frames, self.fps, self.step_size)[self.num_frames:]
+        self.num_frames = num_frames
+        return np.ascontiguousarray(np.take(self.spec.T, seq, axis=1).transpose(1, 0, 2))
+
+    def push(self, chunk):
+        """ Add float or int16 samples at `sr`, returns the windows of the video frames now ready """
+        chunk = np.asarray(chunk)
+        if np.issubdtype(chunk.dtype, np.integer):
+            chunk = chunk / 32768.
+        self.pending = np.concatenate([self.pending, chunk])
+        whole = len(self.pending) // self.samples_per_frame
+        if whole:
+            self._append(self.mel.push(self.pending[:whole * self.samples_per_frame]))
+            self.pending = self.pending[whole * self.samples_per_frame:]
+            self.audio_frames += whole
+
+        # the last mel frame of a window, while it is not clamped to the end of the audio
+        frame = np.arange(self.num_frames, self.audio_frames)
+        last = np.trunc(80. * ((frame - 2) / float(self.fps))).astype(np.int64) + self.step_size - 1
+        ready = self.num_frames + int(np.count_nonzero(last < len(self.spec)))
+        return self._windows(ready, len(self.spec))
+
+    def finish(self):
+        """ The windows of the remaining video frames, the partial frame of audio at the end is dropped """
+        self._append(self.mel.finish())
+        return self._windows(self.audio_frames, len(self.spec))
+
+def get_data(first_coeff_path, audio_path, device, ref_eyeblink_coeff_path, still=False, idlemode=False, length_of_audio=False, use_blink=True, context=None):
+    """ With a PipelineContext the source coefficients and the audio come from it instead of first_coeff_path and audio_path. """
 
     syncnet_mel_step_size = 16
     fps = 25
 
-    pic_name = os.path.splitext(os.path.split(first_coeff_path)[-1])[0]
-    audio_name = os.path.splitext(os.path.split(audio_path)[-1])[0]
+    if context is not None:
+        pic_name, audio_name = context.pic_name, context.audio_name
+    else:
+        pic_name = os.path.splitext(os.path.split(first_coeff_path)[-1])[0]
+        audio_name = os.path.splitext(os.path.split(audio_path)[-1])[0]
 
     
     if idlemode:
         num_frames = int(length_of_audio * 25)
-        indiv_mels = np.zeros((num_frames, 80, 16))
+        indiv_mels = torch.zeros((num_frames, 80, 16))
     else:
-        wav = audio.load_wav(audio_path, 16000) 
+        wav = context.load_wav(16000) if context is not None else audio.load_wav(audio_path, 16000) 
         wav_length, num_frames = parse_audio_length(len(wav), 16000, 25)
         wav = crop_pad_audio(wav, wav_length)
-        orig_mel = audio.melspectrogram(wav).T
-        spec = orig_mel.copy()         # nframes 80
-        indiv_mels = []
-
-        for i in tqdm(range(num_frames), 'mel:'):
-            start_frame_num = i-2
-            start_idx = int(80. * (start_frame_num / float(fps)))
-            end_idx = start_idx + syncnet_mel_step_size
-            seq = list(range(start_idx, end_idx))
-            seq = [ min(max(item, 0), orig_mel.shape[0]-1) for item in seq ]
-            m = spec[seq, :]
-            indiv_mels.append(m.T)
-        indiv_mels = np.asarray(indiv_mels)         # T 80 16
+        orig_mel = audio.melspectrogram(wav).T       # nframes 80
+        indiv_mels = torch.empty((num_frames, orig_mel.shape[1], syncnet_mel_step_size), dtype=torch.float32)
+        get_mel_windows(orig_mel, num_frames, fps, syncnet_mel_step_size, out=indiv_mels.numpy())         # T 80 16
 
     ratio = generate_blink_seq_randomly(num_frames)      # T
-    source_semantics_path = first_coeff_path
-    source_semantics_dict = scio.loadmat(source_semantics_path)
-    ref_coeff = source_semantics_dict['coeff_3dmm'][:1,:70]         #1 70
+    if context is not None:
+        ref_coeff = context.source['coeff_3dmm'][:1,:70]                #1 70
+    else:
+        source_semantics_dict = scio.loadmat(first_coeff_path)
+        ref_coeff = source_semantics_dict['coeff_3dmm'][:1,:70]         #1 70
     ref_coeff = np.repeat(ref_coeff, num_frames, axis=0)
 
     if ref_eyeblink_coeff_path is not None:
@@ -99,7 +163,7 @@ def get_data(first_coeff_path, audio_path, device, ref_eyeblink_coeff_path, stil
 
         ref_coeff[:, :64] = refeyeblink_coeff[:num_frames, :64] 
     
-    indiv_mels = torch.FloatTensor(indiv_mels).unsqueeze(1).unsqueeze(0) # bs T 1 80 16
+    indiv_mels = indiv_mels.unsqueeze(1).unsqueeze(0) # bs T 1 80 16
 
     if use_blink:
         ratio = torch.FloatTensor(ratio).unsqueeze(0)                       # bs T
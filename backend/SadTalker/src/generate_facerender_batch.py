@@ -7,71 +7,48 @@ import scipy.io as scio
 
 def get_facerender_data(coeff_path, pic_path, first_coeff_path, audio_path, 
                         batch_size, input_yaw_list=None, input_pitch_list=None, input_roll_list=None, 
-                        expression_scale=1.0, still_mode = False, preprocess='crop', size = 256):
+                        expression_scale=1.0, still_mode = False, preprocess='crop', size = 256, dump_txt=False, context=None):
+    """ With a PipelineContext the source and the target coefficients come from it instead of the files. """
 
     semantic_radius = 13
-    video_name = os.path.splitext(os.path.split(coeff_path)[-1])[0]
-    txt_path = os.path.splitext(coeff_path)[0]
+    if context is not None:
+        video_name = context.video_name
+        txt_path = os.path.join(context.save_dir, video_name) if context.save_dir is not None else None
+        dump_txt = dump_txt and txt_path is not None
+    else:
+        video_name = os.path.splitext(os.path.split(coeff_path)[-1])[0]
+        txt_path = os.path.splitext(coeff_path)[0]
 
     data={}
 
-    img1 = Image.open(pic_path)
-    source_image = np.array(img1)
-    source_image = img_as_float32(source_image)
-    source_image = transform.resize(source_image, (size, size, 3))
-    source_image = source_image.transpose((2, 0, 1))
-    source_image_ts = torch.FloatTensor(source_image).unsqueeze(0)
-    source_image_ts = source_image_ts.repeat(batch_size, 1, 1, 1)
-    data['source_image'] = source_image_ts
- 
-    source_semantics_dict = scio.loadmat(first_coeff_path)
-    generated_dict = scio.loadmat(coeff_path)
-
-    if 'full' not in preprocess.lower():
-        source_semantics = source_semantics_dict['coeff_3dmm'][:1,:70]         #1 70
-        generated_3dmm = generated_dict['coeff_3dmm'][:,:70]
-
+    if context is not None:
+        source = source_data(context.source['image'], context.source['coeff_3dmm'], preprocess, size, semantic_radius)
     else:
-        source_semantics = source_semantics_dict['coeff_3dmm'][:1,:73]         #1 70
-        generated_3dmm = generated_dict['coeff_3dmm'][:,:70]
-
-    source_semantics_new = transform_semantic_1(source_semantics, semantic_radius)
-    source_semantics_ts = torch.FloatTensor(source_semantics_new).unsqueeze(0)
-    source_semantics_ts = source_semantics_ts.repeat(batch_size, 1, 1)
-    data['source_semantics'] = source_semantics_ts
+        source = get_source_data(pic_path, first_coeff_path, preprocess, size, semantic_radius)
+    data['source_image'] = source['source_image'].repeat(batch_size, 1, 1, 1)
+    data['source_semantics'] = source['source_semantics'].repeat(batch_size, 1, 1)
+    source_semantics = source['coeff']
 
     # target 
-    generated_3dmm[:, :64] = generated_3dmm[:, :64] * expression_scale
+    generated_3dmm = context.coeffs if context is not None else scio.loadmat(coeff_path)['coeff_3dmm']
+    generated_3dmm = transform_target_coeffs(generated_3dmm[:,:70], source_semantics, expression_scale, still_mode, preprocess)
 
-    if 'full' in preprocess.lower():
-        generated_3dmm = np.concatenate([generated_3dmm, np.repeat(source_semantics[:,70:], generated_3dmm.shape[0], axis=0)], axis=1)
+    if dump_txt:
+        # debug dump of the coefficients
+        np.savetxt(txt_path+'.txt', generated_3dmm, fmt='%.5g', delimiter='  \t')
 
-    if still_mode:
-        generated_3dmm[:, 64:] = np.repeat(source_semantics[:, 64:], generated_3dmm.shape[0], axis=0)
-
-    with open(txt_path+'.txt', 'w') as f:
-        for coeff in generated_3dmm:
-            for i in coeff:
-                f.write(str(i)[:7]   + '  '+'\t')
-            f.write('\n')
-
-    target_semantics_list = [] 
     frame_num = generated_3dmm.shape[0]
     data['frame_num'] = frame_num
-    for frame_idx in range(frame_num):
-        target_semantics = transform_semantic_target(generated_3dmm, frame_idx, semantic_radius)
-        target_semantics_list.append(target_semantics)
-
-    remainder = frame_num%batch_size
-    if remainder!=0:
-        for _ in range(batch_size-remainder):
-            target_semantics_list.append(target_semantics)
-
-    target_semantics_np = np.array(target_semantics_list)             #frame_num 70 semantic_radius*2+1
+    # the last window repeated up to a multiple of batch_size
+    num_windows = -(-frame_num // batch_size) * batch_size
+    target_semantics_np = get_semantic_windows(generated_3dmm, semantic_radius, num_windows)  #frame_num 70 semantic_radius*2+1
     target_semantics_np = target_semantics_np.reshape(batch_size, -1, target_semantics_np.shape[-2], target_semantics_np.shape[-1])
     data['target_semantics_list'] = torch.FloatTensor(target_semantics_np)
     data['video_name'] = video_name
     data['audio_path'] = audio_path
+    if context is not None:
+        # the decoded audio goes to the muxer as is
+        data['audio_pcm'] = context.pcm(frame_num)
     
     if input_yaw_list is not None:
         yaw_c_seq = gen_camera_pose(input_yaw_list, frame_num, batch_size)
@@ -85,17 +62,59 @@ def get_facerender_data(coeff_path, pic_path, first_coeff_path, audio_path,
  
     return data
 
+def get_source_data(pic_path, first_coeff_path, preprocess='crop', size=256, semantic_radius=13):
+    """ The cropped source image and its semantics, each with a batch dimension of 1. """
+    img1 = Image.open(pic_path)
+    source_semantics_dict = scio.loadmat(first_coeff_path)
+    return source_data(np.array(img1), source_semantics_dict['coeff_3dmm'], preprocess, size, semantic_radius)
+
+def source_data(image, coeff_3dmm, preprocess='crop', size=256, semantic_radius=13):
+    """ get_source_data from the cropped uint8 RGB image and the 3DMM coefficients in memory. """
+    source_image = img_as_float32(image)
+    source_image = transform.resize(source_image, (size, size, 3))
+    source_image = source_image.transpose((2, 0, 1))
+    source_image_ts = torch.FloatTensor(source_image).unsqueeze(0)
+
+    if 'full' not in preprocess.lower():
+        source_semantics = coeff_3dmm[:1,:70]         #1 70
+    else:
+        source_semantics = coeff_3dmm[:1,:73]         #1 73
+
+    source_semantics_new = transform_semantic_1(source_semantics, semantic_radius)
+    source_semantics_ts = torch.FloatTensor(source_semantics_new).unsqueeze(0)
+    return {'source_image': source_image_ts, 'source_semantics': source_semantics_ts, 'coeff': source_semantics}
+
+def transform_target_coeffs(generated_3dmm, source_semantics, expression_scale=1.0, still_mode=False, preprocess='crop'):
+    """ Expression scaling, crop params for 'full' and the still-mode pose, on T x 70 coefficients. """
+    generated_3dmm = generated_3dmm.copy()
+    generated_3dmm[:, :64] = generated_3dmm[:, :64] * expression_scale
+
+    if 'full' in preprocess.lower():
+        generated_3dmm = np.concatenate([generated_3dmm, np.repeat(source_semantics[:,70:], generated_3dmm.shape[0], axis=0)], axis=1)
+
+    if still_mode:
+        generated_3dmm[:, 64:] = np.repeat(source_semantics[:, 64:], generated_3dmm.shape[0], axis=0)
+    return generated_3dmm
+
 def transform_semantic_1(semantic, semantic_radius):
     semantic_list =  [semantic for i in range(0, semantic_radius*2+1)]
     coeff_3dmm = np.concatenate(semantic_list, 0)
     return coeff_3dmm.transpose(1,0)
 
-def transform_semantic_target(coeff_3dmm, frame_index, semantic_radius):
+def get_semantic_windows(coeff_3dmm, semantic_radius, num_windows=None, mode='edge'):
+    """
+    The coefficients of frames i-radius..i+radius, clamped to the sequence, of every frame i as one
+    (num_windows, C, 2*radius+1) array: a strided view over the edge padded coefficients, copied once.
+    Windows past the last frame repeat the last one, 'wrap' mode wraps around the sequence instead of
+    clamping.
+    """
     num_frames = coeff_3dmm.shape[0]
-    seq = list(range(frame_index- semantic_radius, frame_index + semantic_radius+1))
-    index = [ min(max(item, 0), num_frames-1) for item in seq ] 
-    coeff_3dmm_g = coeff_3dmm[index, :]
-    return coeff_3dmm_g.transpose(1,0)
+    padded = np.pad(coeff_3dmm, ((semantic_radius, semantic_radius), (0, 0)), mode=mode)
+    windows = np.lib.stride_tricks.sliding_window_view(padded, 2 * semantic_radius + 1, axis=0)   # T C 2r+1
+    if num_windows is not None and num_windows > num_frames:
+        index = np.minimum(np.arange(num_windows), num_frames - 1)
+        return windows[index]
+    return np.ascontiguousarray(windows)
 
 def gen_camera_pose(camera_degree_list, frame_num, batch_size):
 
@@ -0,0 +1,108 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+from src.generate_facerender_batch import transform_target_coeffs, get_semantic_windows
+from src.test_audio2coeff import smooth_pose
+
+
+class CoeffStream():
+    """
+    Audio2Coeff evaluated incrementally, one Audio2Pose window at a time.
+
+    Frames are only computed once a caller asks for them, yet they match a full
+    Audio2Coeff.generate run over the same audio (the pose given the same seed): pose windows
+    are independent of each other, Audio2Exp is per frame and the savgol smoothing is
+    evaluated with enough context on both sides.
+    """
+
+    smooth_window = 13
+
+    def __init__(self, audio_to_coeff, batch, pose_style=0, seed=None):
+        self.audio2exp_model = audio_to_coeff.audio2exp_model
+        self.audio2pose_model = audio_to_coeff.audio2pose_model
+        self.batch = batch
+        self.batch['class'] = torch.LongTensor([pose_style]).to(audio_to_coeff.device)
+        self.seed = seed
+
+        self.num_frames = int(batch['num_frames'])
+        self.window_starts = self.audio2pose_model.window_starts(self.num_frames)
+        self.ref_pose = batch['ref'][0, 0, -6:].cpu().numpy()
+        self.exp = np.zeros((self.num_frames, 64), dtype=np.float32)
+        self.pose = np.repeat(self.ref_pose[None], self.num_frames, axis=0)     # the ref frame has no motion
+        self.ready = 0
+        self.next_window = 0
+
+    def _compute_next(self):
+        end = self.num_frames
+        with torch.no_grad():
+            if self.next_window < len(self.window_starts):
+                window = self.audio2pose_model.predict_windows(self.batch, self.next_window, self.next_window + 1, self.seed)
+                motion = window['pose_motion_pred'][0, 0].cpu().numpy()   # seq_len 6
+                start = 1 + self.window_starts[self.next_window]
+                end = min(start + self.audio2pose_model.seq_len, self.num_frames)
+                # the tail window overlaps the previous one, only its last frames are new
+                begin = max(start, self.ready, 1)
+                self.pose[begin:end] = self.ref_pose + motion[len(motion) - (end - begin):]
+                self.next_window += 1
+
+            exp = self.audio2exp_model.forward_chunk(self.batch, self.ready, end)
+            self.exp[self.ready:end] = exp[0].cpu().numpy()
+        self.ready = end
+
+    def get(self, lo, hi):
+        """ Smoothed 70-dim coefficients of frames [lo, hi). """
+        T = self.num_frames
+        radius = self.smooth_window // 2
+        need = max(min(hi + radius, T), min(self.smooth_window, T))
+        while self.ready < need:
+            self._compute_next()
+
+        # savgol over a slice is exact for every frame at least `radius` away from a slice end
+        # that is not also a sequence end
+        s1 = self.ready
+        s0 = max(0, min(lo - radius, s1 - self.smooth_window))
+        pose = smooth_pose(self.pose[s0:s1])[lo - s0:hi - s0]
+        return np.concatenate([self.exp[lo:hi], pose], axis=1)
+
+
+def iter_segments(coeff_stream, animate_from_coeff, source, crop_info, segment_frames=25,
+                  expression_scale=1.0, still_mode=False, preprocess='crop', size=256, render_memory_mb=2048,
+                  precision='fp32'):
+    """
+    Render the video in segments of `segment_frames`, each yielded as soon as it is done as
+    {'index', 'start', 'frames'} with uint8 RGB frames. Every segment is rendered from the
+    coefficients of its frames plus `semantic_radius` frames of context on both sides, so
+    the semantic windows are the ones get_facerender_data builds for the whole video.
+
+    The audio2exp chunks and pose windows of the next segment are computed on a worker thread
+    while the current one renders.
+    """
+    semantic_radius = 13
+    device = animate_from_coeff.device
+    T = coeff_stream.num_frames
+
+    source_image = source['source_image'].to(device)
+    source_semantics = source['source_semantics'].to(device)
+
+    def segment_semantics(start):
+        end = min(start + segment_frames, T)
+        lo, hi = max(0, start - semantic_radius), min(T, end + semantic_radius)
+        coeffs = transform_target_coeffs(coeff_stream.get(lo, hi), source['coeff'], expression_scale, still_mode, preprocess)
+        # edge padding the slice only reaches the windows of frames outside [start, end) unless it is a sequence end
+        return get_semantic_windows(coeffs, semantic_radius)[start - lo:end - lo]
+
+    # a single worker, the coefficient stream is only ever advanced by one segment at a time
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        starts = range(0, T, segment_frames)
+        pending = executor.submit(segment_semantics, 0) if T > 0 else None
+        for index, start in enumerate(starts):
+            windows = pending.result()
+            if start + segment_frames < T:
+                pending = executor.submit(segment_semantics, start + segment_frames)
+            target_semantics = torch.FloatTensor(windows).unsqueeze(0).to(device)  # 1 n C 27
+
+            frames = animate_from_coeff.iter_frames(source_image, source_semantics, target_semantics, crop_info, size,
+                                                    render_memory_mb=render_memory_mb, precision=precision)
+            yield {'index': index, 'start': start, 'frames': np.stack(list(frames))}
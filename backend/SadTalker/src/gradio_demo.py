@@ -1,19 +1,20 @@
 import torch, uuid
+import cv2
+import numpy as np
 import os, sys, shutil
-from src.utils.preprocess import CropAndExtract
-from src.test_audio2coeff import Audio2Coeff  
-from src.facerender.animate import AnimateFromCoeff
+import queue
 from src.generate_batch import get_data
-from src.generate_facerender_batch import get_facerender_data
+from src.generate_facerender_batch import get_facerender_data, source_data, transform_target_coeffs, get_semantic_windows
+from src.generate_stream import CoeffStream, iter_segments
+from src.idle_clips import idle_coeffs, render_idle_clip
+from src.utils.paste_pic import load_full_image, get_paste_box, paste_frame
+from src.utils.pipeline import pipelined
+from src.utils.pipeline_context import PipelineContext
+from src.utils.videoio import VideoStreamWriter
 
-from src.utils.init_path import init_path
+from src.utils.model_pool import get_model_pool
 
-from pydub import AudioSegment
-
-
-def mp3_to_wav(mp3_filename,wav_filename,frame_rate):
-    mp3_file = AudioSegment.from_file(file=mp3_filename)
-    mp3_file.set_frame_rate(frame_rate).export(wav_filename,format="wav")
+from scipy.io import loadmat
 
 
 class SadTalker():
@@ -31,7 +32,54 @@ class SadTalker():
 
         self.checkpoint_path = checkpoint_path
         self.config_path = config_path
-      
+        self.model_pool = get_model_pool(checkpoint_path, config_path, device)
+
+        if not lazy_load:
+            self.model_pool.warmup()
+
+    def warmup(self, sizes=(256,), preprocesses=('crop',)):
+        self.model_pool.warmup(sizes, preprocesses)
+
+    def evict(self, size=None, preprocess=None):
+        self.model_pool.evict(size, preprocess)
+
+    def register_avatar(self, source_image, preprocess='crop', size=256):
+        """ Crop the avatar and extract its 3DMM coefficients once, ahead of the first generation. """
+        preprocess_model = self.model_pool.get('preprocess_model', size, preprocess)
+        return preprocess_model.register_avatar(source_image, preprocess, size)
+
+    def idle_clip_dir(self, avatar_id):
+        return os.path.join(self.model_pool.cache_dir, 'idle', avatar_id)
+
+    def idle_clips(self, source_image, preprocess='crop', size=256, num_clips=3, seconds=4.0,
+        pose_style=0, seed=0, render_memory_mb=2048):
+        """
+        Render `num_clips` seamless looping idle clips (blinks and a subtle head pose, no speech)
+        of the avatar once, to <cache_dir>/idle/<avatar id>/clip_<i>.mp4. Clips that already
+        exist are kept, so they are served without any inference afterwards.
+        """
+        preprocess_model, audio_to_coeff, animate_from_coeff = self.model_pool.get_models(size, preprocess)
+        avatar_id = preprocess_model.register_avatar(source_image, preprocess, size)
+        if avatar_id is None:
+            raise AttributeError("No face is detected")
+
+        clip_dir = self.idle_clip_dir(avatar_id)
+        os.makedirs(clip_dir, exist_ok=True)
+        clip_paths = [os.path.join(clip_dir, 'clip_%d.mp4' % i) for i in range(num_clips)]
+        if all(os.path.isfile(path) for path in clip_paths):
+            return clip_paths
+
+        extracted = preprocess_model.extract(source_image, preprocess, True, size)
+        source = source_data(extracted['image'], extracted['coeff_3dmm'], preprocess, size)
+        num_frames = int(seconds * 25)
+        for i, path in enumerate(clip_paths):
+            if os.path.isfile(path):
+                continue
+            coeffs = idle_coeffs(audio_to_coeff, source['coeff'], num_frames, pose_style=pose_style,
+                                 seed=None if seed is None else seed + i * 1000)
+            render_idle_clip(path, animate_from_coeff, coeffs, source, extracted['crop_info'], source_image,
+                             preprocess, size, render_memory_mb)
+        return clip_paths
 
     def test(self, source_image, driven_audio, preprocess='crop', 
         still_mode=False,  use_enhancer=False, batch_size=1, size=256, 
@@ -41,14 +89,9 @@ class SadTalker():
         ref_info = None,
         use_idle_mode = False,
         length_of_audio = 0, use_blink=True,
-        result_dir='./results/'):
+        result_dir='./results/', seed=None, verbose=False, precision='fp32'):
 
-        self.sadtalker_paths = init_path(self.checkpoint_path, self.config_path, size, False, preprocess)
-        print(self.sadtalker_paths)
-            
-        self.audio_to_coeff = Audio2Coeff(self.sadtalker_paths, self.device)
-        self.preprocess_model = CropAndExtract(self.sadtalker_paths, self.device)
-        self.animate_from_coeff = AnimateFromCoeff(self.sadtalker_paths, self.device)
+        self.preprocess_model, self.audio_to_coeff, self.animate_from_coeff = self.model_pool.get_models(size, preprocess)
 
         time_tag = str(uuid.uuid4())
         save_dir = os.path.join(result_dir, time_tag)
@@ -59,23 +102,17 @@ class SadTalker():
 
         print(source_image)
         pic_path = os.path.join(input_dir, os.path.basename(source_image)) 
-        shutil.move(source_image, input_dir)
+        shutil.copy(source_image, input_dir)
 
+        idle_wav = None
         if driven_audio is not None and os.path.isfile(driven_audio):
+            # any format, it is decoded and resampled once by the pipeline context
             audio_path = os.path.join(input_dir, os.path.basename(driven_audio))  
-
-            #### mp3 to wav
-            if '.mp3' in audio_path:
-                mp3_to_wav(driven_audio, audio_path.replace('.mp3', '.wav'), 16000)
-                audio_path = audio_path.replace('.mp3', '.wav')
-            else:
-                shutil.move(driven_audio, input_dir)
+            shutil.move(driven_audio, input_dir)
 
         elif use_idle_mode:
-            audio_path = os.path.join(input_dir, 'idlemode_'+str(length_of_audio)+'.wav') ## generate audio from this new audio_path
-            from pydub import AudioSegment
-            one_sec_segment = AudioSegment.silent(duration=1000*length_of_audio)  #duration in milliseconds
-            one_sec_segment.export(audio_path, format="wav")
+            audio_path = os.path.join(input_dir, 'idlemode_'+str(length_of_audio)+'.wav') ## only names the video, the silence stays in memory
+            idle_wav = np.zeros(int(16000 * length_of_audio), dtype=np.float32)
         else:
             print(use_ref_video, ref_info)
             assert use_ref_video == True and ref_info == 'all'
@@ -90,13 +127,16 @@ class SadTalker():
 
         os.makedirs(save_dir, exist_ok=True)
         
+        # the stages hand their results over in memory, the intermediate files are only kept when verbose
+        context = PipelineContext(pic_path, audio_path, save_dir=save_dir if verbose else None)
+        context.wav = idle_wav
+
         #crop image and extract 3dmm from image
-        first_frame_dir = os.path.join(save_dir, 'first_frame_dir')
-        os.makedirs(first_frame_dir, exist_ok=True)
-        first_coeff_path, crop_pic_path, crop_info = self.preprocess_model.generate(pic_path, first_frame_dir, preprocess, True, size)
-        
-        if first_coeff_path is None:
+        source = self.preprocess_model.extract(pic_path, preprocess, True, size)
+        if source is None:
             raise AttributeError("No face is detected")
+        context.set_source(source)
+        crop_info = context.crop_info
 
         if use_ref_video:
             print('using ref video for genreation')
@@ -129,27 +169,153 @@ class SadTalker():
 
         #audio2ceoff
         if use_ref_video and ref_info == 'all':
-            coeff_path = ref_video_coeff_path # self.audio_to_coeff.generate(batch, save_dir, pose_style, ref_pose_coeff_path)
+            context.set_coeffs(loadmat(ref_video_coeff_path)['coeff_3dmm']) # self.audio_to_coeff.generate(batch, save_dir, pose_style, ref_pose_coeff_path)
         else:
-            batch = get_data(first_coeff_path, audio_path, self.device, ref_eyeblink_coeff_path=ref_eyeblink_coeff_path, still=still_mode, idlemode=use_idle_mode, length_of_audio=length_of_audio, use_blink=use_blink) # longer audio?
-            coeff_path = self.audio_to_coeff.generate(batch, save_dir, pose_style, ref_pose_coeff_path)
+            batch = get_data(None, audio_path, self.device, ref_eyeblink_coeff_path=ref_eyeblink_coeff_path, still=still_mode, idlemode=use_idle_mode, length_of_audio=length_of_audio, use_blink=use_blink, context=context) # longer audio?
+            self.audio_to_coeff.generate(batch, save_dir, pose_style, ref_pose_coeff_path, seed=seed, context=context)
 
         #coeff2video
-        data = get_facerender_data(coeff_path, crop_pic_path, first_coeff_path, audio_path, batch_size, still_mode=still_mode, preprocess=preprocess, size=size, expression_scale = exp_scale)
-        return_path = self.animate_from_coeff.generate(data, save_dir,  pic_path, crop_info, enhancer='gfpgan' if use_enhancer else None, preprocess=preprocess, img_size=size)
+        data = get_facerender_data(None, None, None, audio_path, batch_size, still_mode=still_mode, preprocess=preprocess, size=size, expression_scale = exp_scale, dump_txt=verbose, context=context)
+        return_path = self.animate_from_coeff.generate(data, save_dir,  pic_path, crop_info, enhancer='gfpgan' if use_enhancer else None, preprocess=preprocess, img_size=size, precision=precision)
         video_name = data['video_name']
         print(f'The generated video is named {video_name} in {save_dir}')
 
-        del self.preprocess_model
-        del self.audio_to_coeff
-        del self.animate_from_coeff
-
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
-            torch.cuda.synchronize()
-            
-        import gc; gc.collect()
-        
         return return_path
 
-    
\ No newline at end of file
+    
+
+    def test_sentences(self, source_image, driven_audios, save_path, preprocess='crop', still_mode=False, size=256,
+        pose_style=0, exp_scale=1.0, use_blink=True, seed=None, result_dir='./results/', queue_size=2,
+        blend_frames=8, render_memory_mb=2048, precision='fp32'):
+        """
+        Generate one video from consecutive audio clips (e.g. one per sentence) as a pipeline:
+        clip N+1 goes through audio2coeff while clip N is rendered and clip N+2 is read, or
+        synthesized when `driven_audios` is a lazy generator. Each stage runs in its own thread
+        with bounded queues in between. The clips go into a single ffmpeg encode and the head pose
+        of every clip is eased in from the last pose of the previous one, so there is no cut.
+        """
+        preprocess_model, audio_to_coeff, animate_from_coeff = self.model_pool.get_models(size, preprocess)
+
+        save_dir = os.path.join(result_dir, str(uuid.uuid4()))
+        input_dir = os.path.join(save_dir, 'input')
+        os.makedirs(input_dir, exist_ok=True)
+
+        try:
+            pic_path = os.path.join(input_dir, os.path.basename(source_image)) 
+            shutil.copy(source_image, input_dir)
+
+            extracted = preprocess_model.extract(pic_path, preprocess, True, size)
+            if extracted is None:
+                raise AttributeError("No face is detected")
+            crop_info = extracted['crop_info']
+            source = source_data(extracted['image'], extracted['coeff_3dmm'], preprocess, size)
+
+            def load_audio(item):
+                # the only decode of the clip, get_data and the muxer use the same samples
+                index, driven_audio = item
+                context = PipelineContext(pic_path, driven_audio, source=extracted)
+                context.load_wav(16000)
+                return index, context
+
+            last_pose = []
+            def audio_to_coeffs(item):
+                index, context = item
+                batch = get_data(None, context.audio_path, self.device, None, still=still_mode, use_blink=use_blink, context=context)
+                num_frames = batch['num_frames']
+                clip_seed = None if seed is None else seed + index * 1000
+                coeffs = CoeffStream(audio_to_coeff, batch, pose_style, clip_seed).get(0, num_frames)
+
+                # every clip starts from the reference pose, offset it towards where the last one ended
+                if last_pose:
+                    k = min(blend_frames, num_frames)
+                    w = (np.arange(k) + 1)[:, None] / (k + 1)
+                    coeffs[:k, 64:70] += (1 - w) * (last_pose[-1] - coeffs[0, 64:70])
+                last_pose.append(coeffs[-1, 64:70].copy())
+
+                return coeffs, context.pcm(num_frames)
+
+            box = get_paste_box(crop_info, 'ext' in preprocess.lower()) if 'full' in preprocess.lower() else None
+            if box is not None:
+                full_img = cv2.cvtColor(load_full_image(pic_path), cv2.COLOR_BGR2RGB)
+
+            device = animate_from_coeff.device
+            source_image_ts = source['source_image'].to(device)
+            source_semantics = source['source_semantics'].to(device)
+
+            # audio goes to ffmpeg clip by clip, right before its frames
+            audio_chunks = queue.Queue()
+            writer = VideoStreamWriter(save_path, fps=25, audio_pcm=iter(audio_chunks.get, None))
+            clips = pipelined(enumerate(driven_audios), [load_audio, audio_to_coeffs], queue_size)
+            try:
+                for coeffs, pcm in clips:
+                    T = coeffs.shape[0]
+                    coeffs = transform_target_coeffs(coeffs, source['coeff'], exp_scale, still_mode, preprocess)
+                    target_semantics = torch.FloatTensor(get_semantic_windows(coeffs, 13)).unsqueeze(0).to(device)  # 1 T C 27
+
+                    audio_chunks.put(pcm)
+                    for frame in animate_from_coeff.iter_frames(source_image_ts, source_semantics, target_semantics, crop_info,
+                                                                size, frame_num=T, render_memory_mb=render_memory_mb,
+                                                                precision=precision):
+                        writer.write(paste_frame(frame, full_img, box) if box is not None else frame)
+                audio_chunks.put(None)
+                writer.close()
+            except BaseException:
+                audio_chunks.put(None)
+                writer.abort()
+                raise
+            finally:
+                # the caller cleans up the clips once this returns, so no stage may still be making one
+                clips.close()
+        finally:
+            shutil.rmtree(save_dir, ignore_errors=True)
+
+        if not os.path.isfile(save_path):
+            raise ValueError("No audio to generate a video from")
+        return save_path
+
+    def stream(self, source_image, driven_audio, preprocess='crop', still_mode=False, size=256,
+        pose_style=0, exp_scale=1.0, use_blink=True, segment_frames=25, seed=None,
+        result_dir='./results/', render_memory_mb=2048, precision='fp32'):
+        """
+        Generate the video segment by segment instead of as one file. Yields dicts with the
+        segment 'index', its first frame 'start', the uint8 RGB 'frames' at 25 fps and the
+        matching int16 16kHz mono 'audio'. Only the next segment's coefficients are computed
+        before it is rendered, so the first segment is out long before the whole video would be.
+        """
+        preprocess_model, audio_to_coeff, animate_from_coeff = self.model_pool.get_models(size, preprocess)
+
+        save_dir = os.path.join(result_dir, str(uuid.uuid4()))
+        input_dir = os.path.join(save_dir, 'input')
+        os.makedirs(input_dir, exist_ok=True)
+
+        try:
+            pic_path = os.path.join(input_dir, os.path.basename(source_image)) 
+            shutil.copy(source_image, input_dir)
+
+            extracted = preprocess_model.extract(pic_path, preprocess, True, size)
+            if extracted is None:
+                raise AttributeError("No face is detected")
+            # the audio is decoded once, for the mels and for the segments' samples
+            context = PipelineContext(pic_path, driven_audio, source=extracted)
+            crop_info = context.crop_info
+
+            batch = get_data(None, driven_audio, self.device, None, still=still_mode, use_blink=use_blink, context=context)
+            coeff_stream = CoeffStream(audio_to_coeff, batch, pose_style, seed)
+            source = source_data(extracted['image'], extracted['coeff_3dmm'], preprocess, size)
+
+            pcm = context.pcm(batch['num_frames'])
+            samples_per_frame = 16000 // 25
+
+            box = get_paste_box(crop_info, 'ext' in preprocess.lower()) if 'full' in preprocess.lower() else None
+            if box is not None:
+                full_img = cv2.cvtColor(load_full_image(pic_path), cv2.COLOR_BGR2RGB)
+
+            for segment in iter_segments(coeff_stream, animate_from_coeff, source, crop_info, segment_frames,
+                                         exp_scale, still_mode, preprocess, size, render_memory_mb, precision):
+                if box is not None:
+                    segment['frames'] = np.stack([paste_frame(frame, full_img, box) for frame in segment['frames']])
+                start, end = segment['start'], segment['start'] + len(segment['frames'])
+                segment['audio'] = pcm[start*samples_per_frame:end*samples_per_frame]
+                yield segment
+        finally:
+            shutil.rmtree(save_dir, ignore_errors=True)
@@ -0,0 +1,67 @@
+import os
+import uuid
+
+import cv2
+import numpy as np
+import torch
+
+from src.generate_batch import generate_blink_seq_randomly
+from src.generate_facerender_batch import transform_target_coeffs, get_semantic_windows
+from src.test_audio2coeff import smooth_pose
+from src.utils.paste_pic import load_full_image, get_paste_box, paste_frame
+from src.utils.videoio import VideoStreamWriter
+
+
+def idle_coeffs(audio_to_coeff, ref_coeff, num_frames, blend_frames=12, pose_scale=0.5, pose_style=0, seed=None):
+    """
+    num_frames x 70 coefficients of a silent, looping clip: random blinks and a subtle head pose
+    from the silent-audio idle mode. `blend_frames` extra frames are rendered and crossfaded into
+    the first frames, so the last frame leads into the first as if the clip went on.
+    """
+    device = audio_to_coeff.device
+    total = num_frames + blend_frames
+    batch = {'indiv_mels': torch.zeros((1, total, 1, 80, 16), device=device),      # bs T 1 80 16, silence
+             'ref': torch.FloatTensor(np.repeat(ref_coeff[:1, :70], total, axis=0)).unsqueeze(0).to(device),
+             'num_frames': total,
+             'ratio_gt': torch.FloatTensor(generate_blink_seq_randomly(total)).unsqueeze(0).to(device),
+             'class': torch.LongTensor([pose_style]).to(device)}
+
+    with torch.no_grad():
+        exp = audio_to_coeff.audio2exp_model.test(batch)['exp_coeff_pred'][0].cpu().numpy()       # T 64
+        pose = audio_to_coeff.audio2pose_model.test(batch, seed=seed)['pose_pred'][0].cpu().numpy()  # T 6
+
+    ref_pose = ref_coeff[0, 64:70]
+    pose = ref_pose + pose_scale * (smooth_pose(pose) - ref_pose)
+    coeffs = np.concatenate([exp, pose], axis=1)
+
+    loop = coeffs[:num_frames].copy()
+    w = (np.arange(blend_frames) / blend_frames)[:, None]
+    loop[:blend_frames] = (1 - w) * coeffs[num_frames:] + w * coeffs[:blend_frames]
+    return loop
+
+
+def render_idle_clip(save_path, animate_from_coeff, coeffs, source, crop_info, pic_path=None,
+                     preprocess='crop', size=256, render_memory_mb=2048):
+    """
+    Render looping coefficients to a silent mp4. The semantic windows wrap around the clip
+    instead of being clamped at its ends, which keeps the seam as smooth as any other frame.
+    """
+    semantic_radius = 13
+    device = animate_from_coeff.device
+
+    coeffs = transform_target_coeffs(coeffs, source['coeff'], preprocess=preprocess)
+    windows = get_semantic_windows(coeffs, semantic_radius, mode='wrap')
+    target_semantics = torch.FloatTensor(windows).unsqueeze(0).to(device)     # 1 T C 27
+
+    box = get_paste_box(crop_info, 'ext' in preprocess.lower()) if 'full' in preprocess.lower() else None
+    if box is not None:
+        full_img = cv2.cvtColor(load_full_image(pic_path), cv2.COLOR_BGR2RGB)
+
+    frames = animate_from_coeff.iter_frames(source['source_image'].to(device), source['source_semantics'].to(device),
+                                            target_semantics, crop_info, size, render_memory_mb=render_memory_mb)
+    tmp_path = os.path.join(os.path.dirname(save_path), '%s.tmp.mp4' % uuid.uuid4().hex)
+    with VideoStreamWriter(tmp_path, fps=25) as writer:
+        for frame in frames:
+            writer.write(paste_frame(frame, full_img, box) if box is not None else frame)
+    os.replace(tmp_path, save_path)
+    return save_path
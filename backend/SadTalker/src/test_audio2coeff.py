@@ -5,13 +5,10 @@ from scipy.io import savemat, loadmat
 from yacs.config import CfgNode as CN
 from scipy.signal import savgol_filter
 
-import safetensors
-import safetensors.torch 
-
 from src.audio2pose_models.audio2pose import Audio2Pose
 from src.audio2exp_models.networks import SimpleWrapperV2 
 from src.audio2exp_models.audio2exp import Audio2Exp
-from src.utils.safetensor_helper import load_x_from_safetensor  
+from src.utils.safetensor_helper import load_checkpoint
 
 def load_cpk(checkpoint_path, model=None, optimizer=None, device="cpu"):
     checkpoint = torch.load(checkpoint_path, map_location=torch.device(device))
@@ -22,6 +19,14 @@ def load_cpk(checkpoint_path, model=None, optimizer=None, device="cpu"):
 
     return checkpoint['epoch']
 
+def smooth_pose(pose, axis=0):
+    """ savgol smoothing of the predicted head pose along the frame axis. """
+    pose_len = pose.shape[axis]
+    if pose_len<13: 
+        pose_len = int((pose_len-1)/2)*2+1
+        return savgol_filter(pose, pose_len, 2, axis=axis)
+    return savgol_filter(pose, 13, 2, axis=axis)
+
 class Audio2Coeff():
 
     def __init__(self, sadtalker_path, device):
@@ -42,8 +47,8 @@ class Audio2Coeff():
         
         try:
             if sadtalker_path['use_safetensor']:
-                checkpoints = safetensors.torch.load_file(sadtalker_path['checkpoint'])
-                self.audio2pose_model.load_state_dict(load_x_from_safetensor(checkpoints, 'audio2pose'))
+                checkpoints = load_checkpoint(sadtalker_path['checkpoint'])
+                self.audio2pose_model.load_state_dict(checkpoints.view('audio2pose'))
             else:
                 load_cpk(sadtalker_path['audio2pose_checkpoint'], model=self.audio2pose_model, device=device)
         except:
@@ -57,8 +62,8 @@ class Audio2Coeff():
         netG.eval()
         try:
             if sadtalker_path['use_safetensor']:
-                checkpoints = safetensors.torch.load_file(sadtalker_path['checkpoint'])
-                netG.load_state_dict(load_x_from_safetensor(checkpoints, 'audio2exp'))
+                checkpoints = load_checkpoint(sadtalker_path['checkpoint'])
+                netG.load_state_dict(checkpoints.view('audio2exp'))
             else:
                 load_cpk(sadtalker_path['audio2exp_checkpoint'], model=netG, device=device)
         except:
@@ -71,7 +76,8 @@ class Audio2Coeff():
  
         self.device = device
 
-    def generate(self, batch, coeff_save_dir, pose_style, ref_pose_coeff_path=None):
+    def generate(self, batch, coeff_save_dir, pose_style, ref_pose_coeff_path=None, seed=None, context=None):
+        """ The coefficients go to the PipelineContext when one is given, else to coeff_save_dir/pic##audio.mat. """
 
         with torch.no_grad():
             #test
@@ -82,15 +88,10 @@ class Audio2Coeff():
             #class_id = 0#(i+10)%45
             #class_id = random.randint(0,46)                                   #46 styles can be selected 
             batch['class'] = torch.LongTensor([pose_style]).to(self.device)
-            results_dict_pose = self.audio2pose_model.test(batch) 
+            results_dict_pose = self.audio2pose_model.test(batch, seed=seed) 
             pose_pred = results_dict_pose['pose_pred']                        #bs T 6
 
-            pose_len = pose_pred.shape[1]
-            if pose_len<13: 
-                pose_len = int((pose_len-1)/2)*2+1
-                pose_pred = torch.Tensor(savgol_filter(np.array(pose_pred.cpu()), pose_len, 2, axis=1)).to(self.device)
-            else:
-                pose_pred = torch.Tensor(savgol_filter(np.array(pose_pred.cpu()), 13, 2, axis=1)).to(self.device) 
+            pose_pred = torch.Tensor(smooth_pose(np.array(pose_pred.cpu()), axis=1)).to(self.device)
             
             coeffs_pred = torch.cat((exp_pred, pose_pred), dim=-1)            #bs T 70
 
@@ -98,6 +99,10 @@ class Audio2Coeff():
 
             if ref_pose_coeff_path is not None: 
                  coeffs_pred_numpy = self.using_refpose(coeffs_pred_numpy, ref_pose_coeff_path)
+
+            if context is not None:
+                context.set_coeffs(coeffs_pred_numpy)
+                return None
         
             savemat(os.path.join(coeff_save_dir, '%s##%s.mat'%(batch['pic_name'], batch['audio_name'])),  
                     {'coeff_3dmm': coeffs_pred_numpy})
@@ -1,3 +1,5 @@
+import inspect
+
 import librosa
 import librosa.filters
 import numpy as np
@@ -9,6 +11,10 @@ from src.utils.hparams import hparams as hp
 def load_wav(path, sr):
     return librosa.core.load(path, sr=sr)[0]
 
+def to_pcm16(wav):
+    """ float samples in [-1, 1] as int16 """
+    return np.clip(wav * 32767, -32768, 32767).astype(np.int16)
+
 def save_wav(wav, path, sr):
     wav *= 32767 / max(0.01, np.max(np.abs(wav)))
     #proposed by @dsmiller
@@ -44,12 +50,85 @@ def linearspectrogram(wav):
 
 def melspectrogram(wav):
     D = _stft(preemphasis(wav, hp.preemphasis, hp.preemphasize))
+    return _stft_to_mel(D)
+
+def _stft_to_mel(D):
     S = _amp_to_db(_linear_to_mel(np.abs(D))) - hp.ref_level_db
     
     if hp.signal_normalization:
         return _normalize(S)
     return S
 
+class StreamingMelSpectrogram():
+    """
+    melspectrogram of a waveform that arrives in chunks, e.g. PCM from a TTS engine or a microphone.
+
+    The preemphasis filter state and the samples of the frames still overlapping the next chunk
+    are kept between calls, and the first and last frames are padded like librosa.stft's
+    center=True, so the mel frames of all push() calls and finish() put together match
+    melspectrogram() of the whole waveform.
+    """
+
+    def __init__(self):
+        assert not hp.use_lws
+        self.n_fft = hp.n_fft
+        self.hop = get_hop_size()
+        self.pad = self.n_fft // 2
+        # same default as the librosa.stft of melspectrogram, 'reflect' before 0.10, 'constant' since
+        self.pad_mode = inspect.signature(librosa.stft).parameters['pad_mode'].default
+        window = librosa.filters.get_window('hann', hp.win_size or self.n_fft, fftbins=True)
+        self.window = librosa.util.pad_center(window, size=self.n_fft)
+        self.zi = np.zeros(1)
+        self.head = np.zeros(0)       # the first samples, until there are enough to pad the start
+        self.buffer = None            # padded samples from the first frame not emitted yet
+
+    def _preemphasis(self, wav):
+        if not hp.preemphasize:
+            return wav
+        wav, self.zi = signal.lfilter([1, -hp.preemphasis], [1], wav, zi=self.zi)
+        return wav
+
+    def _frames(self, padded):
+        """ mel frames of every full n_fft frame of `padded` and the samples left for the next ones """
+        num_frames = (len(padded) - self.n_fft) // self.hop + 1 if len(padded) >= self.n_fft else 0
+        if num_frames == 0:
+            return np.zeros((hp.num_mels, 0)), padded
+        frames = np.lib.stride_tricks.sliding_window_view(padded, self.n_fft)[::self.hop][:num_frames]
+        D = np.fft.rfft(frames * self.window, axis=-1).T     # 1 + n_fft/2, num_frames
+        return _stft_to_mel(D), padded[num_frames * self.hop:]
+
+    def push(self, chunk):
+        """ Add float samples in [-1, 1] or int16 PCM, returns the new num_mels x N mel frames """
+        chunk = np.asarray(chunk)
+        if np.issubdtype(chunk.dtype, np.integer):
+            chunk = chunk / 32768.
+        wav = self._preemphasis(chunk)
+
+        if self.buffer is None:
+            self.head = np.concatenate([self.head, wav])
+            # a reflected start needs the samples 1 to pad
+            if self.pad_mode == 'reflect' and len(self.head) <= self.pad:
+                return np.zeros((hp.num_mels, 0))
+            start = self.head[1:self.pad + 1][::-1] if self.pad_mode == 'reflect' else np.zeros(self.pad)
+            self.buffer, self.head = np.concatenate([start, self.head]), None
+        else:
+            self.buffer = np.concatenate([self.buffer, wav])
+
+        mel, self.buffer = self._frames(self.buffer)
+        return mel
+
+    def finish(self):
+        """ The mel frames of the padded end of the waveform """
+        if self.buffer is None:
+            # shorter than the padding, padded on both sides at once like librosa does
+            mel, _ = self._frames(np.pad(self.head, self.pad, mode=self.pad_mode))
+        else:
+            end = self.buffer[-self.pad - 1:-1][::-1] if self.pad_mode == 'reflect' else np.zeros(self.pad)
+            mel, _ = self._frames(np.concatenate([self.buffer, end]))
+        self.buffer, self.head = None, np.zeros(0)
+        self.zi = np.zeros(1)
+        return mel
+
 def _lws_processor():
     import lws
     return lws.lws(hp.n_fft, get_hop_size(), fftsize=hp.win_size, mode="speech")
@@ -0,0 +1,85 @@
+import hashlib
+import os
+import threading
+import uuid
+
+import numpy as np
+
+
+class AvatarCache():
+    """ Persistent cache of preprocessed source images.
+
+    One .npz per (image content, preprocess mode, size) holding the crop info, the cropped
+    image, the landmarks and the 3DMM coefficients. Entries are evicted least recently used
+    first once more than `max_entries` are stored.
+    """
+
+    def __init__(self, cache_dir, max_entries=32):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(image_path, preprocess='crop', size=256):
+        h = hashlib.sha1()
+        with open(image_path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+        h.update(('%s_%d' % (preprocess.lower(), size)).encode())
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.npz')
+
+    def __contains__(self, key):
+        return os.path.isfile(self._path(key))
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            os.utime(path)  # mark as recently used
+            with np.load(path) as data:
+                entry = {k: data[k] for k in data.files}
+        except OSError:
+            # not cached, or evicted meanwhile, possibly by another worker process sharing the directory
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+
+        crop = tuple(int(v) for v in entry.pop('crop')) or None
+        quad = [float(v) for v in entry.pop('quad')] or None
+        entry['crop_info'] = (tuple(int(v) for v in entry.pop('crop_size')), crop, quad)
+        return entry
+
+    def put(self, key, crop_info, image, landmarks, coeff_3dmm, full_3dmm):
+        crop_size, crop, quad = crop_info
+        path = self._path(key)
+        tmp_path = path + '.' + uuid.uuid4().hex + '.tmp.npz'
+        np.savez_compressed(tmp_path,
+                            crop_size=np.array(crop_size, dtype=np.int64),
+                            crop=np.array(crop if crop is not None else [], dtype=np.int64),
+                            quad=np.array(quad if quad is not None else [], dtype=np.float64),
+                            image=image, landmarks=landmarks,
+                            coeff_3dmm=coeff_3dmm, full_3dmm=full_3dmm)
+        os.replace(tmp_path, path)
+        self._evict()
+
+    def _evict(self):
+        with self._lock:
+            entries = [os.path.join(self.cache_dir, f) for f in os.listdir(self.cache_dir) if f.endswith('.npz') and not f.endswith('.tmp.npz')]
+            if len(entries) <= self.max_entries:
+                return
+            entries.sort(key=os.path.getmtime)
+            for path in entries[:len(entries) - self.max_entries]:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'cache_dir': self.cache_dir}
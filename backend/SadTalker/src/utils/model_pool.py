@@ -0,0 +1,145 @@
+import os
+import tempfile
+import threading
+import time
+
+import torch
+
+from src.utils.init_path import init_path
+from src.utils.safetensor_helper import checkpoint_stats, release_checkpoint
+from src.utils.avatar_cache import AvatarCache
+
+
+class ModelPool():
+    """ Long-lived registry of the SadTalker components.
+
+    Every component is loaded once and reused across requests. Components are keyed by what
+    actually changes their weights: the checkpoint dir and the render size for all of them,
+    plus the facerender variant ('full' or not) for AnimateFromCoeff. A component is built by
+    the first request for it, outside the pool lock: requests for it wait, the others do not.
+
+    The pool also owns the on-disk caches shared by its components, under `cache_dir`, the
+    compiled face renderers included when `compile_mode` (SADTALKER_COMPILE) is not 'off'.
+    """
+
+    def __init__(self, checkpoint_path='checkpoints', config_path='src/config', device=None, old_version=False, cache_dir=None,
+                 compile_mode=None):
+        if device is None:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        if cache_dir is None:
+            cache_dir = os.environ.get('SADTALKER_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'sadtalker_cache'))
+        if compile_mode is None:
+            compile_mode = os.environ.get('SADTALKER_COMPILE', 'off')
+        self.checkpoint_path = checkpoint_path
+        self.config_path = config_path
+        self.device = device
+        self.old_version = old_version
+        self.cache_dir = cache_dir
+        self.compile_mode = compile_mode
+
+        self.avatar_cache = AvatarCache(os.path.join(cache_dir, 'avatars'))
+
+        self._models = {}
+        self._loading = {}          # key -> Event set once its build is stored in _models, or failed
+        self._lock = threading.Lock()
+
+    def _key(self, component, size, preprocess):
+        checkpoint_dir = os.path.abspath(self.checkpoint_path)
+        if component == 'animate_from_coeff':
+            return (component, checkpoint_dir, size, 'full' in preprocess.lower())
+        return (component, checkpoint_dir, size)
+
+    def _build(self, component, sadtalker_paths):
+        if component == 'preprocess_model':
+            from src.utils.preprocess import CropAndExtract
+            return CropAndExtract(sadtalker_paths, self.device, avatar_cache=self.avatar_cache)
+        elif component == 'audio_to_coeff':
+            from src.test_audio2coeff import Audio2Coeff
+            return Audio2Coeff(sadtalker_paths, self.device)
+        elif component == 'animate_from_coeff':
+            from src.facerender.animate import AnimateFromCoeff
+            return AnimateFromCoeff(sadtalker_paths, self.device, compile_mode=self.compile_mode,
+                                    cache_dir=os.path.join(self.cache_dir, 'compiled'))
+        raise ValueError('unknown component: %s' % component)
+
+    def get_paths(self, size=256, preprocess='crop'):
+        return init_path(self.checkpoint_path, self.config_path, size, self.old_version, preprocess)
+
+    def get(self, component, size=256, preprocess='crop'):
+        key = self._key(component, size, preprocess)
+        while True:
+            with self._lock:
+                if key in self._models:
+                    return self._models[key]
+                done = self._loading.get(key)
+                waiting = done is not None
+                if not waiting:
+                    done = self._loading[key] = threading.Event()
+            if not waiting:
+                break
+            # built by another request meanwhile, loaded components are not held up by it.
+            # Loop as the build may have failed, then this one tries again
+            done.wait()
+
+        try:
+            start = time.time()
+            model = self._build(component, self.get_paths(size, preprocess))
+            print('loaded %s (size=%d, preprocess=%s) in %.2fs' % (component, size, preprocess, time.time() - start))
+            with self._lock:
+                self._models[key] = model
+            return model
+        finally:
+            with self._lock:
+                del self._loading[key]
+            done.set()
+
+    def get_models(self, size=256, preprocess='crop'):
+        """ Return (preprocess_model, audio_to_coeff, animate_from_coeff) for one configuration. """
+        return (self.get('preprocess_model', size, preprocess),
+                self.get('audio_to_coeff', size, preprocess),
+                self.get('animate_from_coeff', size, preprocess))
+
+    def warmup(self, sizes=(256,), preprocesses=('crop',)):
+        for size in sizes:
+            for preprocess in preprocesses:
+                self.get_models(size, preprocess)
+
+    def evict(self, size=None, preprocess=None):
+        """ Drop loaded components. With no arguments the whole pool is cleared. """
+        with self._lock:
+            for key in list(self._models.keys()):
+                if size is not None and key[2] != size:
+                    continue
+                if preprocess is not None and (key[0] != 'animate_from_coeff' or key[3] != ('full' in preprocess.lower())):
+                    continue
+                del self._models[key]
+            # the loaded components hold copies of their weights, only new builds need the mapping again
+            release_checkpoint()
+
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        import gc; gc.collect()
+
+    def loaded(self):
+        with self._lock:
+            return [{'component': key[0], 'size': key[2]} for key in self._models]
+
+    def stats(self):
+        with self._lock:
+            compiled = [model.renderer.stats() for key, model in self._models.items()
+                        if key[0] == 'animate_from_coeff' and model.renderer is not model.generator]
+        return {'loaded': self.loaded(), 'checkpoints': checkpoint_stats(), 'avatar_cache': self.avatar_cache.stats(),
+                'compiled': compiled}
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_model_pool(checkpoint_path='checkpoints', config_path='src/config', device=None, old_version=False, cache_dir=None,
+                   compile_mode=None):
+    """ Process-wide pool, one per (checkpoint dir, config dir, device). """
+    key = (os.path.abspath(checkpoint_path), os.path.abspath(config_path), device, old_version, cache_dir, compile_mode)
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = ModelPool(checkpoint_path, config_path, device, old_version, cache_dir, compile_mode)
+        return _pools[key]
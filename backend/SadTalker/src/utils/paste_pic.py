@@ -5,8 +5,8 @@ import uuid
 
 from src.utils.videoio import save_video_with_watermark 
 
-def paste_pic(video_path, pic_path, crop_info, new_audio_path, full_video_path, extended_crop=False):
-
+def load_full_image(pic_path):
+    """ The frame the crop is pasted back into: the image itself, or the first frame of a video. """
     if not os.path.isfile(pic_path):
         raise ValueError('pic_path must be a valid path to video/image file')
     elif pic_path.split('.')[-1] in ['jpg', 'png', 'jpeg']:
@@ -15,15 +15,37 @@ def paste_pic(video_path, pic_path, crop_info, new_audio_path, full_video_path,
     else:
         # loader for videos
         video_stream = cv2.VideoCapture(pic_path)
-        fps = video_stream.get(cv2.CAP_PROP_FPS)
-        full_frames = [] 
-        while 1:
-            still_reading, frame = video_stream.read()
-            if not still_reading:
-                video_stream.release()
-                break 
-            break 
+        still_reading, frame = video_stream.read()
+        video_stream.release()
         full_img = frame
+    return full_img
+
+def get_paste_box(crop_info, extended_crop=False):
+    """ (ox1, oy1, ox2, oy2) of the generated face in the full image, None if it was not cropped. """
+    if len(crop_info) != 3:
+        return None
+    r_w, r_h = crop_info[0]
+    clx, cly, crx, cry = crop_info[1]
+    lx, ly, rx, ry = crop_info[2]
+    lx, ly, rx, ry = int(lx), int(ly), int(rx), int(ry)
+
+    if extended_crop:
+        oy1, oy2, ox1, ox2 = cly, cry, clx, crx
+    else:
+        oy1, oy2, ox1, ox2 = cly+ly, cly+ry, clx+lx, clx+rx
+    return ox1, oy1, ox2, oy2
+
+def paste_frame(crop_frame, full_img, box):
+    ox1, oy1, ox2, oy2 = box
+    p = cv2.resize(crop_frame.astype(np.uint8), (ox2-ox1, oy2 - oy1)) 
+
+    mask = 255*np.ones(p.shape, p.dtype)
+    location = ((ox1+ox2) // 2, (oy1+oy2) // 2)
+    return cv2.seamlessClone(p, full_img, mask, location, cv2.NORMAL_CLONE)
+
+def paste_pic(video_path, pic_path, crop_info, new_audio_path, full_video_path, extended_crop=False):
+
+    full_img = load_full_image(pic_path)
     frame_h = full_img.shape[0]
     frame_w = full_img.shape[1]
 
@@ -37,31 +59,15 @@ def paste_pic(video_path, pic_path, crop_info, new_audio_path, full_video_path,
             break
         crop_frames.append(frame)
     
-    if len(crop_info) != 3:
+    box = get_paste_box(crop_info, extended_crop)
+    if box is None:
         print("you didn't crop the image")
         return
-    else:
-        r_w, r_h = crop_info[0]
-        clx, cly, crx, cry = crop_info[1]
-        lx, ly, rx, ry = crop_info[2]
-        lx, ly, rx, ry = int(lx), int(ly), int(rx), int(ry)
-        # oy1, oy2, ox1, ox2 = cly+ly, cly+ry, clx+lx, clx+rx
-        # oy1, oy2, ox1, ox2 = cly+ly, cly+ry, clx+lx, clx+rx
-
-        if extended_crop:
-            oy1, oy2, ox1, ox2 = cly, cry, clx, crx
-        else:
-            oy1, oy2, ox1, ox2 = cly+ly, cly+ry, clx+lx, clx+rx
 
     tmp_path = str(uuid.uuid4())+'.mp4'
     out_tmp = cv2.VideoWriter(tmp_path, cv2.VideoWriter_fourcc(*'MP4V'), fps, (frame_w, frame_h))
     for crop_frame in tqdm(crop_frames, 'seamlessClone:'):
-        p = cv2.resize(crop_frame.astype(np.uint8), (ox2-ox1, oy2 - oy1)) 
-
-        mask = 255*np.ones(p.shape, p.dtype)
-        location = ((ox1+ox2) // 2, (oy1+oy2) // 2)
-        gen_img = cv2.seamlessClone(p, full_img, mask, location, cv2.NORMAL_CLONE)
-        out_tmp.write(gen_img)
+        out_tmp.write(paste_frame(crop_frame, full_img, box))
 
     out_tmp.release()
 
@@ -0,0 +1,79 @@
+import queue
+import threading
+
+_DONE = object()
+
+
+def _put(q, item, stop):
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _get(q, stop):
+    while not stop.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            pass
+    return _DONE, None
+
+
+def _feed(items, outbox, stop):
+    try:
+        for item in items:
+            if not _put(outbox, (item, None), stop):
+                return
+        _put(outbox, (_DONE, None), stop)
+    except Exception as e:
+        _put(outbox, (_DONE, e), stop)
+
+
+def _work(fn, inbox, outbox, stop):
+    while True:
+        item, error = _get(inbox, stop)
+        if item is _DONE:
+            _put(outbox, (_DONE, error), stop)
+            return
+        try:
+            result = fn(item)
+        except Exception as e:
+            _put(outbox, (_DONE, e), stop)
+            return
+        if not _put(outbox, (result, None), stop):
+            return
+
+
+def pipelined(items, stages, queue_size=2):
+    """
+    Yield fn_k(...fn_1(item)) for every item, with the iteration of `items` and every stage running
+    in its own thread, joined by queues of at most `queue_size` items. Item N+1 is thus in stage 1
+    while item N is in stage 2 and the caller works on item N-1. The first exception of any stage is
+    re-raised in the caller, and the stages stop once the caller stops iterating. Closing the
+    generator waits for the stage that is still busy with an item, so nothing the stages create
+    outlives it (e.g. a clip still being synthesized when the caller gives up).
+    """
+    stop = threading.Event()
+    queues = [queue.Queue(queue_size) for _ in range(len(stages) + 1)]
+    threads = [threading.Thread(target=_feed, args=(items, queues[0], stop), daemon=True)]
+    threads += [threading.Thread(target=_work, args=(fn, queues[i], queues[i + 1], stop), daemon=True)
+                for i, fn in enumerate(stages)]
+    for thread in threads:
+        thread.start()
+
+    try:
+        while True:
+            item, error = queues[-1].get()
+            if item is _DONE:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
@@ -0,0 +1,65 @@
+import os
+
+import cv2
+import numpy as np
+from scipy.io import savemat
+
+import src.utils.audio as audio
+
+
+class PipelineContext():
+    """ Intermediate data of one generation, handed from stage to stage in memory.
+
+    CropAndExtract.extract fills `source` (3DMM coefficients, cropped image, landmarks and crop
+    info), get_data reads the source coefficients and the `wav` decoded once, Audio2Coeff.generate
+    fills `coeffs` (T x 70) and get_facerender_data builds the render batch from both. Nothing is
+    written to disk unless `save_dir` is set, then the .png/.mat files of the file based pipeline
+    are kept there as well (e.g. for --verbose).
+    """
+
+    def __init__(self, pic_path, audio_path=None, save_dir=None, source=None):
+        self.pic_path = pic_path
+        self.audio_path = audio_path
+        self.pic_name = os.path.splitext(os.path.basename(pic_path))[0]
+        self.audio_name = os.path.splitext(os.path.basename(audio_path))[0] if audio_path else 'idle'
+        self.save_dir = save_dir
+        self.source = None
+        self.wav = None
+        self.coeffs = None
+        if source is not None:
+            self.set_source(source)
+
+    @property
+    def crop_info(self):
+        return self.source['crop_info']
+
+    @property
+    def video_name(self):
+        return '%s##%s' % (self.pic_name, self.audio_name)
+
+    def load_wav(self, sr=16000):
+        """ The driving audio, decoded and resampled on first use, whatever its format. """
+        if self.wav is None:
+            self.wav = audio.load_wav(self.audio_path, sr)
+        return self.wav
+
+    def pcm(self, num_frames, fps=25, sr=16000):
+        """ int16 samples of exactly `num_frames` video frames, zero padded, to pipe into the muxer. """
+        num_samples = num_frames * sr // fps
+        pcm = audio.to_pcm16(self.load_wav(sr)[:num_samples])
+        return np.pad(pcm, (0, num_samples - len(pcm)))
+
+    def set_source(self, source):
+        self.source = source
+        if self.save_dir is not None:
+            first_frame_dir = os.path.join(self.save_dir, 'first_frame_dir')
+            os.makedirs(first_frame_dir, exist_ok=True)
+            cv2.imwrite(os.path.join(first_frame_dir, self.pic_name + '.png'), cv2.cvtColor(source['image'], cv2.COLOR_RGB2BGR))
+            np.savetxt(os.path.join(first_frame_dir, self.pic_name + '_landmarks.txt'), source['landmarks'].reshape(-1))
+            savemat(os.path.join(first_frame_dir, self.pic_name + '.mat'),
+                    {'coeff_3dmm': source['coeff_3dmm'], 'full_3dmm': source['full_3dmm']})
+
+    def set_coeffs(self, coeffs):
+        self.coeffs = coeffs
+        if self.save_dir is not None:
+            savemat(os.path.join(self.save_dir, self.video_name + '.mat'), {'coeff_3dmm': coeffs})
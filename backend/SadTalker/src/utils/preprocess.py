@@ -4,8 +4,6 @@ from tqdm import tqdm
 from PIL import Image 
 
 # 3dmm extraction
-import safetensors
-import safetensors.torch 
 from src.face3d.util.preprocess import align_img
 from src.face3d.util.load_mats import load_lm3d
 from src.face3d.models import networks
@@ -16,7 +14,7 @@ from src.utils.croper import Preprocesser
 
 import warnings
 
-from src.utils.safetensor_helper import load_x_from_safetensor 
+from src.utils.safetensor_helper import load_checkpoint
 warnings.filterwarnings("ignore")
 
 def split_coeff(coeffs):
@@ -44,14 +42,14 @@ def split_coeff(coeffs):
 
 
 class CropAndExtract():
-    def __init__(self, sadtalker_path, device):
+    def __init__(self, sadtalker_path, device, avatar_cache=None):
 
         self.propress = Preprocesser(device)
         self.net_recon = networks.define_net_recon(net_recon='resnet50', use_last_fc=False, init_path='').to(device)
         
         if sadtalker_path['use_safetensor']:
-            checkpoint = safetensors.torch.load_file(sadtalker_path['checkpoint'])    
-            self.net_recon.load_state_dict(load_x_from_safetensor(checkpoint, 'face_3drecon'))
+            checkpoint = load_checkpoint(sadtalker_path['checkpoint'])
+            self.net_recon.load_state_dict(checkpoint.view('face_3drecon'))
         else:
             checkpoint = torch.load(sadtalker_path['path_of_net_recon_model'], map_location=torch.device(device))    
             self.net_recon.load_state_dict(checkpoint['net_recon'])
@@ -59,7 +57,26 @@ class CropAndExtract():
         self.net_recon.eval()
         self.lm3d_std = load_lm3d(sadtalker_path['dir_of_BFM_fitting'])
         self.device = device
-    
+        self.avatar_cache = avatar_cache
+
+    def register_avatar(self, input_path, crop_or_resize='crop', pic_size=256):
+        """ Preprocess a source image ahead of time so later generate() calls are served from the avatar cache. """
+        if self.avatar_cache is None:
+            raise ValueError('register_avatar needs an avatar cache')
+
+        key = self.avatar_cache.key(input_path, crop_or_resize, pic_size)
+        if key not in self.avatar_cache:
+            if self.extract(input_path, crop_or_resize, source_image_flag=True, pic_size=pic_size) is None:
+                return None
+        return key
+
+    @staticmethod
+    def save(result, png_path, landmarks_path, coeff_path):
+        """ Write an extract() result as the .png, landmarks .txt and .mat files of generate(). """
+        cv2.imwrite(png_path, cv2.cvtColor(result['image'], cv2.COLOR_RGB2BGR))
+        np.savetxt(os.path.splitext(landmarks_path)[0]+'.txt', result['landmarks'].reshape(-1))
+        savemat(coeff_path, {'coeff_3dmm': result['coeff_3dmm'], 'full_3dmm': result['full_3dmm']})
+
     def generate(self, input_path, save_dir, crop_or_resize='crop', source_image_flag=False, pic_size=256):
 
         pic_name = os.path.splitext(os.path.split(input_path)[-1])[0]  
@@ -68,6 +85,27 @@ class CropAndExtract():
         coeff_path =  os.path.join(save_dir, pic_name+'.mat')  
         png_path =  os.path.join(save_dir, pic_name+'.png')  
 
+        result = self.extract(input_path, crop_or_resize, source_image_flag, pic_size)
+        if result is None:
+            return None, None
+        self.save(result, png_path, landmarks_path, coeff_path)
+        return coeff_path, png_path, result['crop_info']
+
+    def extract(self, input_path, crop_or_resize='crop', source_image_flag=False, pic_size=256):
+        """
+        Crop and 3DMM extraction in memory. Returns a dict with the 'coeff_3dmm' and 'full_3dmm'
+        coefficients per frame, the last cropped frame as uint8 RGB 'image', the 'landmarks' and the
+        'crop_info', or None when no face is found.
+        """
+        # a single source image is served from the avatar cache when possible
+        cache_key = None
+        if self.avatar_cache is not None and source_image_flag and os.path.isfile(input_path) \
+                and input_path.split('.')[-1] in ['jpg', 'png', 'jpeg']:
+            cache_key = self.avatar_cache.key(input_path, crop_or_resize, pic_size)
+            entry = self.avatar_cache.get(cache_key)
+            if entry is not None:
+                return entry
+
         #load input
         if not os.path.isfile(input_path):
             raise ValueError('input_path must be a valid path to video/image file')
@@ -113,58 +151,50 @@ class CropAndExtract():
         frames_pil = [Image.fromarray(cv2.resize(frame,(pic_size, pic_size))) for frame in x_full_frames]
         if len(frames_pil) == 0:
             print('No face is detected in the input file')
-            return None, None
-
-        # save crop info
-        for frame in frames_pil:
-            cv2.imwrite(png_path, cv2.cvtColor(np.array(frame), cv2.COLOR_RGB2BGR))
+            return None
 
         # 2. get the landmark according to the detected face. 
-        if not os.path.isfile(landmarks_path): 
-            lm = self.propress.predictor.extract_keypoint(frames_pil, landmarks_path)
-        else:
-            print(' Using saved landmarks.')
-            lm = np.loadtxt(landmarks_path).astype(np.float32)
-            lm = lm.reshape([len(x_full_frames), -1, 2])
-
-        if not os.path.isfile(coeff_path):
-            # load 3dmm paramter generator from Deep3DFaceRecon_pytorch 
-            video_coeffs, full_coeffs = [],  []
-            for idx in tqdm(range(len(frames_pil)), desc='3DMM Extraction In Video:'):
-                frame = frames_pil[idx]
-                W,H = frame.size
-                lm1 = lm[idx].reshape([-1, 2])
+        lm = self.propress.predictor.extract_keypoint(frames_pil)
+
+        # load 3dmm paramter generator from Deep3DFaceRecon_pytorch 
+        video_coeffs, full_coeffs = [],  []
+        for idx in tqdm(range(len(frames_pil)), desc='3DMM Extraction In Video:'):
+            frame = frames_pil[idx]
+            W,H = frame.size
+            lm1 = lm[idx].reshape([-1, 2])
+        
+            if np.mean(lm1) == -1:
+                lm1 = (self.lm3d_std[:, :2]+1)/2.
+                lm1 = np.concatenate(
+                    [lm1[:, :1]*W, lm1[:, 1:2]*H], 1
+                )
+            else:
+                lm1[:, -1] = H - 1 - lm1[:, -1]
+
+            trans_params, im1, lm1, _ = align_img(frame, lm1, self.lm3d_std)
+
+            trans_params = np.array([float(item) for item in np.hsplit(trans_params, 5)]).astype(np.float32)
+            im_t = torch.tensor(np.array(im1)/255., dtype=torch.float32).permute(2, 0, 1).to(self.device).unsqueeze(0)
             
-                if np.mean(lm1) == -1:
-                    lm1 = (self.lm3d_std[:, :2]+1)/2.
-                    lm1 = np.concatenate(
-                        [lm1[:, :1]*W, lm1[:, 1:2]*H], 1
-                    )
-                else:
-                    lm1[:, -1] = H - 1 - lm1[:, -1]
-
-                trans_params, im1, lm1, _ = align_img(frame, lm1, self.lm3d_std)
- 
-                trans_params = np.array([float(item) for item in np.hsplit(trans_params, 5)]).astype(np.float32)
-                im_t = torch.tensor(np.array(im1)/255., dtype=torch.float32).permute(2, 0, 1).to(self.device).unsqueeze(0)
-                
-                with torch.no_grad():
-                    full_coeff = self.net_recon(im_t)
-                    coeffs = split_coeff(full_coeff)
-
-                pred_coeff = {key:coeffs[key].cpu().numpy() for key in coeffs}
- 
-                pred_coeff = np.concatenate([
-                    pred_coeff['exp'], 
-                    pred_coeff['angle'],
-                    pred_coeff['trans'],
-                    trans_params[2:][None],
-                    ], 1)
-                video_coeffs.append(pred_coeff)
-                full_coeffs.append(full_coeff.cpu().numpy())
-
-            semantic_npy = np.array(video_coeffs)[:,0] 
-
-            savemat(coeff_path, {'coeff_3dmm': semantic_npy, 'full_3dmm': np.array(full_coeffs)[0]})
-
-        return coeff_path, png_path, crop_info
+            with torch.no_grad():
+                full_coeff = self.net_recon(im_t)
+                coeffs = split_coeff(full_coeff)
+
+            pred_coeff = {key:coeffs[key].cpu().numpy() for key in coeffs}
+
+            pred_coeff = np.concatenate([
+                pred_coeff['exp'], 
+                pred_coeff['angle'],
+                pred_coeff['trans'],
+                trans_params[2:][None],
+                ], 1)
+            video_coeffs.append(pred_coeff)
+            full_coeffs.append(full_coeff.cpu().numpy())
+
+        semantic_npy = np.array(video_coeffs)[:,0] 
+
+        result = {'coeff_3dmm': semantic_npy, 'full_3dmm': np.array(full_coeffs)[0],
+                  'image': np.array(frames_pil[-1]), 'landmarks': lm, 'crop_info': crop_info}
+        if cache_key is not None:
+            self.avatar_cache.put(cache_key, crop_info, result['image'], lm, semantic_npy, result['full_3dmm'])
+        return result
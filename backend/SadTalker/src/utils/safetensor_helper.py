@@ -1,3 +1,9 @@
+import os
+import threading
+import time
+from collections.abc import Mapping
+
+import safetensors
 
 
 def load_x_from_safetensor(checkpoint, key):
@@ -5,4 +11,96 @@ def load_x_from_safetensor(checkpoint, key):
     for k,v in checkpoint.items():
         if key in k:
             x_generator[k.replace(key+'.', '')] = v
-    return x_generator
\ No newline at end of file
+    return x_generator
+
+
+class SafetensorCheckpoint():
+    """ A safetensors file memory-mapped once and shared by every component that needs it.
+
+    Tensors are only read when a view is actually loaded into a model, so opening the
+    checkpoint costs a header parse rather than a full copy of every weight.
+    """
+
+    def __init__(self, path):
+        start = time.time()
+        self.path = path
+        self._handle = safetensors.safe_open(path, framework='pt', device='cpu')
+        self._keys = list(self._handle.keys())
+        self._lock = threading.Lock()
+
+        self.open_time = time.time() - start
+        self.load_time = 0.
+        self.loaded_bytes = 0
+        self.loaded_tensors = 0
+
+    def keys(self):
+        return self._keys
+
+    def get_tensor(self, key):
+        start = time.time()
+        tensor = self._handle.get_tensor(key)
+        with self._lock:
+            self.load_time += time.time() - start
+            self.loaded_bytes += tensor.numel() * tensor.element_size()
+            self.loaded_tensors += 1
+        return tensor
+
+    def view(self, prefix):
+        return CheckpointView(self, prefix)
+
+    def stats(self):
+        return {'path': self.path,
+                'file_bytes': os.path.getsize(self.path),
+                'open_time': self.open_time,
+                'load_time': self.load_time,
+                'loaded_bytes': self.loaded_bytes,
+                'loaded_tensors': self.loaded_tensors}
+
+
+class CheckpointView(Mapping):
+    """ Lazy state dict of the tensors under `prefix.`, with the prefix stripped. """
+
+    def __init__(self, checkpoint, prefix):
+        self.checkpoint = checkpoint
+        self.prefix = prefix + '.'
+        self._keys = [k[len(self.prefix):] for k in checkpoint.keys() if k.startswith(self.prefix)]
+        self._key_set = set(self._keys)
+
+    def __getitem__(self, key):
+        if key not in self._key_set:
+            raise KeyError(key)
+        return self.checkpoint.get_tensor(self.prefix + key)
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def copy(self):
+        # older torch versions call state_dict.copy() inside load_state_dict
+        return dict(self.items())
+
+
+_checkpoints = {}
+_checkpoints_lock = threading.Lock()
+
+def load_checkpoint(path):
+    """ Open `path` once per process and hand the same SafetensorCheckpoint to every caller. """
+    path = os.path.abspath(path)
+    with _checkpoints_lock:
+        if path not in _checkpoints:
+            _checkpoints[path] = SafetensorCheckpoint(path)
+        return _checkpoints[path]
+
+def release_checkpoint(path=None):
+    """ Drop the mapping of `path` (or of every checkpoint) once all components are built. """
+    with _checkpoints_lock:
+        if path is None:
+            _checkpoints.clear()
+        else:
+            _checkpoints.pop(os.path.abspath(path), None)
+
+def checkpoint_stats():
+    with _checkpoints_lock:
+        return [checkpoint.stats() for checkpoint in _checkpoints.values()]
@@ -1,9 +1,15 @@
+import queue
 import shutil
+import subprocess
+import tempfile
+import threading
 import uuid
+import wave
 
 import os
 
 import cv2
+import numpy as np
 
 def load_video_to_cv2(input_path):
     video_stream = cv2.VideoCapture(input_path)
@@ -38,4 +44,169 @@ def save_video_with_watermark(video, audio, save_path, watermark=False):
 
         cmd = r'ffmpeg -y -hide_banner -loglevel error -i "%s" -i "%s" -filter_complex "[1]scale=100:-1[wm];[0][wm]overlay=(main_w-overlay_w)-10:10" "%s"' % (temp_file, watarmark_path, save_path)
         os.system(cmd)
-        os.remove(temp_file)
\ No newline at end of file
+        os.remove(temp_file)
+
+
+class VideoStreamWriter():
+    """ Encode RGB frames into an mp4 with a single ffmpeg process.
+
+    Frames are piped to ffmpeg as raw video as soon as they are written and the audio is muxed
+    in the same pass, so memory stays constant and nothing is written besides `save_path`.
+    The audio is either a file (`audio_path`) or int16 mono samples (`audio_pcm`, one array or an
+    iterable of chunks that may still be produced while frames are written) fed through a
+    second pipe. `duration` trims the output, e.g. to frame_num / fps.
+
+    With `save_path=None` the output is a fragmented mp4 (one fragment per second) on ffmpeg's
+    stdout instead, collected with `read_output()` while frames are still being written.
+    """
+
+    def __init__(self, save_path, fps=25, audio_path=None, audio_pcm=None, sample_rate=16000, duration=None, crf=18, preset='veryfast'):
+        self.save_path = save_path
+        self.fps = fps
+        self.audio_path = audio_path
+        self.audio_pcm = audio_pcm
+        self.sample_rate = sample_rate
+        self.duration = duration
+        self.crf = crf
+        self.preset = preset
+        self.frames = 0
+
+        self._proc = None
+        self._audio_thread = None
+        self._audio_tmp = None
+        self._output = queue.Queue()
+        self._output_thread = None
+
+    def _open(self, width, height):
+        cmd = ['ffmpeg', '-y', '-hide_banner', '-loglevel', 'error',
+               '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', '%dx%d' % (width, height), '-r', str(self.fps), '-i', 'pipe:0']
+
+        pass_fds, audio_fd = (), None
+        if self.audio_path is not None:
+            cmd += ['-i', self.audio_path]
+        elif self.audio_pcm is not None:
+            pcm = self.audio_pcm
+            if os.name == 'nt':
+                # no fd inheritance on windows, fall back to a temp wav
+                if not isinstance(pcm, np.ndarray):
+                    raise ValueError('chunked audio_pcm needs fd inheritance, which windows does not have')
+                self._audio_tmp = os.path.join(tempfile.gettempdir(), str(uuid.uuid4()) + '.wav')
+                with wave.open(self._audio_tmp, 'wb') as f:
+                    f.setnchannels(1)
+                    f.setsampwidth(2)
+                    f.setframerate(self.sample_rate)
+                    f.writeframes(np.ascontiguousarray(pcm, dtype=np.int16).tobytes())
+                cmd += ['-i', self._audio_tmp]
+            else:
+                read_fd, audio_fd = os.pipe()
+                pass_fds = (read_fd,)
+                cmd += ['-f', 's16le', '-ar', str(self.sample_rate), '-ac', '1', '-i', 'pipe:%d' % read_fd]
+
+        cmd += ['-map', '0:v']
+        if self.audio_path is not None or self.audio_pcm is not None:
+            cmd += ['-map', '1:a', '-c:a', 'aac']
+        # libx264 with yuv420p needs even dimensions
+        cmd += ['-c:v', 'libx264', '-preset', self.preset, '-crf', str(self.crf), '-pix_fmt', 'yuv420p',
+                '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2']
+        if self.duration is not None:
+            cmd += ['-t', '%.3f' % self.duration]
+        if self.save_path is None:
+            cmd += ['-tune', 'zerolatency', '-g', str(self.fps),
+                    '-movflags', 'frag_keyframe+empty_moov+default_base_moof', '-f', 'mp4', 'pipe:1']
+        else:
+            # moov atom up front, so players can start before the whole file is fetched
+            cmd += ['-movflags', '+faststart', self.save_path]
+
+        stdout = subprocess.PIPE if self.save_path is None else None
+        self._proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=stdout, stderr=subprocess.PIPE, pass_fds=pass_fds)
+        if stdout is not None:
+            self._output_thread = threading.Thread(target=_read_pipe, args=(self._proc.stdout, self._output), daemon=True)
+            self._output_thread.start()
+        if audio_fd is not None:
+            os.close(pass_fds[0])
+            self._audio_thread = threading.Thread(target=_write_pipe, args=(audio_fd, pcm), daemon=True)
+            self._audio_thread.start()
+
+    def write(self, frame):
+        """ Append one HxWx3 uint8 RGB frame. """
+        if self._proc is None:
+            self._open(frame.shape[1], frame.shape[0])
+        try:
+            self._proc.stdin.write(np.ascontiguousarray(frame, dtype=np.uint8).data)
+        except BrokenPipeError:
+            self.close()
+            raise RuntimeError('ffmpeg exited early while writing %s' % self.save_path)
+        self.frames += 1
+
+    def write_batch(self, frames):
+        for frame in frames:
+            self.write(frame)
+
+    def read_output(self):
+        """ The encoded bytes produced since the last call (only with save_path=None). """
+        data = []
+        while True:
+            try:
+                data.append(self._output.get_nowait())
+            except queue.Empty:
+                return b''.join(data)
+
+    def close(self):
+        """ Finish the file. A chunked `audio_pcm` has to be exhausted for ffmpeg to exit. """
+        self._finish()
+
+    def _finish(self, wait_audio=True):
+        if self._proc is None:
+            return
+        proc, self._proc = self._proc, None
+        try:
+            proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        err = proc.stderr.read()
+        proc.wait()
+        if self._output_thread is not None:
+            self._output_thread.join()
+        if self._audio_thread is not None and wait_audio:
+            self._audio_thread.join()
+        if self._audio_tmp is not None:
+            os.remove(self._audio_tmp)
+        if proc.returncode != 0:
+            raise RuntimeError('ffmpeg failed writing %s: %s' % (self.save_path, err.decode(errors='ignore').strip()))
+
+    def abort(self):
+        """ Kill ffmpeg and remove the partial output. """
+        if self._proc is not None:
+            self._proc.kill()
+            try:
+                # the audio thread may be blocked on its chunk iterator, its next write fails on the closed pipe
+                self._finish(wait_audio=False)
+            except RuntimeError:
+                pass
+        if self.save_path is not None and os.path.isfile(self.save_path):
+            os.remove(self.save_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def _read_pipe(pipe, output):
+    for block in iter(lambda: pipe.read1(1 << 16), b''):
+        output.put(block)
+
+def _write_pipe(fd, pcm):
+    chunks = [pcm] if isinstance(pcm, np.ndarray) else pcm
+    with os.fdopen(fd, 'wb') as f:
+        try:
+            for chunk in chunks:
+                f.write(np.ascontiguousarray(chunk, dtype=np.int16).tobytes())
+                f.flush()
+        except BrokenPipeError:
+            # ffmpeg stops reading once the output duration is reached
+            pass
@@ -0,0 +1,49 @@
+import librosa
+import numpy as np
+import pytest
+
+from src.utils import audio
+from src.utils.hparams import hparams as hp
+
+
+def push_in_chunks(stream, wav, seed=0):
+    """ The mel frames of `wav` fed to `stream` in random sized chunks, finish() included. """
+    rng = np.random.default_rng(seed)
+    mels, i = [], 0
+    while i < len(wav):
+        n = int(rng.integers(1, 3000))
+        mels.append(stream.push(wav[i:i + n]))
+        i += n
+    mels.append(stream.finish())
+    return np.concatenate(mels, axis=1)
+
+
+def test_streaming_mel_matches_the_whole_waveform():
+    wav = np.random.default_rng(1).standard_normal(16000 * 2 + 123) * 0.1
+    mel = push_in_chunks(audio.StreamingMelSpectrogram(), wav)
+    np.testing.assert_allclose(mel, audio.melspectrogram(wav), atol=1e-9)
+
+
+def test_streaming_mel_int16_pcm():
+    wav = np.random.default_rng(2).standard_normal(8000) * 0.1
+    pcm = audio.to_pcm16(wav)
+    mel = push_in_chunks(audio.StreamingMelSpectrogram(), pcm)
+    np.testing.assert_allclose(mel, audio.melspectrogram(pcm / 32768.), atol=1e-9)
+
+
+@pytest.mark.parametrize('pad_mode', ['constant', 'reflect'])
+def test_streaming_mel_pad_modes(pad_mode):
+    # the default pad mode of librosa.stft changed in 0.10, both are followed
+    wav = np.random.default_rng(3).standard_normal(5000) * 0.1
+    stream = audio.StreamingMelSpectrogram()
+    stream.pad_mode = pad_mode
+    D = librosa.stft(y=audio.preemphasis(wav, hp.preemphasis, hp.preemphasize), n_fft=hp.n_fft,
+                     hop_length=audio.get_hop_size(), win_length=hp.win_size, pad_mode=pad_mode)
+    np.testing.assert_allclose(push_in_chunks(stream, wav, seed=4), audio._stft_to_mel(D), atol=1e-9)
+
+
+def test_streaming_mel_shorter_than_a_frame():
+    wav = np.random.default_rng(5).standard_normal(300) * 0.1
+    stream = audio.StreamingMelSpectrogram()
+    mel = np.concatenate([stream.push(wav[:100]), stream.push(wav[100:]), stream.finish()], axis=1)
+    np.testing.assert_allclose(mel, audio.melspectrogram(wav), atol=1e-9)
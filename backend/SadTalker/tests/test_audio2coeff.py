@@ -0,0 +1,110 @@
+import os
+
+import torch
+from yacs.config import CfgNode as CN
+
+from src.audio2exp_models.audio2exp import Audio2Exp
+from src.audio2exp_models.networks import SimpleWrapperV2
+from src.audio2pose_models.audio2pose import Audio2Pose
+
+CONFIG_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src', 'config')
+
+
+def audio2exp_loop(netG, batch):
+    """ Audio2Exp.test before the batched chunks: ten frames per forward pass. """
+    mel_input = batch['indiv_mels']
+    exp_coeff_pred = []
+    for i in range(0, mel_input.shape[1], 10):
+        current_mel_input = mel_input[:, i:i+10]
+        ref = batch['ref'][:, :, :64][:, i:i+10]
+        ratio = batch['ratio_gt'][:, i:i+10]
+        audiox = current_mel_input.view(-1, 1, 80, 16)
+        exp_coeff_pred += [netG(audiox, ref, ratio)]
+    return torch.cat(exp_coeff_pred, axis=1)
+
+
+def audio_batch(num_frames, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    return {'indiv_mels': torch.randn(1, num_frames, 1, 80, 16, generator=generator),
+            'ref': torch.randn(1, num_frames, 70, generator=generator),
+            'ratio_gt': torch.rand(1, num_frames, 1, generator=generator)}
+
+
+def test_audio2exp_chunks_match_the_10_frame_loop():
+    torch.manual_seed(0)
+    netG = SimpleWrapperV2().eval()
+    audio2exp = Audio2Exp(netG, None, 'cpu').eval()
+    batch = audio_batch(57)
+    with torch.no_grad():
+        expected = audio2exp_loop(netG, batch)
+        for chunk_size in (None, 7, 256):
+            audio2exp.chunk_size = chunk_size
+            torch.testing.assert_close(audio2exp.test(batch)['exp_coeff_pred'], expected, rtol=1e-4, atol=1e-5)
+
+
+def audio2pose_loop(model, x, seed):
+    """ Audio2Pose.test before the windows were batched, window i drawing its z from seed + i. """
+    ref = x['ref']
+    batch = {'ref': x['ref'][:, 0, -6:], 'class': x['class']}
+    bs = ref.shape[0]
+    indiv_mels_use = x['indiv_mels'][:, 1:]
+    num_frames = int(x['num_frames']) - 1
+    div = num_frames // model.seq_len
+    re = num_frames % model.seq_len
+    pose_motion_pred_list = [torch.zeros(batch['ref'].unsqueeze(1).shape, dtype=batch['ref'].dtype)]
+
+    def z(i):
+        return torch.randn(bs, model.latent_dim, generator=torch.Generator().manual_seed(seed + i))
+
+    for i in range(div):
+        batch['z'] = z(i)
+        batch['audio_emb'] = model.audio_encoder(indiv_mels_use[:, i*model.seq_len:(i+1)*model.seq_len])
+        batch = model.netG.test(batch)
+        pose_motion_pred_list.append(batch['pose_motion_pred'])
+    if re != 0:
+        batch['z'] = z(div)
+        audio_emb = model.audio_encoder(indiv_mels_use[:, -1*model.seq_len:])
+        if audio_emb.shape[1] != model.seq_len:
+            pad_dim = model.seq_len - audio_emb.shape[1]
+            audio_emb = torch.cat([audio_emb[:, :1].repeat(1, pad_dim, 1), audio_emb], 1)
+        batch['audio_emb'] = audio_emb
+        batch = model.netG.test(batch)
+        pose_motion_pred_list.append(batch['pose_motion_pred'][:, -1*re:, :])
+    return ref[:, :1, -6:] + torch.cat(pose_motion_pred_list, dim=1)
+
+
+def audio2pose_model():
+    with open(os.path.join(CONFIG_DIR, 'auido2pose.yaml')) as f:
+        cfg = CN.load_cfg(f)
+    torch.manual_seed(0)
+    return Audio2Pose(cfg, None, device='cpu').eval()
+
+
+def pose_batch(num_frames):
+    batch = audio_batch(num_frames)
+    batch['num_frames'] = num_frames
+    batch['class'] = torch.LongTensor([3])
+    return batch
+
+
+def test_audio2pose_windows_match_the_per_window_loop():
+    model = audio2pose_model()
+    # whole windows only, whole windows and an overlapping tail, a single padded window
+    for num_frames in (65, 75, 20):
+        x = pose_batch(num_frames)
+        with torch.no_grad():
+            pose_pred = model.test(x, seed=7)['pose_pred']
+            expected = audio2pose_loop(model, x, seed=7)
+        assert pose_pred.shape == (1, num_frames, 6)
+        torch.testing.assert_close(pose_pred, expected, rtol=1e-4, atol=1e-5)
+
+
+def test_audio2pose_window_ranges_match_a_full_run():
+    model = audio2pose_model()
+    x = pose_batch(120)
+    num_windows = len(model.window_starts(x['num_frames']))
+    with torch.no_grad():
+        full = model.predict_windows(x, 0, num_windows, seed=7)['pose_motion_pred']
+        for first, last in [(0, 1), (1, 3), (num_windows - 1, num_windows)]:
+            part = model.predict_windows(x, first, last, seed=7)['pose_motion_pred']
+            torch.testing.assert_close(part, full[:, first:last], rtol=1e-4, atol=1e-5)
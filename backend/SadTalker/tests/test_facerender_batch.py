@@ -0,0 +1,36 @@
+import numpy as np
+
+from src.generate_facerender_batch import get_semantic_windows
+
+
+def transform_semantic_target(coeff_3dmm, frame_index, semantic_radius, wrap=False):
+    """ The per-frame window get_semantic_windows replaced, wrapping around instead of clamping if asked. """
+    num_frames = coeff_3dmm.shape[0]
+    seq = list(range(frame_index - semantic_radius, frame_index + semantic_radius + 1))
+    if wrap:
+        index = [item % num_frames for item in seq]
+    else:
+        index = [min(max(item, 0), num_frames - 1) for item in seq]
+    return coeff_3dmm[index, :].transpose(1, 0)
+
+
+def semantic_windows_loop(coeff_3dmm, semantic_radius, num_windows=None, wrap=False):
+    """ The loop of get_facerender_data, the batch padded with copies of the last window. """
+    windows = [transform_semantic_target(coeff_3dmm, i, semantic_radius, wrap) for i in range(coeff_3dmm.shape[0])]
+    windows += [windows[-1]] * ((num_windows or 0) - len(windows))
+    return np.asarray(windows)
+
+
+def test_semantic_windows_match_the_loop():
+    rng = np.random.default_rng(0)
+    for num_frames in (1, 5, 40):
+        coeffs = rng.standard_normal((num_frames, 70)).astype(np.float32)
+        for num_windows in (None, num_frames, num_frames + 3):
+            windows = get_semantic_windows(coeffs, 13, num_windows)
+            np.testing.assert_array_equal(windows, semantic_windows_loop(coeffs, 13, num_windows))
+
+
+def test_semantic_windows_wrap():
+    coeffs = np.random.default_rng(1).standard_normal((30, 70)).astype(np.float32)
+    np.testing.assert_array_equal(get_semantic_windows(coeffs, 13, mode='wrap'),
+                                  semantic_windows_loop(coeffs, 13, wrap=True))
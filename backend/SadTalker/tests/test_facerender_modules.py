@@ -0,0 +1,62 @@
+import torch
+import torch.nn.functional as F
+
+from src.facerender.modules.dense_motion import DenseMotionNetwork
+from src.facerender.modules.keypoint_detector import KPDetector
+from src.facerender.modules.util import kp2gaussian, make_coordinate_grid
+
+
+def kp2gaussian_repeat(kp, spatial_size, kp_variance):
+    """ kp2gaussian before it became separable: the grid repeated per keypoint. """
+    mean = kp['value']
+    coordinate_grid = make_coordinate_grid(spatial_size, mean.type())
+    number_of_leading_dimensions = len(mean.shape) - 1
+    shape = (1,) * number_of_leading_dimensions + coordinate_grid.shape
+    coordinate_grid = coordinate_grid.view(*shape)
+    repeats = mean.shape[:number_of_leading_dimensions] + (1, 1, 1, 1)
+    coordinate_grid = coordinate_grid.repeat(*repeats)
+    shape = mean.shape[:number_of_leading_dimensions] + (1, 1, 1, 3)
+    mean = mean.view(*shape)
+    mean_sub = (coordinate_grid - mean)
+    return torch.exp(-0.5 * (mean_sub ** 2).sum(-1) / kp_variance)
+
+
+def test_kp2gaussian_matches_the_repeated_grid():
+    torch.manual_seed(0)
+    kp = {'value': torch.rand(4, 15, 3) * 2.2 - 1.1}
+    for spatial_size in [(16, 64, 64), (8, 16, 32)]:
+        torch.testing.assert_close(kp2gaussian(kp, spatial_size, 0.01), kp2gaussian_repeat(kp, spatial_size, 0.01),
+                                   rtol=1e-5, atol=1e-6)
+
+
+def test_gaussian2kp_matches_the_weighted_sum():
+    torch.manual_seed(1)
+    heatmap = torch.softmax(torch.randn(2, 15, 16 * 8 * 8), dim=2).view(2, 15, 16, 8, 8)
+    grid = make_coordinate_grid(heatmap.shape[2:], heatmap.type()).unsqueeze_(0).unsqueeze_(0)
+    expected = (heatmap.unsqueeze(-1) * grid).sum(dim=(2, 3, 4))
+    # gaussian2kp does not use the detector's weights
+    torch.testing.assert_close(KPDetector.gaussian2kp(None, heatmap)['value'], expected, rtol=1e-5, atol=1e-6)
+
+
+def deformed_feature_repeat(feature, sparse_motions, num_kp):
+    """ create_deformed_feature before the sampling was stacked: the feature volume repeated per keypoint. """
+    bs, _, d, h, w = feature.shape
+    feature_repeat = feature.unsqueeze(1).unsqueeze(1).repeat(1, num_kp+1, 1, 1, 1, 1, 1)
+    feature_repeat = feature_repeat.view(bs * (num_kp+1), -1, d, h, w)
+    sparse_motions = sparse_motions.view((bs * (num_kp+1), d, h, w, -1))
+    sparse_deformed = F.grid_sample(feature_repeat, sparse_motions)
+    return sparse_deformed.view((bs, num_kp+1, -1, d, h, w))
+
+
+def test_deformed_feature_matches_the_repeated_volume():
+    torch.manual_seed(2)
+    num_kp, bs = 15, 3
+    dense_motion = DenseMotionNetwork(block_expansion=8, num_blocks=2, max_features=64, num_kp=num_kp, feature_channel=8,
+                                      reshape_depth=8, compress=4).eval()
+    kp_source = {'value': (torch.rand(1, num_kp, 3) * 2 - 1).repeat(bs, 1, 1)}
+    kp_driving = {'value': kp_source['value'] + 0.1 * torch.randn(bs, num_kp, 3)}
+    # one source shared by the batch, as rendered, and one source per frame
+    for feature in [torch.randn(1, 4, 8, 16, 16), torch.randn(bs, 4, 8, 16, 16)]:
+        sparse_motions = dense_motion.create_sparse_motions(feature, kp_driving, kp_source)
+        expected = deformed_feature_repeat(feature.expand(bs, *feature.shape[1:]), sparse_motions, num_kp)
+        torch.testing.assert_close(dense_motion.create_deformed_feature(feature, sparse_motions), expected, rtol=0, atol=0)
@@ -0,0 +1,45 @@
+import torch
+
+from src.facerender.freeze import freeze_checked
+from src.facerender.modules.generator import OcclusionAwareSPADEGenerator
+from src.facerender.modules.keypoint_detector import KPDetector, HEEstimator
+
+# facerender.yaml with fewer channels and blocks, small enough for 128px and 64px images on a CPU
+COMMON = dict(num_kp=15, image_channel=3, feature_channel=8, estimate_jacobian=False)
+
+
+def randomize_batch_norms(model):
+    """ Freshly built batch norms are identities, give them statistics like a trained checkpoint's. """
+    for module in model.modules():
+        if isinstance(module, torch.nn.modules.batchnorm._BatchNorm):
+            module.running_mean.uniform_(-0.5, 0.5)
+            module.running_var.uniform_(0.5, 2)
+            if module.affine:
+                module.weight.data.uniform_(0.5, 1.5)
+                module.bias.data.uniform_(-0.5, 0.5)
+    return model.eval()
+
+
+def test_frozen_models_match_the_loaded_ones():
+    torch.manual_seed(0)
+    kp_extractor = randomize_batch_norms(KPDetector(temperature=0.1, block_expansion=8, max_features=256, scale_factor=0.25,
+                                                    num_blocks=5, reshape_channel=4096, reshape_depth=16, **COMMON))
+    he_estimator = randomize_batch_norms(HEEstimator(block_expansion=8, max_features=256, num_bins=66, **COMMON))
+    generator = randomize_batch_norms(OcclusionAwareSPADEGenerator(
+        block_expansion=64, max_features=128, num_down_blocks=2, reshape_channel=8, reshape_depth=16, num_resblocks=2,
+        estimate_occlusion_map=True, **COMMON,
+        dense_motion_params=dict(block_expansion=8, max_features=256, num_blocks=3, reshape_depth=16, compress=4)))
+
+    image = torch.rand(1, 3, 128, 128)
+    with torch.no_grad():
+        kp_source = kp_extractor(image)
+        kp_driving = {'value': kp_source['value'] + 0.02 * torch.randn_like(kp_source['value'])}
+
+    atol = 1e-3
+    for model, run in [(kp_extractor, lambda m: m(image)),
+                       (he_estimator, lambda m: m(image)),
+                       (generator, lambda m: m(image[:, :, ::2, ::2], kp_driving=kp_driving, kp_source=kp_source))]:
+        stats = freeze_checked(model, run, atol)
+        assert stats['folded_bn'] > 0
+        assert stats['max_abs_diff'] < atol
+    assert stats['spectral_norm'] > 0
@@ -0,0 +1,47 @@
+import numpy as np
+
+from src.generate_batch import MelWindowStream, crop_pad_audio, get_mel_windows, parse_audio_length
+from src.utils import audio
+
+
+def mel_windows_loop(orig_mel, num_frames, fps=25, syncnet_mel_step_size=16):
+    """ The per-frame loop get_mel_windows replaced. """
+    indiv_mels = []
+    for i in range(num_frames):
+        start_idx = int(80. * ((i - 2) / float(fps)))
+        seq = [min(max(item, 0), orig_mel.shape[0] - 1) for item in range(start_idx, start_idx + syncnet_mel_step_size)]
+        indiv_mels.append(orig_mel[seq, :].T)
+    return np.asarray(indiv_mels)
+
+
+def test_mel_windows_match_the_loop():
+    rng = np.random.default_rng(0)
+    for num_frames in (1, 3, 40):
+        orig_mel = rng.standard_normal((int(num_frames * 3.2) + 1, 80)).astype(np.float32)
+        np.testing.assert_array_equal(get_mel_windows(orig_mel, num_frames), mel_windows_loop(orig_mel, num_frames))
+
+
+def test_mel_windows_into_out():
+    orig_mel = np.random.default_rng(1).standard_normal((65, 80)).astype(np.float32)
+    out = np.empty((20, 80, 16), dtype=np.float32)
+    get_mel_windows(orig_mel, 20, out=out)
+    np.testing.assert_array_equal(out, mel_windows_loop(orig_mel, 20))
+
+
+def test_mel_window_stream_matches_get_data():
+    rng = np.random.default_rng(2)
+    wav = rng.standard_normal(16000 * 3 + 457) * 0.1
+    # get_data: cropped to whole video frames, then the windows of the whole mel spectrogram
+    wav_length, num_frames = parse_audio_length(len(wav), 16000, 25)
+    expected = get_mel_windows(audio.melspectrogram(crop_pad_audio(wav, wav_length)).T, num_frames)
+
+    stream = MelWindowStream()
+    windows, i = [], 0
+    while i < len(wav):
+        n = int(rng.integers(1, 4000))
+        windows.append(stream.push(wav[i:i + n]))
+        i += n
+    windows.append(stream.finish())
+    # windows come out as soon as their mel frames are final, before the end of the audio
+    assert sum(len(w) for w in windows[:-1]) > 0
+    np.testing.assert_allclose(np.concatenate(windows), expected, atol=1e-5)
@@ -14,6 +14,9 @@ const unlink = promisify(fs.unlink);
 // SadTalker Python Service Configuration
 const SADTALKER_SERVICE_URL = process.env.SADTALKER_SERVICE_URL || 'http://localhost:5001';
 const TEMP_DIR = path.join(__dirname, '..', 'temp', 'avatars');
+// How long the Python service holds a generate request before answering 202 with a job id (SADTALKER_JOB_TIMEOUT)
+const JOB_TIMEOUT_MS = parseFloat(process.env.SADTALKER_JOB_TIMEOUT || '600') * 1000;
+const sleep = (ms) => new Promise((resolve) => setTimeout(resolve, ms));
 
 // Ensure temp directory exists
 if (!fs.existsSync(TEMP_DIR)) {
@@ -47,6 +50,68 @@ exports.initializeAvatar = async (req, res) => {
   }
 };
 
+/**
+ * POST a generation to the Python service. A 202 {jobId} (still rendering) is polled
+ * until the job finishes or JOB_TIMEOUT_MS after the request was sent, so the whole call
+ * takes at most about JOB_TIMEOUT_MS (plus one poll). 429 and 202 responses are returned
+ * rather than thrown, 5xx throw as usual
+ */
+const requestGeneration = async (endpoint, body) => {
+  // the service holds the POST for up to JOB_TIMEOUT_MS, that time counts towards the same deadline
+  const deadline = Date.now() + JOB_TIMEOUT_MS;
+  let response = await axios.post(`${SADTALKER_SERVICE_URL}${endpoint}`, body, {
+    timeout: JOB_TIMEOUT_MS + 30000, // the service answers 202 after JOB_TIMEOUT_MS
+    validateStatus: (status) => status < 500
+  });
+
+  while (response.status === 202 && response.data?.jobId && Date.now() < deadline) {
+    const retryAfter = parseInt(response.headers['retry-after'] || '2', 10);
+    await sleep(Math.min(Math.max(retryAfter, 1), 10) * 1000);
+    response = await axios.get(`${SADTALKER_SERVICE_URL}/api/avatar/jobs/${encodeURIComponent(response.data.jobId)}/result`, {
+      timeout: 30000,
+      validateStatus: (status) => status < 500
+    });
+  }
+  return response;
+};
+
+/**
+ * Answer with a 429 (with Retry-After), 202 or 4xx from the Python service as is.
+ * Returns false when the response is a success for the caller to send
+ */
+const forwardNotDone = (res, response, error) => {
+  if (response.status === 429) {
+    if (response.headers['retry-after']) {
+      res.setHeader('Retry-After', response.headers['retry-after']);
+    }
+    res.status(429).json({
+      success: false,
+      error: 'SadTalker service is busy, retry later',
+      retryAfter: response.data?.retryAfter,
+      details: response.data
+    });
+    return true;
+  }
+  if (response.status === 202) {
+    // Still rendering after JOB_TIMEOUT_MS, the client can keep polling the job
+    res.status(202).json({
+      success: false,
+      message: 'Avatar video is still rendering',
+      data: response.data
+    });
+    return true;
+  }
+  if (response.status >= 400) {
+    res.status(response.status).json({
+      success: false,
+      error,
+      details: response.data
+    });
+    return true;
+  }
+  return false;
+};
+
 /**
  * Generate talking head video from text
  * Converts text to speech and generates lip-synced video
@@ -64,16 +129,16 @@ exports.generateAvatarVideo = async (req, res) => {
 
     console.log('🎬 Generating avatar video for text:', text?.substring(0, 50) + '...');
 
-    const response = await axios.post(`${SADTALKER_SERVICE_URL}/api/avatar/generate`, {
+    const response = await requestGeneration('/api/avatar/generate', {
       text,
       audio,
       preprocess: options.preprocess || 'crop',
       stillMode: options.stillMode !== undefined ? options.stillMode : false,
-      useEnhancer: options.useEnhancer !== undefined ? options.useEnhancer : true,
-      returnBase64: options.returnBase64 !== undefined ? options.returnBase64 : true
-    }, {
-      timeout: 120000 // 2 minutes timeout for video generation
+      useEnhancer: options.useEnhancer !== undefined ? options.useEnhancer : true
     });
+    if (forwardNotDone(res, response, 'Failed to generate avatar video')) {
+      return;
+    }
 
     res.json({
       success: true,
@@ -110,11 +175,10 @@ exports.quickGenerateAvatar = async (req, res) => {
 
     const startTime = Date.now();
 
-    const response = await axios.post(`${SADTALKER_SERVICE_URL}/api/avatar/quick-generate`, {
-      text
-    }, {
-      timeout: 60000 // 1 minute timeout for quick generation
-    });
+    const response = await requestGeneration('/api/avatar/quick-generate', { text });
+    if (forwardNotDone(res, response, 'Failed to generate avatar video')) {
+      return;
+    }
 
     const generationTime = Date.now() - startTime;
     console.log(`✅ Avatar generated in ${generationTime}ms`);
@@ -138,21 +202,29 @@ exports.quickGenerateAvatar = async (req, res) => {
 
 /**
  * Stream avatar video frames
+ * Multipart MJPEG by default, server-sent events with ?format=sse
  */
 exports.streamAvatarVideo = async (req, res) => {
   try {
     const { videoId } = req.params;
 
-    // Set up SSE headers
-    res.setHeader('Content-Type', 'text/event-stream');
-    res.setHeader('Cache-Control', 'no-cache');
-    res.setHeader('Connection', 'keep-alive');
-
     // Stream from Python service
-    const response = await axios.get(`${SADTALKER_SERVICE_URL}/api/avatar/stream/${videoId}`, {
-      responseType: 'stream'
+    const response = await axios.get(`${SADTALKER_SERVICE_URL}/api/avatar/stream/${encodeURIComponent(videoId)}`, {
+      params: { format: req.query.format },
+      responseType: 'stream',
+      validateStatus: (status) => status < 500
+    });
+
+    res.status(response.status);
+    ['content-type', 'cache-control', 'x-stream-id'].forEach((name) => {
+      if (response.headers[name]) {
+        res.setHeader(name, response.headers[name]);
+      }
     });
+    res.setHeader('Connection', 'keep-alive');
 
+    // Stop rendering frames nobody is watching
+    req.on('close', () => response.data.destroy());
     response.data.pipe(res);
 
   } catch (error) {
@@ -164,6 +236,110 @@ exports.streamAvatarVideo = async (req, res) => {
   }
 };
 
+/**
+ * Per-stream bitrate and FPS statistics
+ */
+exports.getAvatarStreamStats = async (req, res) => {
+  try {
+    const response = await axios.get(`${SADTALKER_SERVICE_URL}/api/avatar/streams`);
+    res.json({
+      success: true,
+      data: response.data
+    });
+  } catch (error) {
+    console.error('❌ Error fetching stream stats:', error.message);
+    res.status(500).json({
+      success: false,
+      error: 'Failed to fetch stream stats'
+    });
+  }
+};
+
+/**
+ * Proxy a binary MP4 from the Python service, forwarding Range and
+ * conditional headers so players can seek and revalidate via ETag
+ */
+const proxyVideo = async (req, res, path) => {
+  const forwardHeaders = {};
+  ['range', 'if-range', 'if-none-match', 'if-modified-since'].forEach((name) => {
+    if (req.headers[name]) {
+      forwardHeaders[name] = req.headers[name];
+    }
+  });
+
+  const response = await axios.get(`${SADTALKER_SERVICE_URL}${path}`, {
+    headers: forwardHeaders,
+    responseType: 'stream',
+    validateStatus: (status) => status < 500
+  });
+
+  res.status(response.status);
+  ['content-type', 'content-length', 'content-range', 'accept-ranges', 'etag', 'cache-control', 'last-modified', 'expires'].forEach((name) => {
+    if (response.headers[name]) {
+      res.setHeader(name, response.headers[name]);
+    }
+  });
+
+  response.data.pipe(res);
+};
+
+/**
+ * Serve a rendered avatar video
+ */
+exports.getAvatarVideo = async (req, res) => {
+  try {
+    const { videoId } = req.params;
+    await proxyVideo(req, res, `/api/avatar/video/${encodeURIComponent(videoId)}`);
+
+  } catch (error) {
+    console.error('❌ Error serving avatar video:', error.message);
+    res.status(500).json({
+      success: false,
+      error: 'Failed to serve avatar video'
+    });
+  }
+};
+
+/**
+ * List the looping idle clips of an avatar
+ * Rendered at initialization, played while the candidate is talking
+ */
+exports.getIdleClips = async (req, res) => {
+  try {
+    const { avatarId } = req.params;
+    const response = await axios.get(`${SADTALKER_SERVICE_URL}/api/avatar/idle/${encodeURIComponent(avatarId)}`);
+
+    res.json({
+      success: true,
+      data: response.data
+    });
+
+  } catch (error) {
+    console.error('❌ Error listing idle clips:', error.message);
+    res.status(500).json({
+      success: false,
+      error: 'Failed to list idle clips'
+    });
+  }
+};
+
+/**
+ * Serve one idle clip
+ */
+exports.getIdleClip = async (req, res) => {
+  try {
+    const { avatarId, index } = req.params;
+    await proxyVideo(req, res, `/api/avatar/idle/${encodeURIComponent(avatarId)}/${encodeURIComponent(index)}`);
+
+  } catch (error) {
+    console.error('❌ Error serving idle clip:', error.message);
+    res.status(500).json({
+      success: false,
+      error: 'Failed to serve idle clip'
+    });
+  }
+};
+
 /**
  * Health check for SadTalker service
  * Returns availability status and service information
@@ -235,11 +411,18 @@ exports.batchGenerateAvatars = async (req, res) => {
       try {
         console.log(`🎬 Generating ${i + 1}/${questions.length}: ${question.text?.substring(0, 40)}...`);
 
-        const response = await axios.post(`${SADTALKER_SERVICE_URL}/api/avatar/quick-generate`, {
+        const response = await requestGeneration('/api/avatar/quick-generate', {
           text: question.text
-        }, {
-          timeout: 60000
         });
+        if (response.status !== 200) {
+          errors.push({
+            index: i,
+            questionId: question.id,
+            error: response.data?.error || `SadTalker service answered ${response.status}`,
+            retryAfter: response.headers['retry-after']
+          });
+          continue;
+        }
 
         results.push({
           index: i,
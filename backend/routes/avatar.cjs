@@ -51,6 +51,16 @@ router.post('/quick-generate', avatarController.quickGenerateAvatar);
 // Stream avatar video
 router.get('/stream/:videoId', avatarController.streamAvatarVideo);
 
+// Per-stream bitrate and FPS
+router.get('/streams', avatarController.getAvatarStreamStats);
+
+// Rendered video (binary MP4 with Range support)
+router.get('/video/:videoId', avatarController.getAvatarVideo);
+
+// Looping idle clips of an avatar
+router.get('/idle/:avatarId', avatarController.getIdleClips);
+router.get('/idle/:avatarId/:index', avatarController.getIdleClip);
+
 // Batch generate multiple avatars
 router.post('/batch-generate', avatarController.batchGenerateAvatars);
 
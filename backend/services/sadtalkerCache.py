@@ -0,0 +1,122 @@
+"""
+SadTalker Result Cache - Rendered videos on disk, keyed by everything that changes them
+Least recently used videos are evicted once the cache grows past its size cap
+"""
+
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+
+
+def default_cache_dir():
+    """Same root as the SadTalker model pool caches"""
+    return os.environ.get('SADTALKER_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'sadtalker_cache'))
+
+
+def file_hash(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+_content_hashes = {}
+_content_hashes_lock = threading.Lock()
+
+def content_hash(path):
+    """file_hash memoized per (path, mtime, size)"""
+    stat = os.stat(path)
+    memo_key = (os.path.abspath(path), stat.st_mtime, stat.st_size)
+    with _content_hashes_lock:
+        if memo_key in _content_hashes:
+            return _content_hashes[memo_key]
+    digest = file_hash(path)
+    with _content_hashes_lock:
+        _content_hashes[memo_key] = digest
+    return digest
+
+
+class ResultCache:
+    """Disk-backed LRU cache of rendered videos"""
+
+    def __init__(self, cache_dir=None, max_bytes=2 << 30):
+        self.cache_dir = cache_dir or os.path.join(default_cache_dir(), 'results')
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self._lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def key(self, avatar_path, text=None, audio_bytes=None, preprocess='crop', still_mode=False,
+            use_enhancer=False, size=256, pose_style=0, seed=None, pipelined=False, precision='fp32'):
+        """Cache key of one generation, from the audio bytes or else from the TTS text"""
+        h = hashlib.sha1()
+        h.update(content_hash(avatar_path).encode())
+        if audio_bytes is not None:
+            h.update(b'audio:' + hashlib.sha1(audio_bytes).hexdigest().encode())
+        else:
+            h.update(b'text:' + (text or '').encode('utf-8'))
+        h.update(repr((preprocess, bool(still_mode), bool(use_enhancer), int(size), int(pose_style), seed)).encode())
+        if pipelined:
+            # rendered sentence by sentence, a different video from the same text
+            h.update(b'pipelined')
+        if precision != 'fp32':
+            h.update(b'precision:' + precision.encode())
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + '.mp4')
+
+    def get(self, key):
+        """Path of the cached video, or None"""
+        path = self.path(key)
+        with self._lock:
+            if not os.path.isfile(path):
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.bytes_saved += os.path.getsize(path)
+            os.utime(path)  # mark as recently used
+            return path
+
+    def put(self, key, video_path):
+        """Move a rendered video into the cache and return its new path"""
+        path = self.path(key)
+        tmp_path = path + '.tmp'
+        shutil.move(video_path, tmp_path)
+        os.replace(tmp_path, path)
+        self._evict()
+        return path
+
+    def _evict(self):
+        with self._lock:
+            entries = [os.path.join(self.cache_dir, f) for f in os.listdir(self.cache_dir) if f.endswith('.mp4')]
+            sizes = {path: os.path.getsize(path) for path in entries}
+            total = sum(sizes.values())
+            for path in sorted(entries, key=os.path.getmtime):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                    total -= sizes[path]
+                except OSError:
+                    pass
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            entries = [f for f in os.listdir(self.cache_dir) if f.endswith('.mp4')]
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else None,
+                'bytes_saved': self.bytes_saved,
+                'entries': len(entries),
+                'bytes': sum(os.path.getsize(os.path.join(self.cache_dir, f)) for f in entries),
+                'max_bytes': self.max_bytes,
+                'cache_dir': self.cache_dir
+            }
@@ -0,0 +1,366 @@
+"""
+SadTalker Job Queue - Runs avatar generations in worker processes
+Each worker keeps its own warm models, the queue in front of them is bounded
+"""
+
+import math
+import multiprocessing as mp
+import queue
+import threading
+import time
+import traceback
+import uuid
+
+
+class QueueFullError(Exception):
+    """Raised when a job is submitted while the queue is at capacity"""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Job queue is full, retry in {retry_after}s")
+        self.retry_after = retry_after
+
+
+def _publish_stats(worker, results, worker_id):
+    if hasattr(worker, 'stats'):
+        try:
+            results.put((worker_id, 'stats', worker.stats(), None))
+        except Exception as e:
+            print(f"⚠️  Worker {worker_id} stats failed: {e}")
+
+
+def _worker_main(worker_factory, tasks, control, results, worker_id, cancelled):
+    """
+    Worker process: build the generator once, then run jobs until a None task arrives.
+    Jobs sent to this worker alone (`control`) go before the shared ones
+    """
+    worker = worker_factory()
+    try:
+        worker.warmup()
+    except Exception as e:
+        # models are loaded lazily by the first job instead
+        print(f"⚠️  Worker {worker_id} warmup failed: {e}")
+    _publish_stats(worker, results, worker_id)
+
+    while True:
+        try:
+            task = control.get_nowait()
+        except queue.Empty:
+            try:
+                task = tasks.get(timeout=0.5)
+            except queue.Empty:
+                continue
+        if task is None:
+            break
+        job_id, method, kwargs, stream = task
+        results.put((job_id, 'running', worker_id, None))
+        try:
+            result = getattr(worker, method)(**kwargs)
+            if stream:
+                # items go back one by one, until the consumer goes away
+                items = iter(result)
+                while cancelled.value != job_id.encode():
+                    item = next(items, None)
+                    if item is None:
+                        break
+                    results.put((job_id, 'item', item, None))
+                if hasattr(items, 'close'):
+                    items.close()
+                result = None
+            results.put((job_id, 'done', result, None))
+        except Exception as e:
+            traceback.print_exc()
+            results.put((job_id, 'failed', None, str(e)))
+        _publish_stats(worker, results, worker_id)
+
+
+class JobQueue:
+    """
+    Bounded job queue in front of a pool of worker processes
+
+    Jobs are (method, kwargs) calls on the object built by `worker_factory` in each worker.
+    Submitting while `max_queue` jobs are waiting raises QueueFullError with a Retry-After
+    estimate from the recent render times. Jobs submitted with the `dedupe_key` of a job
+    still in flight are coalesced into it. `on_done(job)` may replace the result of every
+    finished job before its waiters are woken, it runs without holding the queue's lock.
+    Workers start on the first submit.
+
+    Stream jobs call a method returning an iterator, whose items are sent back as they come
+    (see stream). They are admitted like the other jobs. broadcast runs a job on every worker,
+    and every worker reports `worker.stats()` after each job (see worker_stats).
+    """
+
+    def __init__(self, worker_factory, num_workers=1, max_queue=10, job_ttl=3600, on_done=None):
+        self.worker_factory = worker_factory
+        self.on_done = on_done
+        self.num_workers = num_workers
+        self.max_queue = max_queue
+        self.job_ttl = job_ttl
+
+        self.jobs = {}
+        self._events = {}
+        self._streams = {}
+        self._worker_stats = {}
+        self._lock = threading.Lock()
+        self._durations = []
+        self.coalesced = 0
+        self._workers = []
+        self._started = False
+        self._stopping = False
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+            # spawn, CUDA cannot be used in forked children
+            self._ctx = mp.get_context('spawn')
+            self._tasks = self._ctx.Queue()
+            self._results = self._ctx.Queue()
+            self._controls = [self._ctx.Queue() for _ in range(self.num_workers)]
+            # id of the stream job each worker should stop
+            self._cancelled = [self._ctx.Array('c', 32) for _ in range(self.num_workers)]
+            self._workers = [self._start_worker(i) for i in range(self.num_workers)]
+            self._started = True
+
+        threading.Thread(target=self._collect, daemon=True).start()
+        print(f"✅ Started {self.num_workers} SadTalker worker(s)")
+
+    def _start_worker(self, worker_id):
+        process = self._ctx.Process(target=_worker_main, args=(self.worker_factory, self._tasks, self._controls[worker_id],
+                                                               self._results, worker_id, self._cancelled[worker_id]), daemon=True)
+        process.start()
+        return process
+
+    def _pending(self):
+        return sum(1 for job in self.jobs.values() if job['status'] == 'queued' and not job['broadcast'])
+
+    def retry_after(self):
+        """Seconds until a slot frees up, from the average of the recent render times"""
+        durations = self._durations[-20:]
+        average = sum(durations) / len(durations) if durations else 30.
+        return max(1, math.ceil(average * (self._pending() + 1) / self.num_workers))
+
+    def _find(self, dedupe_key):
+        for job in self.jobs.values():
+            if job['dedupe_key'] == dedupe_key and job['status'] in ('queued', 'running'):
+                return job['id']
+        return None
+
+    def find(self, dedupe_key):
+        """Id of the in-flight job with this key, or None"""
+        with self._lock:
+            job_id = self._find(dedupe_key)
+            if job_id is not None:
+                self.coalesced += 1
+            return job_id
+
+    def submit(self, method, dedupe_key=None, on_coalesced=None, **kwargs):
+        """
+        Queue `method(**kwargs)` and return the job id right away. `on_coalesced()` is called
+        when the call joins the in-flight job with the same `dedupe_key` instead
+        """
+        return self._submit(method, dedupe_key, False, kwargs, on_coalesced)
+
+    def submit_stream(self, method, **kwargs):
+        """Queue `method(**kwargs)`, which returns an iterator, and return the job id right away"""
+        return self._submit(method, None, True, kwargs)
+
+    def _submit(self, method, dedupe_key, stream, kwargs, on_coalesced=None):
+        self.start()
+        with self._lock:
+            job_id = self._find(dedupe_key) if dedupe_key is not None else None
+            coalesced = job_id is not None
+            if coalesced:
+                self.coalesced += 1
+            else:
+                if self._pending() >= self.max_queue:
+                    raise QueueFullError(self.retry_after())
+                job_id = self._create(method, dedupe_key, stream)
+
+        if coalesced:
+            if on_coalesced is not None:
+                on_coalesced()
+        else:
+            self._tasks.put((job_id, method, kwargs, stream))
+        return job_id
+
+    def _create(self, method, dedupe_key=None, stream=False, broadcast=False):
+        job_id = uuid.uuid4().hex
+        self.jobs[job_id] = {
+            'id': job_id,
+            'method': method,
+            'dedupe_key': dedupe_key,
+            'status': 'queued',
+            'submitted': time.time(),
+            'started': None,
+            'finished': None,
+            'worker': None,
+            'result': None,
+            'error': None,
+            'broadcast': broadcast
+        }
+        self._events[job_id] = threading.Event()
+        if stream:
+            self._streams[job_id] = queue.Queue()
+        return job_id
+
+    def broadcast(self, method, **kwargs):
+        """
+        Queue `method(**kwargs)` on every worker, ahead of the shared queue and outside its
+        capacity, and return one job id per worker. A busy worker runs it after its current job
+        """
+        self.start()
+        with self._lock:
+            job_ids = [self._create(method, broadcast=True) for _ in range(self.num_workers)]
+        for worker_id, job_id in enumerate(job_ids):
+            self._controls[worker_id].put((job_id, method, kwargs, False))
+        return job_ids
+
+    def worker_stats(self):
+        """The latest `stats()` reported by each live worker, by worker id"""
+        with self._lock:
+            return dict(self._worker_stats)
+
+    def stream(self, job_id):
+        """
+        Items of a stream job as the worker produces them. Closing the iterator early (e.g. on
+        a client disconnect) cancels the job, the worker stops before its next item
+        """
+        items = self._streams[job_id]
+        try:
+            while True:
+                kind, value = items.get()
+                if kind == 'item':
+                    yield value
+                elif kind == 'failed':
+                    raise RuntimeError(value)
+                else:
+                    return
+        finally:
+            self.cancel(job_id)
+
+    def cancel(self, job_id):
+        """Stop a stream job before its next item, right after it starts if it is still queued"""
+        with self._lock:
+            self._streams.pop(job_id, None)
+            job = self.jobs.get(job_id)
+            if job is None or job['status'] in ('done', 'failed'):
+                return
+            job['cancelled'] = True
+            if job['status'] == 'running':
+                self._cancelled[job['worker']].value = job_id.encode()
+
+    def get(self, job_id):
+        with self._lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            job = dict(job)
+            if job['status'] == 'queued':
+                job['position'] = sum(1 for other in self.jobs.values()
+                                      if other['status'] == 'queued' and other['submitted'] < job['submitted'])
+        return job
+
+    def wait(self, job_id, timeout=None):
+        """Block until the job is done or failed, return its record (None on timeout)"""
+        event = self._events.get(job_id)
+        if event is None or not event.wait(timeout):
+            return None
+        return self.get(job_id)
+
+    def _finish(self, job_id, status, result=None, error=None):
+        job = self.jobs.get(job_id)
+        if job is None:
+            return
+        job['status'] = status
+        job['result'] = result
+        job['error'] = error
+        job['finished'] = time.time()
+        if status == 'done' and job['started'] is not None:
+            self._durations = self._durations[-99:] + [job['finished'] - job['started']]
+        if job_id in self._streams:
+            self._streams[job_id].put((status, error))
+        self._events[job_id].set()
+
+    def _on_done(self, job_id, status, result, error):
+        """
+        Run on_done on a finished job outside the lock, it may move files around. The job only
+        turns 'done' afterwards, with the result on_done returned
+        """
+        with self._lock:
+            job = self.jobs.get(job_id)
+            job = dict(job, result=result) if job is not None else None
+        if job is not None:
+            try:
+                result = self.on_done(job)
+            except Exception as e:
+                print(f"⚠️  on_done failed for job {job_id}: {e}")
+        return job_id, status, result, error
+
+    def _collect(self):
+        """Apply worker updates, restart dead workers and drop old jobs"""
+        while True:
+            try:
+                update = self._results.get(timeout=1.0)
+            except queue.Empty:
+                update = None
+
+            if update is not None and update[1] == 'done' and self.on_done is not None:
+                update = self._on_done(*update)
+
+            with self._lock:
+                if update is not None:
+                    job_id, status, value, error = update
+                    if status == 'stats':
+                        # job_id is the worker id here
+                        self._worker_stats[job_id] = value
+                    elif status == 'running':
+                        if job_id in self.jobs:
+                            self.jobs[job_id].update(status='running', started=time.time(), worker=value)
+                            if self.jobs[job_id].get('cancelled'):
+                                self._cancelled[value].value = job_id.encode()
+                    elif status == 'item':
+                        if job_id in self._streams:
+                            self._streams[job_id].put(('item', value))
+                    else:
+                        self._finish(job_id, status, value, error)
+
+                for worker_id, process in enumerate(self._workers):
+                    if process.is_alive() or self._stopping:
+                        continue
+                    print(f"❌ Worker {worker_id} died (exit code {process.exitcode}), restarting")
+                    self._worker_stats.pop(worker_id, None)
+                    for job in self.jobs.values():
+                        if job['status'] == 'running' and job['worker'] == worker_id:
+                            self._finish(job['id'], 'failed', error='Worker process died')
+                    self._workers[worker_id] = self._start_worker(worker_id)
+
+                now = time.time()
+                for old_id in [job['id'] for job in self.jobs.values()
+                               if job['finished'] is not None and now - job['finished'] > self.job_ttl]:
+                    del self.jobs[old_id]
+                    del self._events[old_id]
+
+    def stats(self):
+        with self._lock:
+            statuses = [job['status'] for job in self.jobs.values()]
+            durations = self._durations[-20:]
+            return {
+                'workers': self.num_workers,
+                'workers_alive': sum(1 for process in self._workers if process.is_alive()),
+                'max_queue': self.max_queue,
+                'queued': statuses.count('queued'),
+                'running': statuses.count('running'),
+                'done': statuses.count('done'),
+                'failed': statuses.count('failed'),
+                'coalesced': self.coalesced,
+                'avg_render_time': sum(durations) / len(durations) if durations else None
+            }
+
+    def shutdown(self):
+        if not self._started:
+            return
+        self._stopping = True
+        for _ in self._workers:
+            self._tasks.put(None)
+        for process in self._workers:
+            process.join(timeout=10)
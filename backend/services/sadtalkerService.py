@@ -14,25 +14,46 @@ from io import BytesIO
 from PIL import Image
 import json
 import asyncio
-from flask import Flask, request, jsonify, Response
+from flask import Flask, request, jsonify, Response, send_file
 from flask_cors import CORS
 import threading
 import queue
 import tempfile
 import time
+import shutil
+import uuid
+import re
+
+from sadtalkerJobs import JobQueue, QueueFullError
+from sadtalkerCache import ResultCache, content_hash, default_cache_dir
+from sadtalkerStreams import StreamRegistry, MJPEG_BOUNDARY, mjpeg_parts, paced
 
 # Add SadTalker to path (assuming it's cloned in the backend directory)
 SADTALKER_PATH = Path(__file__).parent.parent / "SadTalker"
 sys.path.append(str(SADTALKER_PATH))
 
 try:
-    from inference import SadTalker as SadTalkerInference
+    from src.gradio_demo import SadTalker as SadTalkerInference
+    from src.utils.videoio import VideoStreamWriter
 except ImportError:
     print("Warning: SadTalker not found. Please clone it first.")
     SadTalkerInference = None
 
 app = Flask(__name__)
-CORS(app)
+CORS(app, expose_headers=['Content-Range', 'Accept-Ranges', 'ETag', 'X-Stream-Id'])
+# Let a fronting nginx/apache send the video files itself
+app.config['USE_X_SENDFILE'] = os.environ.get('SADTALKER_X_SENDFILE', '0') == '1'
+VIDEO_MAX_AGE = int(os.environ.get('SADTALKER_VIDEO_MAX_AGE', 86400))
+# Looping idle clips rendered per avatar at registration
+IDLE_CLIPS = int(os.environ.get('SADTALKER_IDLE_CLIPS', 3))
+IDLE_CLIP_SECONDS = float(os.environ.get('SADTALKER_IDLE_SECONDS', 4.0))
+# Default face render precision of a request: fp32, bf16, fp16 or auto (fp16 on CUDA, bf16 on CPU)
+RENDER_PRECISION = os.environ.get('SADTALKER_PRECISION', 'fp32')
+# The precisions the face renderer takes, as in make_animation.RENDER_PRECISIONS
+RENDER_PRECISIONS = ('fp32', 'bf16', 'fp16', 'auto')
+
+class InvalidRequestError(ValueError):
+    """Raised for a request option the service does not accept, answered with a 400"""
 
 class AvatarVideoGenerator:
     """Generates realistic talking head videos with lip sync"""
@@ -41,7 +62,6 @@ class AvatarVideoGenerator:
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
         self.model = None
         self.avatar_image_path = None
-        self.video_queue = queue.Queue(maxsize=10)
         
         # Default avatar image path - use SadTalker example image
         examples_path = SADTALKER_PATH / "examples" / "source_image"
@@ -69,12 +89,79 @@ class AvatarVideoGenerator:
             self.model = SadTalkerInference(
                 checkpoint_path=str(checkpoint_path),
                 config_path=str(SADTALKER_PATH / "src" / "config"),
-                device=self.device
+                lazy_load=True
             )
             print(f"✅ SadTalker initialized on {self.device}")
         except Exception as e:
             print(f"❌ Error initializing SadTalker: {e}")
             raise
+
+    def warmup(self, sizes=(256,), preprocesses=('crop',)):
+        """Load the SadTalker components into the warm model pool ahead of the first request"""
+        if self.model is None:
+            self.initialize_model()
+
+        start = time.time()
+        self.model.warmup(sizes, preprocesses)
+        print(f"✅ Model pool warm in {time.time() - start:.2f}s")
+
+    def evict(self, size=None, preprocess=None):
+        """Release pooled models (all of them when no filter is given)"""
+        if self.model is not None:
+            self.model.evict(size, preprocess)
+
+    def stats(self):
+        """Loaded models and caches of this generator's model pool, None before it is initialized"""
+        if self.model is None:
+            return None
+        return self.model.model_pool.stats()
+
+    def register_avatar(self, preprocess='crop', size=256, source_image=None):
+        """
+        Preprocess the current avatar (face crop, landmarks, 3DMM coefficients) once so that
+        generation requests are served from the avatar cache
+        """
+        if self.model is None:
+            self.initialize_model()
+
+        if source_image is None:
+            if self.avatar_image_path is None:
+                self.avatar_image_path = str(self.default_avatar)
+            source_image = self.avatar_image_path
+
+        start = time.time()
+        avatar_id = self.model.register_avatar(source_image, preprocess, size)
+        if avatar_id is None:
+            raise Exception("No face detected in the avatar image")
+        print(f"✅ Avatar registered in {time.time() - start:.2f}s: {avatar_id}")
+        return avatar_id
+    
+    def render_idle_clips(self, preprocess='crop', size=256, source_image=None, num_clips=3, seconds=4.0):
+        """
+        Render the looping idle clips of an avatar, played while the candidate is talking
+        
+        Args:
+            preprocess: 'crop' or 'resize' or 'full'
+            size: Face render size (256 or 512)
+            source_image: Avatar image (defaults to the current avatar)
+            num_clips: Number of different clips
+            seconds: Length of each clip
+            
+        Returns:
+            Paths of the clips
+        """
+        if self.model is None:
+            self.initialize_model()
+            
+        if source_image is None:
+            if self.avatar_image_path is None:
+                self.avatar_image_path = str(self.default_avatar)
+            source_image = self.avatar_image_path
+        
+        start = time.time()
+        clip_paths = self.model.idle_clips(source_image, preprocess, size, num_clips, seconds)
+        print(f"✅ Idle clips ready in {time.time() - start:.2f}s: {len(clip_paths)} clip(s)")
+        return clip_paths
     
     def set_avatar_image(self, image_data):
         """
@@ -105,7 +192,8 @@ class AvatarVideoGenerator:
             return False
     
     def generate_talking_video(self, audio_path, output_path=None, preprocess='crop', 
-                               still_mode=False, use_enhancer=False):
+                               still_mode=False, use_enhancer=False, source_image=None,
+                               size=256, pose_style=0, seed=None, precision='fp32'):
         """
         Generate talking head video from audio
         
@@ -115,6 +203,11 @@ class AvatarVideoGenerator:
             preprocess: 'crop' or 'resize' or 'full'
             still_mode: Use still mode (less head movement)
             use_enhancer: Use GFPGAN face enhancer
+            source_image: Avatar image (defaults to the current avatar)
+            size: Face render size (256 or 512)
+            pose_style: Head pose style (0-45)
+            seed: Seed for the head pose, makes the video reproducible (optional)
+            precision: Face render precision ('fp32', 'bf16', 'fp16' or 'auto')
             
         Returns:
             Path to generated video
@@ -124,65 +217,351 @@ class AvatarVideoGenerator:
             
         if self.avatar_image_path is None:
             self.avatar_image_path = str(self.default_avatar)
+        if source_image is None:
+            source_image = self.avatar_image_path
             
         try:
             if output_path is None:
-                output_path = Path(tempfile.gettempdir()) / f"avatar_output_{int(time.time())}.mp4"
+                output_path = Path(tempfile.gettempdir()) / f"avatar_output_{uuid.uuid4().hex}.mp4"
             
-            # Generate video using SadTalker
+            # Generate video using SadTalker (models come from the warm pool)
             result = self.model.test(
-                source_image=self.avatar_image_path,
+                source_image=source_image,
                 driven_audio=audio_path,
                 preprocess=preprocess,
                 still_mode=still_mode,
                 use_enhancer=use_enhancer,
+                size=size,
+                pose_style=pose_style,
+                seed=seed,
                 result_dir=str(Path(output_path).parent),
-                save_dir=str(Path(output_path).parent)
+                precision=precision
             )
+            shutil.move(result, str(output_path))
             
-            print(f"✅ Video generated: {result}")
-            return result
+            print(f"✅ Video generated: {output_path}")
+            return str(output_path)
             
         except Exception as e:
             print(f"❌ Error generating video: {e}")
             raise
     
-    def stream_video_frames(self, video_path):
+    def generate_talking_video_pipelined(self, text, output_path=None, preprocess='crop',
+                                         still_mode=False, source_image=None, size=256,
+                                         pose_style=0, seed=None, precision='fp32'):
         """
-        Stream video frames as base64 for real-time display
+        Generate talking head video from text, sentence by sentence: TTS of the next sentence,
+        audio2coeff of the current one and rendering of the previous one run at the same time
         
         Args:
-            video_path: Path to generated video
+            text: Text to speak
+            output_path: Output video path (optional)
+            preprocess: 'crop' or 'resize' or 'full'
+            still_mode: Use still mode (less head movement)
+            source_image: Avatar image (defaults to the current avatar)
+            size: Face render size (256 or 512)
+            pose_style: Head pose style (0-45)
+            seed: Seed for the head pose (optional)
+            precision: Face render precision ('fp32', 'bf16', 'fp16' or 'auto')
             
-        Yields:
-            Base64 encoded frames
+        Returns:
+            Path to generated video
         """
-        try:
-            cap = cv2.VideoCapture(str(video_path))
-            fps = int(cap.get(cv2.CAP_PROP_FPS))
-            frame_delay = 1.0 / fps
-            
-            while cap.isOpened():
-                ret, frame = cap.read()
-                if not ret:
-                    break
-                
-                # Encode frame to base64
-                _, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, 85])
-                frame_base64 = base64.b64encode(buffer).decode('utf-8')
-                
-                yield frame_base64
-                time.sleep(frame_delay)
+        if self.model is None:
+            self.initialize_model()
             
-            cap.release()
+        if self.avatar_image_path is None:
+            self.avatar_image_path = str(self.default_avatar)
+        if source_image is None:
+            source_image = self.avatar_image_path
+        
+        if output_path is None:
+            output_path = Path(tempfile.gettempdir()) / f"avatar_output_{uuid.uuid4().hex}.mp4"
+        
+        tts_paths = []
+        def synthesize():
+            # runs in the pipeline's first stage, one sentence ahead of audio2coeff
+            for sentence in split_sentences(text):
+                tts_paths.append(synthesize_speech(sentence, prefix='sentence_'))
+                yield str(tts_paths[-1])
+        
+        try:
+            start = time.time()
+            self.model.test_sentences(
+                source_image=source_image,
+                driven_audios=synthesize(),
+                save_path=str(output_path),
+                preprocess=preprocess,
+                still_mode=still_mode,
+                size=size,
+                pose_style=pose_style,
+                seed=seed,
+                result_dir=tempfile.gettempdir(),
+                precision=precision
+            )
+            print(f"✅ Video generated in {time.time() - start:.2f}s ({len(tts_paths)} sentence(s)): {output_path}")
+            return str(output_path)
             
         except Exception as e:
-            print(f"❌ Error streaming video: {e}")
+            print(f"❌ Error generating video: {e}")
             raise
+        finally:
+            for tts_path in tts_paths:
+                tts_path.unlink(missing_ok=True)
+    
+    def stream_talking_video(self, audio_path, preprocess='crop', still_mode=False, segment_seconds=1.0, seed=None,
+                             precision='fp32', source_image=None):
+        """
+        Generate a talking head video segment by segment
+        
+        Args:
+            audio_path: Path to audio file (WAV, MP3)
+            preprocess: 'crop' or 'resize' or 'full'
+            still_mode: Use still mode (less head movement)
+            segment_seconds: Length of each segment
+            seed: Seed for the head pose (optional)
+            precision: Face render precision ('fp32', 'bf16', 'fp16' or 'auto')
+            source_image: Custom avatar image path (optional)
+            
+        Yields:
+            Segments with their RGB frames (25 fps) and 16kHz int16 audio
+        """
+        if self.model is None:
+            self.initialize_model()
+            
+        if source_image is None:
+            if self.avatar_image_path is None:
+                self.avatar_image_path = str(self.default_avatar)
+            source_image = self.avatar_image_path
+
+        return self.model.stream(
+            source_image=source_image,
+            driven_audio=audio_path,
+            preprocess=preprocess,
+            still_mode=still_mode,
+            segment_frames=max(1, int(round(segment_seconds * 25))),
+            seed=seed,
+            result_dir=tempfile.gettempdir(),
+            precision=precision
+        )
+    
+    def stream_video_frames(self, video_path):
+        """
+        Decode the frames of a rendered video, unpaced
+        
+        Args:
+            video_path: Path to generated video
+            
+        Returns:
+            (fps, generator of BGR frames)
+        """
+        cap = cv2.VideoCapture(str(video_path))
+        if not cap.isOpened():
+            raise RuntimeError(f"Cannot open video: {video_path}")
+        fps = cap.get(cv2.CAP_PROP_FPS) or 25
+        
+        def frames():
+            try:
+                while True:
+                    ret, frame = cap.read()
+                    if not ret:
+                        break
+                    yield frame
+            finally:
+                cap.release()
+        
+        return fps, frames()
 
 # Global generator instance
 generator = AvatarVideoGenerator()
 
+# Rendered videos, keyed by avatar, audio or text and render options
+result_cache = ResultCache(max_bytes=int(os.environ.get('SADTALKER_RESULT_CACHE_MB', 2048)) << 20)
+
+# Bitrate and FPS of the frame streams
+stream_registry = StreamRegistry()
+
+GENERATION_METHODS = ('generate_talking_video', 'generate_talking_video_pipelined')
+
+def cache_result(job):
+    """Move a finished generation into the result cache"""
+    if job['method'] in GENERATION_METHODS and job['dedupe_key'] is not None:
+        return result_cache.put(job['dedupe_key'], job['result'])
+    return job['result']
+
+# Renders run in worker processes, each holding its own warm AvatarVideoGenerator
+job_queue = JobQueue(
+    AvatarVideoGenerator,
+    num_workers=int(os.environ.get('SADTALKER_WORKERS', 1)),
+    max_queue=int(os.environ.get('SADTALKER_MAX_QUEUE', 10)),
+    on_done=cache_result
+)
+JOB_WAIT_TIMEOUT = float(os.environ.get('SADTALKER_JOB_TIMEOUT', 600))
+
+def queue_full_response(error):
+    """429 with a Retry-After estimate"""
+    response = jsonify({'error': str(error), 'retryAfter': error.retry_after})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
+
+def job_status(job):
+    """Public view of a job record"""
+    status = {
+        'jobId': job['id'],
+        'status': job['status'],
+        'submitted': job['submitted'],
+        'started': job['started'],
+        'finished': job['finished'],
+        'statusUrl': f"/api/avatar/jobs/{job['id']}",
+        'resultUrl': f"/api/avatar/jobs/{job['id']}/result"
+    }
+    if 'position' in job:
+        status['position'] = job['position']
+    if job['error']:
+        status['error'] = job['error']
+    return status
+
+def decode_request_audio(data):
+    """The request's base64 audio as bytes, None for text requests"""
+    audio_base64 = data.get('audio', None)
+    if not audio_base64:
+        return None
+    return base64.b64decode(audio_base64.split(',')[1] if ',' in audio_base64 else audio_base64)
+
+def split_sentences(text, min_chars=20):
+    """Sentences of a text, short ones merged into the next so that no clip is tiny"""
+    sentences = []
+    for part in re.split(r'(?<=[.!?])\s+', text.strip()):
+        if sentences and len(sentences[-1]) < min_chars:
+            sentences[-1] += ' ' + part
+        elif part:
+            sentences.append(part)
+    return sentences
+
+def synthesize_speech(text, prefix=''):
+    """TTS of a text to a temp mp3"""
+    from gtts import gTTS
+    audio_path = Path(tempfile.gettempdir()) / f"{prefix}tts_{uuid.uuid4().hex}.mp3"
+    tts = gTTS(text=text, lang='en', slow=False)
+    tts.save(str(audio_path))
+    return audio_path
+
+def save_request_audio(data, prefix='', audio_bytes=None):
+    """Write the request's base64 audio to a temp file, or synthesize its text with TTS"""
+    if audio_bytes is None:
+        audio_bytes = decode_request_audio(data)
+    if audio_bytes is not None:
+        audio_path = Path(tempfile.gettempdir()) / f"{prefix}audio_{uuid.uuid4().hex}.wav"
+        with open(audio_path, 'wb') as f:
+            f.write(audio_bytes)
+    else:
+        # Generate audio from text using TTS
+        audio_path = synthesize_speech(data.get('text', ''), prefix)
+    return audio_path
+
+def request_precision(data, default=RENDER_PRECISION):
+    """
+    Face render precision of a request, with 'auto' resolved to the dtype it renders in on this
+    device so that it shares cached results and in-flight jobs with the explicit one
+    """
+    precision = data.get('precision', default)
+    if precision not in RENDER_PRECISIONS:
+        raise InvalidRequestError(f"Unknown precision: {precision}, expected one of {', '.join(RENDER_PRECISIONS)}")
+    if precision == 'auto':
+        return 'fp16' if generator.device == 'cuda' else 'bf16'
+    return precision
+
+def generation_options(data, **overrides):
+    """Render options of a generation request for the current avatar"""
+    options = {
+        'preprocess': data.get('preprocess', 'crop'),
+        'still_mode': data.get('stillMode', False),
+        'use_enhancer': data.get('useEnhancer', True),
+        'size': int(data.get('size', 256)),
+        'pose_style': int(data.get('poseStyle', 0)),
+        'seed': data.get('seed', None),
+        'precision': request_precision(data),
+        'source_image': str(generator.avatar_image_path or generator.default_avatar)
+    }
+    options.update(overrides)
+    return options
+
+def generate_cached(data, prefix='', **overrides):
+    """
+    Serve a generation from the result cache, or join the job already rendering it,
+    or queue a new one. Returns (video_path, None) on a cache hit, else (None, job_id)
+    """
+    options = generation_options(data, **overrides)
+    audio_bytes = decode_request_audio(data)
+    # Multi-sentence text without the enhancer can be rendered sentence by sentence
+    pipelined = (data.get('pipelined', False) and audio_bytes is None and not options['use_enhancer']
+                 and len(split_sentences(data.get('text', ''))) > 1)
+    key = result_cache.key(options['source_image'], text=data.get('text', ''), audio_bytes=audio_bytes,
+                           preprocess=options['preprocess'], still_mode=options['still_mode'],
+                           use_enhancer=options['use_enhancer'], size=options['size'],
+                           pose_style=options['pose_style'], seed=options['seed'], pipelined=pipelined,
+                           precision=options['precision'])
+
+    video_path = result_cache.get(key)
+    if video_path is not None:
+        return video_path, None
+
+    # Identical requests in flight wait on the same render, without even redoing TTS
+    job_id = job_queue.find(key)
+    if job_id is None and pipelined:
+        # TTS happens inside the pipeline
+        del options['use_enhancer']
+        job_id = job_queue.submit('generate_talking_video_pipelined', dedupe_key=key, text=data.get('text', ''), **options)
+    elif job_id is None:
+        audio_path = save_request_audio(data, prefix, audio_bytes)
+        discard_audio = lambda: audio_path.unlink(missing_ok=True)
+        try:
+            # an identical request may have been queued since find(), this one then joins it
+            job_id = job_queue.submit('generate_talking_video', dedupe_key=key, on_coalesced=discard_audio,
+                                      audio_path=str(audio_path), **options)
+        except BaseException:
+            discard_audio()
+            raise
+    return None, job_id
+
+def find_video(video_id):
+    """Path of a rendered video by id, in the result cache or the temp dir"""
+    if not video_id.replace('_', '').replace('-', '').isalnum():
+        return None
+    for video_path in (Path(result_cache.path(video_id)), Path(tempfile.gettempdir()) / f"{video_id}.mp4"):
+        if video_path.exists():
+            return video_path
+    return None
+
+def video_metadata(video_path, video_url=None):
+    """URL and metadata of a rendered video, sent instead of the video itself"""
+    video_path = Path(video_path)
+    cap = cv2.VideoCapture(str(video_path))
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    frame_count = cap.get(cv2.CAP_PROP_FRAME_COUNT)
+    duration = frame_count / fps if fps > 0 else 0
+    cap.release()
+    
+    return {
+        'videoId': video_path.stem,
+        'videoUrl': video_url or f"/api/avatar/video/{video_path.stem}",
+        'videoPath': str(video_path),
+        'contentType': 'video/mp4',
+        'size': video_path.stat().st_size,
+        'duration': duration,
+        'etag': content_hash(str(video_path))
+    }
+
+def idle_clip_paths(avatar_id):
+    """Finished idle clips of an avatar, in clip order"""
+    if not avatar_id.isalnum():
+        return []
+    clip_dir = Path(default_cache_dir()) / 'idle' / avatar_id
+    if not clip_dir.is_dir():
+        return []
+    return sorted(clip_dir.glob('clip_*.mp4'), key=lambda path: int(path.stem.split('_')[1]))
+
 @app.route('/api/avatar/initialize', methods=['POST'])
 def initialize_avatar():
     """Initialize avatar with custom image"""
@@ -195,16 +574,50 @@ def initialize_avatar():
             if not success:
                 return jsonify({'error': 'Failed to set avatar image'}), 400
         
-        # Initialize model if not already done
-        if generator.model is None:
-            generator.initialize_model()
+        # Crop and extract the avatar now instead of on every generate. This runs in a
+        # worker, which also loads its models, and lands in the avatar cache every worker shares
+        preprocess = data.get('preprocess', 'crop')
+        job_id = job_queue.submit('register_avatar', preprocess=preprocess,
+                                  source_image=generator.avatar_image_path or generator.default_avatar)
+        job = job_queue.wait(job_id, JOB_WAIT_TIMEOUT)
+        if job is None:
+            return jsonify({'error': 'Avatar initialization timed out', 'jobId': job_id}), 504
+        if job['status'] == 'failed':
+            return jsonify({'error': job['error']}), 500
+        avatar_id = job['result']
+        
+        # The idle clips render in the background, GET /api/avatar/idle/<avatarId> lists them once ready
+        idle_job_id = None
+        if IDLE_CLIPS > 0 and not idle_clip_paths(avatar_id):
+            idle_job_id = job_queue.submit('render_idle_clips', dedupe_key=('idle', avatar_id),
+                                           preprocess=preprocess, source_image=generator.avatar_image_path or generator.default_avatar,
+                                           num_clips=IDLE_CLIPS, seconds=IDLE_CLIP_SECONDS)
         
         return jsonify({
             'success': True,
             'message': 'Avatar initialized successfully',
-            'device': generator.device
+            'device': generator.device,
+            'avatarId': avatar_id,
+            'idleJobId': idle_job_id
         })
         
+    except QueueFullError as e:
+        return queue_full_response(e)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/avatar/evict', methods=['POST'])
+def evict_models():
+    """Release pooled models to free memory, in every worker"""
+    try:
+        data = request.json or {}
+        # A worker busy rendering evicts once its current job is done
+        job_ids = job_queue.broadcast('evict', size=data.get('size'), preprocess=data.get('preprocess'))
+        jobs = [job_queue.wait(job_id, float(data.get('timeout', 30))) or job_queue.get(job_id) for job_id in job_ids]
+        return jsonify({
+            'success': all(job['status'] == 'done' for job in jobs),
+            'workers': [job_status(job) for job in jobs]
+        })
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -213,75 +626,313 @@ def generate_avatar_video():
     """Generate talking head video from text/audio"""
     try:
         data = request.json
-        text = data.get('text', '')
-        audio_base64 = data.get('audio', None)
-        
-        # Handle audio input
-        if audio_base64:
-            # Decode audio from base64
-            audio_bytes = base64.b64decode(audio_base64.split(',')[1] if ',' in audio_base64 else audio_base64)
-            audio_path = Path(tempfile.gettempdir()) / f"audio_{int(time.time())}.wav"
-            with open(audio_path, 'wb') as f:
-                f.write(audio_bytes)
-        else:
-            # Generate audio from text using TTS
-            from gtts import gTTS
-            audio_path = Path(tempfile.gettempdir()) / f"tts_{int(time.time())}.mp3"
-            tts = gTTS(text=text, lang='en', slow=False)
-            tts.save(str(audio_path))
-        
-        # Generate video
-        video_path = generator.generate_talking_video(
-            str(audio_path),
-            preprocess=data.get('preprocess', 'crop'),
-            still_mode=data.get('stillMode', False),
-            use_enhancer=data.get('useEnhancer', True)
-        )
         
-        # Return video path or base64
-        if data.get('returnBase64', False):
-            with open(video_path, 'rb') as f:
-                video_base64 = base64.b64encode(f.read()).decode('utf-8')
-            return jsonify({
-                'success': True,
-                'video': f"data:video/mp4;base64,{video_base64}",
-                'videoPath': str(video_path)
-            })
+        # Served from the result cache, or generated in a worker
+        video_path, job_id = generate_cached(data)
+        if video_path is None:
+            job = job_queue.wait(job_id, JOB_WAIT_TIMEOUT)
+            if job is None:
+                # Still rendering, the client can poll the job from here
+                return jsonify(job_status(job_queue.get(job_id))), 202
+            if job['status'] == 'failed':
+                return jsonify({'error': job['error'], 'jobId': job_id}), 500
+            video_path = job['result']
+        
+        # The video itself is fetched from videoUrl
+        return jsonify({'success': True, **video_metadata(video_path)})
+        
+    except InvalidRequestError as e:
+        return jsonify({'error': str(e)}), 400
+    except QueueFullError as e:
+        return queue_full_response(e)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/avatar/jobs', methods=['POST'])
+def submit_avatar_job():
+    """Queue a generation and return its job id right away"""
+    try:
+        data = request.json
+        video_path, job_id = generate_cached(data)
+        if video_path is not None:
+            return jsonify({'success': True, 'status': 'done', 'cached': True, **video_metadata(video_path)})
+        return jsonify(job_status(job_queue.get(job_id))), 202
+        
+    except InvalidRequestError as e:
+        return jsonify({'error': str(e)}), 400
+    except QueueFullError as e:
+        return queue_full_response(e)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/avatar/jobs/<job_id>', methods=['GET'])
+def get_avatar_job(job_id):
+    """Status of a queued generation"""
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job_status(job))
+
+@app.route('/api/avatar/jobs/<job_id>/result', methods=['GET'])
+def get_avatar_job_result(job_id):
+    """Result of a generation, 202 with Retry-After while it is not done"""
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    if job['status'] == 'failed':
+        return jsonify({'error': job['error'], 'jobId': job_id}), 500
+    if job['status'] != 'done':
+        response = jsonify(job_status(job))
+        response.status_code = 202
+        response.headers['Retry-After'] = str(job_queue.retry_after())
+        return response
+    
+    if job['method'] == 'render_idle_clips':
+        avatar_id = Path(job['result'][0]).parent.name if job['result'] else None
+        return jsonify({'success': True, 'jobId': job_id, 'avatarId': avatar_id,
+                        'clips': [video_metadata(path, f"/api/avatar/idle/{avatar_id}/{index}")
+                                  for index, path in enumerate(job['result'])]})
+    if job['method'] not in GENERATION_METHODS:
+        return jsonify({'success': True, 'jobId': job_id, 'result': job['result']})
+    return jsonify({'success': True, 'jobId': job_id, **video_metadata(job['result'])})
+
+@app.route('/api/avatar/generate-stream', methods=['POST'])
+def generate_avatar_stream():
+    """
+    Generate and stream a talking head video while it is being rendered.
+    format 'fmp4' (default) streams one fragmented MP4 with a fragment per second,
+    format 'mjpeg' streams the frames as multipart JPEG straight from the renderer (video
+    only, the client plays the audio it sent), format 'jpeg' sends one server-sent event
+    per segment with JPEG frames and PCM audio.
+    """
+    try:
+        data = request.json
+        stream_format = data.get('format', 'fmp4')
+        if stream_format not in ('fmp4', 'mjpeg', 'jpeg'):
+            return jsonify({'error': f'Unknown format: {stream_format}'}), 400
+        precision = request_precision(data)
+
+        # Rendered in a worker like any other job, the segments come back as they are done
+        audio_path = save_request_audio(data, prefix='stream_')
+        try:
+            job_id = job_queue.submit_stream(
+                'stream_talking_video',
+                audio_path=str(audio_path),
+                preprocess=data.get('preprocess', 'crop'),
+                still_mode=data.get('stillMode', False),
+                segment_seconds=float(data.get('segmentSeconds', 1.0)),
+                seed=data.get('seed', None),
+                precision=precision,
+                source_image=str(generator.avatar_image_path or generator.default_avatar)
+            )
+        except BaseException:
+            audio_path.unlink(missing_ok=True)
+            raise
+        segments = job_queue.stream(job_id)
+
+        def finish():
+            # also runs when the client leaves before the body was even started
+            segments.close()
+            job_queue.cancel(job_id)
+            audio_path.unlink(missing_ok=True)
+
+        def generate_fmp4():
+            # audio goes to ffmpeg segment by segment, right before its frames
+            audio_chunks = queue.Queue()
+            writer = VideoStreamWriter(None, fps=25, audio_pcm=iter(audio_chunks.get, None))
+            try:
+                for segment in segments:
+                    audio_chunks.put(segment['audio'])
+                    writer.write_batch(segment['frames'])
+                    chunk = writer.read_output()
+                    if chunk:
+                        yield chunk
+                audio_chunks.put(None)
+                writer.close()
+                yield writer.read_output()
+            except Exception as e:
+                print(f"❌ Error streaming video: {e}")
+                writer.abort()
+            except BaseException:
+                # the client went away (GeneratorExit), stop ffmpeg and its audio feed
+                writer.abort()
+                raise
+            finally:
+                audio_chunks.put(None)
+
+        def generate_jpeg():
+            try:
+                for segment in segments:
+                    frames = []
+                    for frame in segment['frames']:
+                        _, buffer = cv2.imencode('.jpg', cv2.cvtColor(frame, cv2.COLOR_RGB2BGR), [cv2.IMWRITE_JPEG_QUALITY, 85])
+                        frames.append(base64.b64encode(buffer).decode('utf-8'))
+                    payload = {
+                        'index': segment['index'],
+                        'start': segment['start'],
+                        'fps': 25,
+                        'frames': frames,
+                        'sampleRate': 16000,
+                        'audio': base64.b64encode(segment['audio'].tobytes()).decode('utf-8')
+                    }
+                    yield f"data: {json.dumps(payload)}\n\n"
+                yield f"event: end\ndata: {{}}\n\n"
+            except Exception as e:
+                print(f"❌ Error streaming video: {e}")
+                yield f"event: error\ndata: {json.dumps({'error': str(e)})}\n\n"
+
+        if stream_format == 'fmp4':
+            response = Response(generate_fmp4(), mimetype='video/mp4', headers={'X-Accel-Buffering': 'no'})
+        elif stream_format == 'mjpeg':
+            stats = stream_registry.open('render')
+            frames = (frame for segment in segments for frame in segment['frames'])
+            response = mjpeg_response(mjpeg_parts(frames, stats, fps=25, rgb=True), stats)
         else:
-            return jsonify({
-                'success': True,
-                'videoPath': str(video_path),
-                'videoId': Path(video_path).stem
-            })
+            response = Response(
+                generate_jpeg(),
+                mimetype='text/event-stream',
+                headers={
+                    'Cache-Control': 'no-cache',
+                    'X-Accel-Buffering': 'no'
+                }
+            )
+        response.call_on_close(finish)
+        return response
         
+    except InvalidRequestError as e:
+        return jsonify({'error': str(e)}), 400
+    except QueueFullError as e:
+        return queue_full_response(e)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+def mjpeg_response(parts, stats):
+    return Response(
+        parts,
+        mimetype=f'multipart/x-mixed-replace; boundary={MJPEG_BOUNDARY}',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no',
+            'X-Stream-Id': stats.id
+        }
+    )
+
 @app.route('/api/avatar/stream/<video_id>')
 def stream_avatar_video(video_id):
-    """Stream avatar video frames in real-time"""
+    """
+    Stream the frames of a rendered video in real time, paced by their timestamps.
+    format 'mjpeg' (default) sends multipart JPEG parts, 'sse' the legacy base64 events
+    """
     try:
-        video_path = Path(tempfile.gettempdir()) / f"{video_id}.mp4"
-        
-        if not video_path.exists():
+        video_path = find_video(video_id)
+        if video_path is None:
             return jsonify({'error': 'Video not found'}), 404
+        stream_format = request.args.get('format', 'mjpeg')
+        if stream_format not in ('mjpeg', 'sse'):
+            return jsonify({'error': f'Unknown format: {stream_format}'}), 400
+        
+        fps, frames = generator.stream_video_frames(video_path)
+        stats = stream_registry.open('replay', fps)
+        if stream_format == 'mjpeg':
+            return mjpeg_response(mjpeg_parts(frames, stats, fps=fps), stats)
         
         def generate_frames():
-            for frame in generator.stream_video_frames(video_path):
-                yield f"data: {json.dumps({'frame': frame})}\n\n"
+            try:
+                for frame, late in paced(frames, fps):
+                    _, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, 85])
+                    event = f"data: {json.dumps({'frame': base64.b64encode(buffer).decode('utf-8')})}\n\n"
+                    stats.record(len(event), late)
+                    yield event
+            finally:
+                stats.close()
         
         return Response(
             generate_frames(),
             mimetype='text/event-stream',
             headers={
                 'Cache-Control': 'no-cache',
-                'X-Accel-Buffering': 'no'
+                'X-Accel-Buffering': 'no',
+                'X-Stream-Id': stats.id
             }
         )
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/avatar/streams', methods=['GET'])
+def get_avatar_streams():
+    """Bitrate and FPS of the active and recently finished frame streams"""
+    return jsonify({'streams': stream_registry.snapshot()})
+
+@app.route('/api/avatar/streams/<stream_id>', methods=['GET'])
+def get_avatar_stream(stream_id):
+    """Bitrate and FPS of one frame stream"""
+    stats = stream_registry.get(stream_id)
+    if stats is None:
+        return jsonify({'error': 'Stream not found'}), 404
+    return jsonify(stats)
+
+@app.route('/api/avatar/video/<video_id>', methods=['GET'])
+def get_avatar_video(video_id):
+    """
+    Serve a rendered video as video/mp4. Range requests are answered with 206 for seeking and
+    progressive playback, the ETag is the content hash so unchanged videos revalidate with 304
+    """
+    try:
+        video_path = find_video(video_id)
+        if video_path is None:
+            return jsonify({'error': 'Video not found'}), 404
+        
+        # send_file uses wsgi.file_wrapper (sendfile under gunicorn) or X-Sendfile when enabled
+        response = send_file(
+            str(video_path),
+            mimetype='video/mp4',
+            conditional=True,
+            etag=content_hash(str(video_path)),
+            max_age=VIDEO_MAX_AGE
+        )
+        response.headers['Accept-Ranges'] = 'bytes'
+        return response
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/avatar/idle/<avatar_id>', methods=['GET'])
+def list_idle_clips(avatar_id):
+    """Idle clips of an avatar, straight from disk (no inference)"""
+    try:
+        clips = [video_metadata(path, f"/api/avatar/idle/{avatar_id}/{index}")
+                 for index, path in enumerate(idle_clip_paths(avatar_id))]
+        return jsonify({
+            'success': True,
+            'avatarId': avatar_id,
+            'ready': len(clips) > 0,
+            'clips': clips
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/avatar/idle/<avatar_id>/<int:index>', methods=['GET'])
+def get_idle_clip(avatar_id, index):
+    """Serve one idle clip, meant to be played on loop"""
+    try:
+        clip_paths = idle_clip_paths(avatar_id)
+        if index >= len(clip_paths):
+            return jsonify({'error': 'Idle clip not found'}), 404
+        
+        response = send_file(
+            str(clip_paths[index]),
+            mimetype='video/mp4',
+            conditional=True,
+            etag=content_hash(str(clip_paths[index])),
+            max_age=VIDEO_MAX_AGE
+        )
+        response.headers['Accept-Ranges'] = 'bytes'
+        return response
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/avatar/quick-generate', methods=['POST'])
 def quick_generate():
     """
@@ -290,40 +941,32 @@ def quick_generate():
     """
     try:
         data = request.json
-        text = data.get('text', '')
-        
-        # Generate audio quickly
-        from gtts import gTTS
-        audio_path = Path(tempfile.gettempdir()) / f"quick_tts_{int(time.time())}.mp3"
-        tts = gTTS(text=text, lang='en', slow=False)
-        tts.save(str(audio_path))
         
-        # Generate with fast settings
-        video_path = generator.generate_talking_video(
-            str(audio_path),
+        # Generate with fast settings, always from the text and sentence by sentence for longer prompts.
+        # Repeated prompts are served from the cache
+        video_path, job_id = generate_cached(
+            {'text': data.get('text', ''), 'seed': data.get('seed', None), 'pipelined': True,
+             'precision': data.get('precision', RENDER_PRECISION)},
+            prefix='quick_',
             preprocess='crop',
             still_mode=True,  # Less head movement = faster
             use_enhancer=False  # Disable enhancer for speed
         )
+        if video_path is None:
+            job = job_queue.wait(job_id, JOB_WAIT_TIMEOUT)
+            if job is None:
+                return jsonify(job_status(job_queue.get(job_id))), 202
+            if job['status'] == 'failed':
+                return jsonify({'error': job['error'], 'jobId': job_id}), 500
+            video_path = job['result']
         
-        # Convert to base64 for immediate use
-        with open(video_path, 'rb') as f:
-            video_base64 = base64.b64encode(f.read()).decode('utf-8')
-        
-        # Get video duration
-        cap = cv2.VideoCapture(str(video_path))
-        fps = cap.get(cv2.CAP_PROP_FPS)
-        frame_count = cap.get(cv2.CAP_PROP_FRAME_COUNT)
-        duration = frame_count / fps if fps > 0 else 0
-        cap.release()
-        
-        return jsonify({
-            'success': True,
-            'video': f"data:video/mp4;base64,{video_base64}",
-            'duration': duration,
-            'videoPath': str(video_path)
-        })
+        # The player streams the video from videoUrl
+        return jsonify({'success': True, **video_metadata(video_path)})
         
+    except InvalidRequestError as e:
+        return jsonify({'error': str(e)}), 400
+    except QueueFullError as e:
+        return queue_full_response(e)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -333,7 +976,11 @@ def health_check():
     return jsonify({
         'status': 'healthy',
         'device': generator.device,
-        'model_loaded': generator.model is not None
+        'model_loaded': any(stats is not None for stats in job_queue.worker_stats().values()),
+        'model_pool': {str(worker_id): stats for worker_id, stats in job_queue.worker_stats().items()},
+        'jobs': job_queue.stats(),
+        'result_cache': result_cache.stats(),
+        'active_streams': sum(1 for stats in stream_registry.snapshot() if stats['active'])
     })
 
 if __name__ == '__main__':
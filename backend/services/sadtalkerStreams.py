@@ -0,0 +1,121 @@
+"""
+SadTalker Frame Streams - Paced MJPEG delivery of avatar frames
+Frames go out as raw JPEG parts of a multipart response, timed by their presentation
+timestamp, and every stream keeps bitrate and FPS statistics
+"""
+
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import cv2
+
+MJPEG_BOUNDARY = 'frame'
+
+
+class StreamStats:
+    """Counters of one frame stream"""
+
+    def __init__(self, kind, fps):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.target_fps = fps
+        self.frames = 0
+        self.bytes = 0
+        self.late_frames = 0
+        self.started = time.monotonic()
+        self.finished = None
+
+    def record(self, nbytes, late=False):
+        self.frames += 1
+        self.bytes += nbytes
+        if late:
+            self.late_frames += 1
+
+    def close(self):
+        if self.finished is None:
+            self.finished = time.monotonic()
+
+    def snapshot(self):
+        elapsed = (self.finished or time.monotonic()) - self.started
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'active': self.finished is None,
+            'frames': self.frames,
+            'bytes': self.bytes,
+            'elapsed': elapsed,
+            'fps': self.frames / elapsed if elapsed > 0 else 0,
+            'target_fps': self.target_fps,
+            'bitrate_kbps': self.bytes * 8 / 1000 / elapsed if elapsed > 0 else 0,
+            'late_frames': self.late_frames
+        }
+
+
+class StreamRegistry:
+    """Stats of the active streams and of the most recent finished ones"""
+
+    def __init__(self, keep=50):
+        self.keep = keep
+        self._streams = OrderedDict()
+        self._lock = threading.Lock()
+
+    def open(self, kind, fps=25):
+        stats = StreamStats(kind, fps)
+        with self._lock:
+            self._streams[stats.id] = stats
+            finished = [stream_id for stream_id, s in self._streams.items() if s.finished is not None]
+            for stream_id in finished[:max(0, len(self._streams) - self.keep)]:
+                del self._streams[stream_id]
+        return stats
+
+    def get(self, stream_id):
+        with self._lock:
+            stats = self._streams.get(stream_id)
+        return stats.snapshot() if stats is not None else None
+
+    def snapshot(self):
+        with self._lock:
+            streams = list(self._streams.values())
+        return [stats.snapshot() for stats in streams]
+
+
+def paced(frames, fps=25):
+    """
+    Yield (frame, late) with frame i released at its presentation time start + i / fps.
+    Sleeping up to a deadline instead of a fixed delay does not drift with encode time,
+    and a source slower than real time is never delayed further
+    """
+    start = None
+    for i, frame in enumerate(frames):
+        now = time.monotonic()
+        if start is None:
+            # the clock starts with the first frame, which is always on time
+            start = now
+        delay = start + i / fps - now
+        if delay > 0:
+            time.sleep(delay)
+        yield frame, delay < 0
+
+
+def encode_jpeg(frame, quality=85, rgb=False):
+    if rgb:
+        frame = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
+    _, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    return buffer.tobytes()
+
+
+def mjpeg_parts(frames, stats, fps=25, quality=85, rgb=False):
+    """Multipart MJPEG body: one raw JPEG part per frame, no base64 or JSON"""
+    try:
+        for i, (frame, late) in enumerate(paced(frames, fps)):
+            jpeg = encode_jpeg(frame, quality, rgb)
+            header = (f"--{MJPEG_BOUNDARY}\r\n"
+                      f"Content-Type: image/jpeg\r\n"
+                      f"Content-Length: {len(jpeg)}\r\n"
+                      f"X-Timestamp: {i / fps:.3f}\r\n\r\n").encode()
+            stats.record(len(header) + len(jpeg) + 2, late)
+            yield header + jpeg + b'\r\n'
+    finally:
+        stats.close()
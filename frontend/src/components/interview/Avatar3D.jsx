@@ -8,6 +8,9 @@ import axios from 'axios';
 import { Loader, Video, Volume2, AlertCircle, Sparkles } from 'lucide-react';
 
 const API_BASE_URL = import.meta.env.VITE_API_BASE_URL || 'http://localhost:5000';
+// The backend waits up to SADTALKER_JOB_TIMEOUT seconds for a render (600 by default), keep
+// this in step with it, plus a minute for its last poll and the response
+const AVATAR_TIMEOUT_MS = (parseFloat(import.meta.env.VITE_AVATAR_TIMEOUT || '600') + 60) * 1000;
 
 const Avatar3D = ({ 
   textToSpeak, 
@@ -97,12 +100,11 @@ const Avatar3D = ({
           options: {
             preprocess: 'crop',
             stillMode: false,
-            useEnhancer: avatarConfig?.settings?.enableEnhancer || false,
-            returnBase64: true
+            useEnhancer: avatarConfig?.settings?.enableEnhancer || false
           }
         },
         {
-          timeout: 90000, // 90 seconds
+          timeout: AVATAR_TIMEOUT_MS,
           headers: {
             'Content-Type': 'application/json'
           },
@@ -115,8 +117,9 @@ const Avatar3D = ({
 
       setGenerationProgress(90);
 
-      if (response.data.success && response.data.data.video) {
-        setVideoSrc(response.data.data.video);
+      if (response.data.success && response.data.data.videoUrl) {
+        // The video is streamed (with seeking) from its URL instead of a base64 payload
+        setVideoSrc(`${API_BASE_URL}${response.data.data.videoUrl}`);
         setGenerationProgress(100);
         console.log('✅ Avatar video generated successfully');
         